@@ -11,7 +11,7 @@ try:
 except ImportError:
     from PyQt5.Qt import QMenu, QToolButton, QApplication, QUrl, Qt
 
-import json, os
+import io, os
 from datetime import datetime
 try:
     from calibre.utils.iso8601 import local_tz
@@ -26,8 +26,10 @@ from calibre.gui2.dialogs.confirm_delete import confirm
 from calibre_plugins.find_duplicates.common_icons import set_plugin_icon_resources, get_icon
 from calibre_plugins.find_duplicates.common_menus import unregister_menu_actions, create_menu_action_unique
 from calibre_plugins.find_duplicates.dialogs import (FindBookDuplicatesDialog, FindVariationsDialog,
-                                FindLibraryDuplicatesDialog, ManageExemptionsDialog)
+                                FindLibraryDuplicatesDialog, ManageExemptionsDialog, ExportDuplicatesDialog)
+from calibre_plugins.find_duplicates.common_dialogs import run_with_progress
 from calibre_plugins.find_duplicates.duplicates import DuplicateFinder, CrossLibraryDuplicateFinder
+from calibre_plugins.find_duplicates.worker import SearchCancelled
 
 try:
     load_translations()
@@ -134,7 +136,7 @@ class FindDuplicatesAction(InterfaceAction):
         m.addSeparator()
         self.export_duplicates_action = create_menu_action_unique(self, m,
                                 _('&Export duplicate groups'),
-                                tooltip=_('Export duplicates groups to a json file'),
+                                tooltip=_('Export duplicates groups to a JSON, JSON Lines or CSV file'),
                                 triggered=self.export_duplicates)
         self.merge_all_groups_action = create_menu_action_unique(self, m,
                                 _('&Merge all groups'),
@@ -342,39 +344,42 @@ class FindDuplicatesAction(InterfaceAction):
 
     def export_duplicates(self):
         '''
-        export all duplicate books to a json file.
+        export all duplicate groups to a file, streaming a chunk of groups at a time
         '''
         self.duplicate_finder._cleanup_deleted_books()
 
-        json_path = choose_save_file(self.gui, 'export-duplicates', _('Choose file'), filters=[
-            (_('Saved duplicates'), ['json'])], all_files=False)
-        if json_path:
-            if not json_path.lower().endswith('.json'):
-                json_path += '.json'
-        if not json_path:
+        d = ExportDuplicatesDialog(self.gui)
+        if d.exec_() != d.Accepted:
+            return
+        export_format = d.export_format
+        export_path = choose_save_file(self.gui, 'export-duplicates', _('Choose file'), filters=[
+            (_('Saved duplicates'), [export_format])], all_files=False)
+        if export_path:
+            if not export_path.lower().endswith('.' + export_format):
+                export_path += '.' + export_format
+        if not export_path:
             return
 
         if iswindows:
-            json_path = os.path.normpath(json_path)
-
-        entangled_books = {}
-        for book_id, groups in self.duplicate_finder._groups_for_book_map.items():
-            if len(groups) > 1:
-                entangled_books[book_id] = list(groups)
+            export_path = os.path.normpath(export_path)
 
-        data = {
-            'books_for_group': self.duplicate_finder._books_for_group_map,
-            'entangled_groups_for_book': entangled_books,
+        header = {
             'library_uuid': self.gui.current_db.library_id,
             'library_path': self.gui.current_db.library_path,
             'timestamp': datetime.now().replace(tzinfo=local_tz).isoformat()
         }
 
-        with open(json_path, 'w') as f:
-            json.dump(data, f, indent=4)
+        def run_export(progress):
+            with io.open(export_path, 'w', encoding='utf-8', newline='') as f:
+                self.duplicate_finder.export_results(f, export_format, d.columns, header, progress)
+        try:
+            run_with_progress(self.gui, _('Exporting duplicates'), run_export)
+        except SearchCancelled:
+            os.remove(export_path)
+            return
 
         info_dialog(self.gui, _('Export completed'),
-                    _('Exported to: {}').format(json_path),
+                    _('Exported to: {}').format(export_path),
                     show=True, show_copy_button=False)
 
     def show_help(self):
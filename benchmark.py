@@ -0,0 +1,504 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+'''
+Benchmark the duplicate searches against a synthetic library, to measure
+whether a change makes them faster or slower. Run with:
+
+    calibre-debug -e benchmark.py -- [options] LIBRARY_DIR
+
+The library is generated in LIBRARY_DIR from the options describing it the
+first time, and reused by later runs with the same options. Each search is
+run several times to time each of its stages, then once more while tracing
+memory allocations to find the peak memory of each stage. The results are
+written as JSON, and can be compared against the results of an earlier run.
+
+Like cli.py, this module must never import Qt.
+'''
+
+import argparse, io, json, os, platform, random, sys, time, unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from calibre.constants import numeric_version
+
+from calibre_plugins.find_duplicates.book_algorithms import create_algorithm
+from calibre_plugins.find_duplicates.cli import (open_library, PREFS_NAMESPACE,
+                    KEY_BOOK_EXEMPTIONS, KEY_AUTHOR_EXEMPTIONS)
+from calibre_plugins.find_duplicates.exemptions import ExemptionStore
+from calibre_plugins.find_duplicates.matching import set_soundex_lengths
+from calibre_plugins.find_duplicates.stats import SearchStats
+from calibre_plugins.find_duplicates.variation_algorithms import VariationAlgorithm
+
+try:
+    load_translations()
+except NameError:
+    pass
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+BENCHMARK_NAMESPACE = 'FindDuplicatesBenchmark'
+
+# Each search is a tuple of (name, search type, title match, author match)
+BOOK_SEARCHES = [
+    ('identical title, identical author', 'titleauthor', 'identical', 'identical'),
+    ('similar title, similar author', 'titleauthor', 'similar', 'similar'),
+    ('soundex title, soundex author', 'titleauthor', 'soundex', 'soundex'),
+    ('fuzzy title, fuzzy author', 'titleauthor', 'fuzzy', 'fuzzy'),
+    ('similar title, ignore author', 'titleauthor', 'similar', 'ignore'),
+    ('ignore title, similar author', 'titleauthor', 'ignore', 'similar'),
+    ('ignore title, fuzzy author', 'titleauthor', 'ignore', 'fuzzy'),
+    ('isbn identifier', 'identifier', 'identical', 'identical'),
+    ('binary compare', 'binary', 'identical', 'identical'),
+]
+# Each variation search is a tuple of (name, match type, item type)
+VARIATION_SEARCHES = [('{0} {1} variations'.format(match_type, item_type), match_type, item_type)
+                      for item_type in ['authors', 'series', 'publisher', 'tags']
+                      for match_type in ['similar', 'soundex', 'fuzzy']]
+
+# The book searches time their own stages, the variation search does not
+VARIATION_STAGES = ['_get_items_to_consider', '_find_candidates', '_flatten_candidates_for_item',
+                    '_get_counts_for_candidates']
+
+ASCII_WORDS = ['the', 'dark', 'tower', 'house', 'river', 'night', 'garden', 'shadow', 'empire',
+               'winter', 'silver', 'secret', 'history', 'island', 'kingdom', 'machine', 'stone',
+               'storm', 'queen', 'fire', 'ocean', 'forest', 'glass', 'crown', 'journey', 'letters',
+               'memory', 'city', 'song', 'war', 'light', 'children', 'road', 'summer', 'blood']
+UNICODE_WORDS = ['Ångström', 'café', 'naïve', 'señor', 'über', 'Ærø', 'Żółć', 'façade', 'smörgåsbord',
+                 'Москва', 'война', 'мир', '東京', '物語', 'Αθήνα', 'λόγος', 'Đà Lạt', 'İstanbul']
+FIRST_NAMES = ['John', 'Mary', 'Kevin', 'Anne', 'Peter', 'Susan', 'James', 'Linda', 'Robert', 'Karen',
+               'Michael', 'Sarah', 'David', 'Emma', 'Richard', 'Laura', 'Thomas', 'Helen']
+LAST_NAMES = ['Smith', 'Anderson', 'Brown', 'Taylor', 'Wilson', 'Moore', 'Clarke', 'Walker', 'Wright',
+              'Hughes', 'Edwards', 'Green', 'Hall', 'Wood', 'Harris', 'Martin', 'Jackson', 'Thompson']
+UNICODE_NAMES = ['José', 'Zoë', 'Jürgen', 'Søren', 'Łukasz', 'Ðorđe', 'Fyodor Dostoevsky', 'Фёдор',
+                 'Достоевский', '村上', '春樹', 'Brontë', 'Müller', 'García Márquez', 'Čapek']
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='calibre-debug -e benchmark.py --',
+                description='Benchmark the duplicate searches against a synthetic library.')
+    parser.add_argument('library_dir', help='The directory to generate (or reuse) the synthetic library in')
+    parser.add_argument('--books', type=int, default=10000,
+                        help='The number of books in the library (default: %(default)s)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.1,
+                        help='The share of books which are variations of another book (default: %(default)s)')
+    parser.add_argument('--author-skew', type=float, default=1.0,
+                        help='How strongly books are concentrated on the most popular authors, '
+                             'as the exponent of a Zipf distribution (default: %(default)s)')
+    parser.add_argument('--unicode-share', type=float, default=0.1,
+                        help='The share of titles and authors containing non-ascii text (default: %(default)s)')
+    parser.add_argument('--exemptions', type=int, default=100,
+                        help='The number of book exemption groups, and of author exemption groups '
+                             '(default: %(default)s)')
+    parser.add_argument('--format-size', default='1024:65536', metavar='MIN:MAX',
+                        help='The range of sizes in bytes of the format of each book, '
+                             'or 0 for books without formats (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='The seed for generating the library')
+    parser.add_argument('--searches', metavar='TEXT', action='append',
+                        help='Only run the searches whose name contains this text. May be repeated.')
+    parser.add_argument('--cluster-groups', action='store_true',
+                        help='Merge overlapping groups into disjoint groups')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of timed runs of each search (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not run each search again to measure its peak memory')
+    parser.add_argument('--output', metavar='PATH', help='The file to write the results to instead of stdout')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='The results of an earlier run to compare these results against')
+    return parser
+
+
+# --------------------------------------------------------------
+#                  Synthetic Library Generation
+# --------------------------------------------------------------
+
+def get_library_spec(opts):
+    '''
+    The options which describe the synthetic library, used to decide whether
+    an existing library can be reused.
+    '''
+    return OrderedDict([('books', opts.books), ('duplicate_rate', opts.duplicate_rate),
+                        ('author_skew', opts.author_skew), ('unicode_share', opts.unicode_share),
+                        ('exemptions', opts.exemptions), ('format_size', opts.format_size),
+                        ('seed', opts.seed)])
+
+
+def strip_accents(text):
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+
+class LibraryGenerator(object):
+    '''
+    Generates the metadata for the books of a synthetic library. A share of the
+    books are variations of an earlier book, as a duplicate would be in a real
+    library, with the kinds of differences the fuzzier algorithms are meant to
+    catch. A duplicate keeps the identifiers and format contents of its original.
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+        self.rand = random.Random(spec['seed'])
+        min_size, _sep, max_size = spec['format_size'].partition(':')
+        self.min_size = int(min_size)
+        self.max_size = int(max_size or min_size)
+        self.authors = [self._create_author() for _i in range(max(10, spec['books'] // 5))]
+        # The weight of each author falls away with their popularity rank
+        self.author_weights = []
+        total = 0.0
+        for rank in range(1, len(self.authors) + 1):
+            total += 1.0 / rank ** spec['author_skew']
+            self.author_weights.append(total)
+        self.series = self._create_names(max(5, spec['books'] // 20), 2)
+        self.publishers = self._create_names(max(5, spec['books'] // 200), 2)
+        self.tags = self._create_names(max(5, spec['books'] // 100), 1)
+
+    def _is_unicode(self):
+        return self.rand.random() < self.spec['unicode_share']
+
+    def _words(self, count):
+        return [self.rand.choice(UNICODE_WORDS if self._is_unicode() else ASCII_WORDS) for _i in range(count)]
+
+    def _create_author(self):
+        if self._is_unicode():
+            return '{0} {1}'.format(self.rand.choice(UNICODE_NAMES), self.rand.choice(LAST_NAMES))
+        return '{0} {1}'.format(self.rand.choice(FIRST_NAMES), self.rand.choice(LAST_NAMES))
+
+    def _create_names(self, count, word_count):
+        names = ['{0} {1}'.format(' '.join(self._words(word_count)).title(), idx) for idx in range(count)]
+        # Variations of some of the names for the variation searches to find
+        for name in list(names):
+            if self.rand.random() < self.spec['duplicate_rate']:
+                names.append(self._vary_text(name))
+        return names
+
+    def _vary_text(self, text):
+        variation = self.rand.randint(0, 4)
+        if variation == 0:
+            return text.lower()
+        elif variation == 1:
+            return strip_accents(text) if text != strip_accents(text) else text.upper()
+        elif variation == 2:
+            return text + '.'
+        elif variation == 3:
+            return 'The ' + text if not text.startswith('The ') else text[4:]
+        return text.replace(' ', '  ', 1)
+
+    def _vary_author(self, author):
+        variation = self.rand.randint(0, 3)
+        first, _sep, last = author.rpartition(' ')
+        if variation == 0 and first:
+            return '{0}, {1}'.format(last, first)
+        elif variation == 1 and first:
+            return '{0}. {1}'.format(first[0], last)
+        elif variation == 2:
+            return strip_accents(author)
+        return author.lower()
+
+    def _vary_title(self, title):
+        if self.rand.random() < 0.3:
+            return title + ': ' + ' '.join(self._words(2)).title()
+        return self._vary_text(title)
+
+    def _choose_author(self):
+        return self.rand.choices(self.authors, cum_weights=self.author_weights)[0]
+
+    def _format_size(self):
+        # Sizes are rounded so that books which are not duplicates also share
+        # sizes, and their contents must be compared by the binary search
+        return self.rand.randint(self.min_size, self.max_size) // 1024 * 1024 or self.min_size
+
+    def generate_books(self):
+        '''
+        Generator returning a dictionary of the metadata for each book
+        '''
+        originals = []
+        for idx in range(self.spec['books']):
+            if originals and self.rand.random() < self.spec['duplicate_rate']:
+                original = self.rand.choice(originals)
+                book = dict(original)
+                book['title'] = self._vary_title(original['title'])
+                book['authors'] = [self._vary_author(author) for author in original['authors']]
+            else:
+                author_count = 1 if self.rand.random() < 0.9 else 2
+                book = {
+                    'title': ' '.join(self._words(self.rand.randint(1, 5))).title(),
+                    'authors': list(OrderedDict.fromkeys(self._choose_author() for _i in range(author_count))),
+                    'series': self.rand.choice(self.series) if self.rand.random() < 0.3 else None,
+                    'publisher': self.rand.choice(self.publishers),
+                    'tags': self.rand.sample(self.tags, min(len(self.tags), self.rand.randint(0, 3))),
+                    'isbn': '978%010d' % idx,
+                    'format_size': self._format_size() if self.max_size else 0,
+                    'format_seed': idx,
+                }
+                originals.append(book)
+            yield book
+
+    def generate_exemptions(self, book_ids_map, count):
+        '''
+        Return lists of the book exemption groups and author exemption groups,
+        taken from books which are duplicates so that they will partition groups
+        '''
+        book_groups, author_groups = [], []
+        duplicated = [book_ids for book_ids in book_ids_map.values() if len(book_ids) > 1]
+        for _i in range(min(count, len(duplicated))):
+            book_ids = self.rand.choice(duplicated)
+            book_groups.append(self.rand.sample(book_ids, min(len(book_ids), self.rand.randint(2, 4))))
+        for _i in range(count):
+            author_groups.append([self._choose_author(), self._choose_author()])
+        return book_groups, [group for group in author_groups if group[0] != group[1]]
+
+
+def create_library(library_dir, spec):
+    '''
+    Open the synthetic library in the directory, first generating it if it
+    does not already exist with the same spec
+    '''
+    from calibre.ebooks.metadata.book.base import Metadata
+
+    if not os.path.exists(library_dir):
+        os.makedirs(library_dir)
+    db = open_library(library_dir)
+    existing_spec = db.prefs.get_namespaced(BENCHMARK_NAMESPACE, 'spec', None)
+    if existing_spec == spec:
+        return db
+    if existing_spec is not None or list(db.all_ids()):
+        raise ValueError('{0} already contains a different library, choose an empty directory'.format(library_dir))
+
+    print('Generating a library of {0} books in {1}'.format(spec['books'], library_dir), file=sys.stderr)
+    generator = LibraryGenerator(spec)
+    book_ids_map = OrderedDict()
+    for count, book in enumerate(generator.generate_books()):
+        mi = Metadata(book['title'], book['authors'])
+        mi.series = book['series']
+        mi.series_index = 1.0
+        mi.publisher = book['publisher']
+        mi.tags = book['tags']
+        mi.languages = ['eng']
+        mi.set_identifiers({'isbn': book['isbn']})
+        book_id = db.new_api.create_book_entry(mi, add_duplicates=True)
+        if book['format_size']:
+            data = random.Random(book['format_seed']).getrandbits(8 * book['format_size'])
+            data = data.to_bytes(book['format_size'], 'little')
+            db.new_api.add_format(book_id, 'EPUB', io.BytesIO(data), run_hooks=False)
+        book_ids_map.setdefault(book['format_seed'], []).append(book_id)
+        if count % 1000 == 0:
+            print('  {0} books'.format(count), file=sys.stderr)
+
+    book_groups, author_groups = generator.generate_exemptions(book_ids_map, spec['exemptions'])
+    ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_BOOK_EXEMPTIONS).replace_all(book_groups)
+    ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_AUTHOR_EXEMPTIONS).replace_all(author_groups)
+    db.prefs.set_namespaced(BENCHMARK_NAMESPACE, 'spec', spec)
+    return db
+
+
+# --------------------------------------------------------------
+#                     Timing The Searches
+# --------------------------------------------------------------
+
+class BenchmarkStats(SearchStats):
+    '''
+    Search stats which also count the calls of each stage and optionally record
+    the peak memory allocated while it ran. As with the times, stages called many
+    times such as partitioning each group are summed. A stage nested within
+    another is included in the peak memory of the stage it runs within.
+    '''
+    def __init__(self, trace_memory=False):
+        SearchStats.__init__(self)
+        self.trace_memory = trace_memory
+        self.calls = {}
+        self.peak_bytes = {}
+        self.search_peak_bytes = 0
+        # The memory at the start of each running stage and its peak so far
+        self._running_memory = []
+
+    @contextmanager
+    def stage(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if not self.trace_memory:
+            with SearchStats.stage(self, name):
+                yield
+            return
+        self._update_peaks()
+        running = [tracemalloc.get_traced_memory()[0], 0]
+        self._running_memory.append(running)
+        try:
+            with SearchStats.stage(self, name):
+                yield
+        finally:
+            self._update_peaks()
+            self._running_memory.pop()
+            self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), running[1] - running[0])
+
+    def _update_peaks(self):
+        # Add the peak since the last reset to every running stage before it
+        # is reset, so that a nested stage does not lose the peak of its parents
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        self.search_peak_bytes = max(self.search_peak_bytes, peak_bytes)
+        for running in self._running_memory:
+            running[1] = max(running[1], peak_bytes)
+        tracemalloc.reset_peak()
+
+    def wrap(self, algorithm, method_names):
+        '''
+        Run each of these methods of an algorithm without stats of its own as a stage
+        '''
+        for name in method_names:
+            fn = getattr(algorithm, name)
+            setattr(algorithm, name, self._stage_of(name, fn))
+
+    def _stage_of(self, name, fn):
+        def staged(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return staged
+
+    def as_stages(self):
+        '''
+        Return an ordered dictionary of the seconds, calls and peak memory of each stage
+        '''
+        return OrderedDict((name, {'seconds': seconds, 'calls': self.calls.get(name, 0),
+                                   'peak_bytes': self.peak_bytes.get(name)})
+                           for name, seconds in self.stages.items())
+
+
+def run_book_search(db, search, opts, exemption_maps, stats):
+    '''
+    Run the search, returning the number of groups found
+    '''
+    _name, search_type, title_match, author_match = search
+    algorithm, _text = create_algorithm(None, db, search_type, 'isbn', title_match, author_match,
+                                        *exemption_maps)
+    algorithm.stats = stats
+    if search_type == 'binary':
+        # Otherwise every run after the first would only read the cached hashes
+        db.delete_all_custom_book_data('find_duplicates')
+    books_for_group_map, _groups_for_book_map = algorithm.run_duplicate_check(True, False, opts.cluster_groups)
+    return len(books_for_group_map)
+
+
+def run_variation_search(db, search, opts, exemption_maps, stats):
+    _name, match_type, item_type = search
+    algorithm = VariationAlgorithm(db)
+    stats.wrap(algorithm, VARIATION_STAGES)
+    _item_map, _count_map, variations_map = algorithm.run_variation_check(match_type, item_type)
+    return len(variations_map)
+
+
+def benchmark_search(db, run_search, search, opts, exemption_maps):
+    '''
+    Time each stage of the search over the repeated runs, keeping the fastest
+    run of each stage, then run it again tracing memory for the peaks
+    '''
+    result = OrderedDict([('search', search[0]), ('seconds', None), ('peak_bytes', None),
+                          ('groups', None), ('stages', OrderedDict())])
+    for _i in range(max(1, opts.repeat)):
+        stats = BenchmarkStats()
+        start = perf_counter()
+        result['groups'] = run_search(db, search, opts, exemption_maps, stats)
+        seconds = perf_counter() - start
+        if result['seconds'] is None or seconds < result['seconds']:
+            result['seconds'] = seconds
+        for name, stage in stats.as_stages().items():
+            best = result['stages'].setdefault(name, stage)
+            best['seconds'] = min(best['seconds'], stage['seconds'])
+
+    if not opts.no_memory and tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+        stats = BenchmarkStats(trace_memory=True)
+        tracemalloc.start()
+        try:
+            run_search(db, search, opts, exemption_maps, stats)
+            result['peak_bytes'] = max(stats.search_peak_bytes, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        for name, stage in stats.as_stages().items():
+            result['stages'][name]['peak_bytes'] = stage['peak_bytes']
+    return result
+
+
+def print_comparison(results, baseline, out):
+    '''
+    Print the change in time and peak memory of each search and stage
+    against the baseline results
+    '''
+    def change(value, baseline_value):
+        if not value or not baseline_value:
+            return '-'
+        return '{0:+.1f}%'.format(100.0 * (value - baseline_value) / baseline_value)
+
+    baseline_map = dict((result['search'], result) for result in baseline['results'])
+    print('{0:<45} {1:>10} {2:>10} {3:>9} {4:>9}'.format('search / stage', 'baseline s', 'current s',
+                                                         'time', 'memory'), file=out)
+    for result in results['results']:
+        baseline_result = baseline_map.get(result['search'])
+        if baseline_result is None:
+            continue
+        if baseline_result['groups'] != result['groups']:
+            print('{0}: found {1} groups rather than {2}'.format(result['search'], result['groups'],
+                                                                 baseline_result['groups']), file=out)
+        rows = [(result['search'], result, baseline_result)]
+        rows.extend(('  ' + name, stage, baseline_result['stages'][name])
+                    for name, stage in result['stages'].items() if name in baseline_result['stages'])
+        for name, current, previous in rows:
+            print('{0:<45} {1:>10.4f} {2:>10.4f} {3:>9} {4:>9}'.format(name[:45], previous['seconds'],
+                        current['seconds'], change(current['seconds'], previous['seconds']),
+                        change(current['peak_bytes'], previous['peak_bytes'])), file=out)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == '--':
+        args = args[1:]
+    opts = create_parser().parse_args(args)
+    spec = get_library_spec(opts)
+    set_soundex_lengths(6, 8)
+
+    # The algorithms print their debug diagnostics to stdout
+    results_out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        db = create_library(opts.library_dir, spec)
+        exemption_maps = (ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_BOOK_EXEMPTIONS).exemptions_map,
+                          ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_AUTHOR_EXEMPTIONS).exemptions_map)
+        searches = [(run_book_search, search) for search in BOOK_SEARCHES] + \
+                   [(run_variation_search, search) for search in VARIATION_SEARCHES]
+        if opts.searches:
+            searches = [(run_search, search) for run_search, search in searches
+                        if any(text in search[0] for text in opts.searches)]
+        results = OrderedDict([
+            ('timestamp', datetime.now().isoformat()),
+            ('calibre_version', '.'.join(str(part) for part in numeric_version)),
+            ('python_version', platform.python_version()),
+            ('platform', platform.platform()),
+            ('library', spec),
+            ('repeat', opts.repeat),
+            ('cluster_groups', opts.cluster_groups),
+            ('results', [])
+        ])
+        for run_search, search in searches:
+            print('Benchmarking {0}'.format(search[0]), file=sys.stderr)
+            results['results'].append(benchmark_search(db, run_search, search, opts, exemption_maps))
+    finally:
+        sys.stdout = results_out
+
+    if opts.output:
+        with io.open(opts.output, 'w', encoding='utf-8') as out:
+            out.write(json.dumps(results, indent=4, ensure_ascii=False))
+    else:
+        json.dump(results, results_out, indent=4)
+        results_out.write('\n')
+    if opts.compare:
+        with io.open(opts.compare, encoding='utf-8') as f:
+            print_comparison(results, json.load(f), sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,19 +3,29 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import time, traceback
+import traceback
 from collections import OrderedDict, defaultdict
 
-try:
-    from qt.core import QModelIndex
-except ImportError:
-    from PyQt5.Qt import QModelIndex
-
 from calibre import prints
 from calibre.constants import DEBUG
 
-from calibre_plugins.find_duplicates.matching import (authors_to_list, similar_title_match,
-                                get_author_algorithm_fn, get_title_algorithm_fn)
+# This module must not import Qt at the module level, so that the algorithms
+# can also be run outside of the calibre user interface.
+
+from calibre_plugins.find_duplicates.matching import (authors_to_list, get_field_pairs, similar_title_match,
+                                get_author_algorithm_fn, get_title_algorithm_fn,
+                                get_field_for_books, authors_for_books, books_for_authors, languages_for_books,
+                                remove_subset_groups, cluster_candidate_groups, title_author_candidate_keys,
+                                title_author_keys, group_candidates)
+from calibre_plugins.find_duplicates.numpy_engine import is_numpy_available, group_shared_candidates
+from calibre_plugins.find_duplicates.parallel import find_title_author_candidates_in_parallel
+from calibre_plugins.find_duplicates.stats import (SearchStats, STAGE_IDS, STAGE_FETCH, STAGE_KEYS,
+                                STAGE_SHRINK, STAGE_SORT, STAGE_CLEANUP, STAGE_PARTITION,
+                                COUNTER_BOOKS, COUNTER_UNIQUE_KEYS, COUNTER_GROUPS_AFTER_SHRINK,
+                                COUNTER_GROUPS_AFTER_CLEANUP, COUNTER_DUPLICATE_GROUPS,
+                                COUNTER_FORMATS_HASHED, COUNTER_HASH_BYTES)
+from calibre_plugins.find_duplicates.worker import (report_progress, iter_with_progress,
+                                PROGRESS_CHUNK_SIZE)
 
 try:
     load_translations()
@@ -25,6 +35,9 @@ except NameError:
 DUPLICATE_SEARCH_FOR_BOOK = 'BOOK'
 DUPLICATE_SEARCH_FOR_AUTHOR = 'AUTHOR'
 
+# Below this many books the cost of starting worker processes outweighs the gain
+DEFAULT_PARALLEL_THRESHOLD = 100000
+
 # --------------------------------------------------------------
 #             Find Duplicate Book Algorithm Classes
 # --------------------------------------------------------------
@@ -36,55 +49,123 @@ class AlgorithmBase(object):
     def __init__(self, gui, db, exemptions_map):
         self.gui = gui
         self.db = db
-        self.model = self.gui.library_view.model()
+        # There is no gui when run from the command line
+        self.model = self.gui.library_view.model() if self.gui is not None else None
         self._exemptions_map = exemptions_map
+        self._progress = None
+        self.parallel_workers = 1
+        self.parallel_threshold = DEFAULT_PARALLEL_THRESHOLD
+        self.use_numpy = False
+        # The timings and counts of the search, an algorithm is run only once
+        self.stats = SearchStats()
 
     def duplicate_search_mode(self):
         return DUPLICATE_SEARCH_FOR_BOOK
 
-    def run_duplicate_check(self, sort_groups_by_title=True, include_languages=False):
+    def set_progress(self, progress):
+        '''
+        Set a function of (stage, done, total) for the algorithm to report its
+        progress to as it runs. The function returns False to cancel the search.
+        '''
+        self._progress = progress
+
+    def set_parallel(self, workers, threshold=DEFAULT_PARALLEL_THRESHOLD):
+        '''
+        Allow the candidates to be computed using this many worker processes,
+        if the algorithm supports it and there are at least threshold books.
+        '''
+        self.parallel_workers = workers
+        self.parallel_threshold = threshold
+
+    def set_use_numpy(self, use_numpy):
+        '''
+        Allow the candidate keys shared by several books to be grouped using
+        NumPy when it is available, rather than with a set or dict per key.
+        '''
+        self.use_numpy = use_numpy
+
+    def report_progress(self, stage, done=0, total=0):
+        report_progress(self._progress, stage, done, total)
+
+    def iter_with_progress(self, items, stage, total=None, chunk_size=PROGRESS_CHUNK_SIZE):
+        return iter_with_progress(self._progress, items, stage, total, chunk_size)
+
+    def run_duplicate_check(self, sort_groups_by_title=True, include_languages=False,
+                            cluster_groups=False, book_ids=None):
         '''
         The entry point for running the algorithm
+        If cluster_groups is True, overlapping candidate groups are merged into
+        disjoint groups rather than only removing groups that are subsets.
+        The book ids should be given when not running on the gui thread, as
+        by default they are read from the library view.
         '''
-        book_ids = self.get_book_ids_to_consider()
-        start = time.time()
+        stats = self.stats
+        if book_ids is None:
+            with stats.stage(STAGE_IDS):
+                book_ids = self.get_book_ids_to_consider()
+        stats.set_count(COUNTER_BOOKS, len(book_ids))
 
         # Get our map of potential duplicate candidates
-        self.gui.status_bar.showMessage(_('Analysing {0} books for duplicates').format(len(book_ids)))
-        candidates_map = self.find_candidates(book_ids, include_languages)
+        self.report_progress(_('Analysing {0} books for duplicates').format(len(book_ids)))
+        with stats.stage(STAGE_KEYS):
+            candidates_map = self.find_candidates(book_ids, include_languages, shared_only=True)
+        stats.counters.setdefault(COUNTER_UNIQUE_KEYS, len(candidates_map))
 
-        # Perform a quick pass through removing all groups with < 2 members
-        self.shrink_candidates_map(candidates_map)
+        # Perform a quick pass through removing all groups with < 2 members,
+        # for the algorithms which always return every key
+        with stats.stage(STAGE_SHRINK):
+            self.shrink_candidates_map(candidates_map)
+        stats.set_count(COUNTER_GROUPS_AFTER_SHRINK, len(candidates_map))
 
         # Now ask for these candidate groups to be ordered so that our numbered
         # groups will have some kind of consistent order to them.
-        candidates_map = self.sort_candidate_groups(candidates_map, sort_groups_by_title)
+        self.report_progress(_('Sorting {0} duplicate groups').format(len(candidates_map)))
+        with stats.stage(STAGE_SORT):
+            candidates_map = self.sort_candidate_groups(candidates_map, sort_groups_by_title)
 
         # Convert our dictionary of potential candidates into sets of more than one
-        books_for_groups_map, groups_for_book_map = self.convert_candidates_to_groups(candidates_map)
+        books_for_groups_map, groups_for_book_map = self.convert_candidates_to_groups(candidates_map,
+                                                                                       cluster_groups)
+        stats.set_count(COUNTER_DUPLICATE_GROUPS, len(books_for_groups_map))
         if DEBUG:
-            prints('Completed duplicate analysis in:', time.time() - start)
+            prints('Completed duplicate analysis in:', stats.total_time())
             prints('Found %d duplicate groups covering %d books'%(len(books_for_groups_map),
                                                                    len(groups_for_book_map)))
+            for line in stats.format_lines():
+                prints(line)
         return books_for_groups_map, groups_for_book_map
 
     def get_book_ids_to_consider(self):
         '''
         Default implementation will iterate over the current subset of books
-        in our current library model
+        in our current library model, or all the books without the gui
         '''
+        if self.model is None:
+            return list(self.db.all_ids())
+        try:
+            from qt.core import QModelIndex
+        except ImportError:
+            from PyQt5.Qt import QModelIndex
         rows = list(range(self.model.rowCount(QModelIndex())))
         book_ids = list(map(self.model.id, rows))
         return book_ids
 
-    def find_candidates(self, book_ids, include_languages=False):
+    def find_candidates(self, book_ids, include_languages=False, shared_only=False):
         '''
-        Default implementation will iterate across the book ids to consider
-        and call find_candidate. Return a dictionary of candidates.
+        Default implementation will compute the candidate keys for all the book
+        ids to consider using find_candidate_keys. Return a dictionary of candidates.
+        If shared_only, an algorithm may leave out the keys of a single book
+        rather than returning them all to be shrunk from the map afterwards.
         '''
-        candidates_map = defaultdict(set)
-        for book_id in book_ids:
-            self.find_candidate(book_id, candidates_map, include_languages)
+        book_ids = list(book_ids)
+        candidate_keys = self.iter_with_progress(self.find_candidate_keys(book_ids, include_languages),
+                            _('Analysing {0} books for duplicates').format(len(book_ids)), len(book_ids))
+        key_book_pairs = ((key, book_id) for book_id, keys in candidate_keys for key in keys)
+        if shared_only and self.use_numpy and is_numpy_available():
+            candidates_map, key_count = group_shared_candidates(key_book_pairs)
+        else:
+            candidates_map, key_count = group_candidates(key_book_pairs, shared_only)
+        self.stats.set_count(COUNTER_UNIQUE_KEYS, key_count)
         return candidates_map
 
     def find_candidate(self, book_id, candidates_map, include_languages=False):
@@ -93,12 +174,49 @@ class AlgorithmBase(object):
         '''
         pass
 
+    def find_candidate_keys(self, book_ids, include_languages=False):
+        '''
+        Generator returning a tuple of (book_id, candidate keys) for each of
+        the book ids. Default implementation calls find_candidate for each
+        book, derived classes can override to compute the keys in bulk.
+        '''
+        for book_id in book_ids:
+            book_candidates_map = defaultdict(set)
+            self.find_candidate(book_id, book_candidates_map, include_languages)
+            yield book_id, list(book_candidates_map.keys())
+
+    def find_match_keys(self, books_for_group, include_languages=False):
+        '''
+        Given an iterable of (group id, book ids), return a dictionary of each
+        group id to the candidate key that all of the books in that group share,
+        computing the keys of all their books in one pass. Groups clustered
+        from several candidate groups may have no shared key and are left out.
+        '''
+        books_for_group = list(books_for_group)
+        book_ids = set()
+        for _group_id, group_book_ids in books_for_group:
+            book_ids.update(group_book_ids)
+        keys_map = dict(self.find_candidate_keys(book_ids, include_languages))
+        match_keys = {}
+        for group_id, group_book_ids in books_for_group:
+            if not group_book_ids:
+                continue
+            shared_keys = set(keys_map.get(group_book_ids[0], ()))
+            for book_id in group_book_ids[1:]:
+                shared_keys.intersection_update(keys_map.get(book_id, ()))
+            # Use the first key of the first book for a consistent choice
+            for key in keys_map.get(group_book_ids[0], ()):
+                if key in shared_keys:
+                    match_keys[group_id] = key
+                    break
+        return match_keys
+
     def shrink_candidates_map(self, candidates_map):
         for key in list(candidates_map.keys()):
             if len(candidates_map[key]) < 2:
                 del candidates_map[key]
 
-    def convert_candidates_to_groups(self, candidates_map):
+    def convert_candidates_to_groups(self, candidates_map, cluster_groups=False):
         '''
         Given a dictionary keyed by some sort of common duplicate group
         key (like a fuzzy of title/author) remove all of the groups that
@@ -111,17 +229,24 @@ class AlgorithmBase(object):
         books_for_group_map = dict()
         groups_for_book_map = defaultdict(set)
         group_id = 0
-        # Convert our map of groups into a list of sets with any duplicate groups removed
-        candidates_list = self.clean_dup_groups(candidates_map)
-        for book_ids in candidates_list:
-            partition_groups = self.partition_using_exemptions(book_ids)
-            for partition_group in partition_groups:
-                if len(partition_group) > 1:
-                    group_id += 1
-                    partition_book_ids = self.get_book_ids_for_candidate_group(partition_group)
-                    books_for_group_map[group_id] = partition_book_ids
-                    for book_id in partition_book_ids:
-                        groups_for_book_map[book_id].add(group_id)
+        with self.stats.stage(STAGE_CLEANUP):
+            if cluster_groups:
+                # Convert our map of groups into a list of disjoint sets of all connected groups
+                candidates_list = self.cluster_dup_groups(candidates_map)
+            else:
+                # Convert our map of groups into a list of sets with any duplicate groups removed
+                candidates_list = self.clean_dup_groups(candidates_map)
+        self.stats.set_count(COUNTER_GROUPS_AFTER_CLEANUP, len(candidates_list))
+        with self.stats.stage(STAGE_PARTITION):
+            for book_ids in self.iter_with_progress(candidates_list, _('Grouping duplicates')):
+                partition_groups = self.partition_using_exemptions(book_ids)
+                for partition_group in partition_groups:
+                    if len(partition_group) > 1:
+                        group_id += 1
+                        partition_book_ids = self.get_book_ids_for_candidate_group(partition_group)
+                        books_for_group_map[group_id] = partition_book_ids
+                        for book_id in partition_book_ids:
+                            groups_for_book_map[book_id].add(group_id)
         return books_for_group_map, groups_for_book_map
 
     def clean_dup_groups(self, candidates_map):
@@ -129,16 +254,14 @@ class AlgorithmBase(object):
         Given a dictionary of sets, convert into a list of sets removing any sets
         that are subsets of other sets.
         '''
-        res = [set(d) for d in list(candidates_map.values())]
-        res.sort(key=lambda x: len(x))
-        candidates_list = []
-        for i,a in enumerate(res):
-            for b in res[i+1:]:
-                if a.issubset(b):
-                    break
-            else:
-                candidates_list.append(a)
-        return candidates_list
+        return remove_subset_groups(candidates_map.values())
+
+    def cluster_dup_groups(self, candidates_map):
+        '''
+        Given a dictionary of sets, convert into a list of disjoint sets where
+        any sets sharing a member have been merged together.
+        '''
+        return cluster_candidate_groups(candidates_map.values())
 
     def get_book_ids_for_candidate_group(self, candidate_group):
         '''
@@ -167,47 +290,83 @@ class AlgorithmBase(object):
         If we find items that should not appear together, then we will
         repartition into multiple groups. Returns a list where each item
         is a sublist containing the data items for that partitioned group.
+        Each data item is assigned a bit position so that the partitions and
+        the exemptions for each member can be manipulated as integer bitsets.
         '''
         data_items = sorted(data_items)
+        position_map = dict((item, idx) for idx, item in enumerate(data_items))
         # Initial condition -- the group contains 1 set of all elements
-        results = [set(data_items)]
+        results = [(1 << len(data_items)) - 1]
         partitioning_ids = [None]
         # Loop through the set of duplicates, checking to see if the entry is in a non-dup set
-        for one_dup in data_items:
-            if one_dup in self._exemptions_map:
-                ndm_entry = self._exemptions_map.merge_sets(one_dup)
-                # The entry is indeed in a non-dup set. We may need to partition
-                for i,res in enumerate(results):
-                    if one_dup in res:
-                        # This result group contains the item with a non-dup set. If the item
-                        # was the one that caused this result group to partition in the first place,
-                        # then we must not partition again or we will make subsets of the group
-                        # that split this partition off. Consider a group of (1,2,3,4) and
-                        # non-dups of [(1,2), (2,3)]. The first partition will give us (1,3,4)
-                        # and (2,3,4). Later when we discover (2,3), if we partition (2,3,4)
-                        # again, we will end up with (2,4) and (3,4), but (3,4) is a subset
-                        # of (1,3,4). All we need to do is remove 3 from the (2,3,4) partition.
-                        if one_dup == partitioning_ids[i]:
-                            results[i] = (res - ndm_entry) | set([one_dup])
-                            continue
-                        # Must partition. We already have one partition, the one in our hand.
-                        # Remove the dups from it, then create new partitions for each of the dups.
-                        results[i] = (res - ndm_entry) | set([one_dup])
-                        for nd in ndm_entry:
-                            # Only partition if the duplicate is larger than the one we are looking
-                            # at. This is necessary because the non-dup set map is complete,
-                            # map[2] == (2,3), and map[3] == (2,3). We know that when processing
-                            # the set for 3, we have already done the work for the element 2.
-                            if nd > one_dup and nd in res:
-                                results.append((res - ndm_entry - set([one_dup])) | set([nd]))
-                                partitioning_ids.append(nd)
+        for idx, one_dup in enumerate(data_items):
+            if one_dup not in self._exemptions_map:
+                continue
+            # The entry is indeed in a non-dup set. We may need to partition
+            ndm_mask = self._get_exemptions_mask(one_dup, position_map)
+            one_dup_bit = 1 << idx
+            # Only partition if the duplicate is larger than the one we are looking
+            # at. This is necessary because the non-dup set map is complete,
+            # map[2] == (2,3), and map[3] == (2,3). We know that when processing
+            # the set for 3, we have already done the work for the element 2.
+            larger_ndm_mask = (ndm_mask >> (idx + 1)) << (idx + 1)
+            # Any partitions appended below will not contain this item so need not be visited
+            for i in range(len(results)):
+                res = results[i]
+                if not res & one_dup_bit:
+                    continue
+                # This result group contains the item with a non-dup set. If the item
+                # was the one that caused this result group to partition in the first place,
+                # then we must not partition again or we will make subsets of the group
+                # that split this partition off. Consider a group of (1,2,3,4) and
+                # non-dups of [(1,2), (2,3)]. The first partition will give us (1,3,4)
+                # and (2,3,4). Later when we discover (2,3), if we partition (2,3,4)
+                # again, we will end up with (2,4) and (3,4), but (3,4) is a subset
+                # of (1,3,4). All we need to do is remove 3 from the (2,3,4) partition.
+                remaining = res & ~ndm_mask & ~one_dup_bit
+                results[i] = remaining | one_dup_bit
+                if one_dup == partitioning_ids[i]:
+                    continue
+                # Must partition. We already have one partition, the one in our hand.
+                # Remove the dups from it, then create new partitions for each of the dups.
+                nd_mask = larger_ndm_mask & res
+                while nd_mask:
+                    nd_bit = nd_mask & -nd_mask
+                    nd_mask ^= nd_bit
+                    results.append(remaining | nd_bit)
+                    partitioning_ids.append(data_items[nd_bit.bit_length() - 1])
         sr = []
         for r in results:
-            if len(r) > 1:
-                sr.append(sorted(list(r)))
+            if r & (r - 1):
+                # More than one bit set, so more than one member in this partition.
+                # Take the members of the set bits, lowest bit first.
+                members = []
+                while r:
+                    bit = r & -r
+                    r ^= bit
+                    members.append(data_items[bit.bit_length() - 1])
+                sr.append(members)
         sr.sort()
         return sr
 
+    def _get_exemptions_mask(self, member, position_map):
+        '''
+        Return a bitset of the positions of the data items that this member
+        is exempt from being a duplicate of.
+        '''
+        exemptions = self._exemptions_map.merge_sets(member)
+        mask = 0
+        if len(exemptions) < len(position_map):
+            for other in exemptions:
+                position = position_map.get(other)
+                if position is not None:
+                    mask |= 1 << position
+        else:
+            for other, position in position_map.items():
+                if other in exemptions:
+                    mask |= 1 << position
+        return mask
+
 
 class IdentifierAlgorithm(AlgorithmBase):
     '''
@@ -230,15 +389,27 @@ class IdentifierAlgorithm(AlgorithmBase):
         if identifier:
             candidates_map[identifier].add(book_id)
 
+    def find_candidate_keys(self, book_ids, include_languages=False):
+        '''
+        Override to fetch the identifiers for all the books in one call
+        '''
+        book_ids = list(book_ids)
+        with self.stats.stage(STAGE_FETCH):
+            identifiers_map = get_field_for_books(self.db, 'identifiers', book_ids, default_value={})
+        for book_id in book_ids:
+            identifier = (identifiers_map.get(book_id) or {}).get(self.identifier_type, '')
+            yield book_id, [identifier] if identifier else []
+
     def sort_candidate_groups(self, candidates_map, by_title=True):
         '''
         Responsible for returning an ordered dict of how to order the groups
         Override to just do a fuzzy title sort to give a better sort than by identifier
         '''
+        first_book_map = dict((key, next(iter(candidates_map[key]))) for key in candidates_map)
+        titles_map = get_field_for_books(self.db, 'title', list(first_book_map.values()), default_value='')
         title_map = {}
-        for key in list(candidates_map.keys()):
-            book_id = list(candidates_map[key])[0]
-            title_map[key] = similar_title_match(self.db.title(book_id, index_is_id=True))
+        for key, book_id in first_book_map.items():
+            title_map[key] = similar_title_match(titles_map.get(book_id) or '')
         if by_title:
             skeys = sorted(list(candidates_map.keys()), key=lambda identifier: title_map[identifier])
         else:
@@ -260,15 +431,16 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
         '''
         return self.db.data.search_getting_ids('formats:True', self.db.data.search_restriction)
 
-    def find_candidates(self, book_ids, include_languages=False):
+    def find_candidates(self, book_ids, include_languages=False, shared_only=False):
         '''
         Override the default implementation so we can do multiple passes as a more
         efficient approach to finding binary duplicates.
+        Only formats of a shared size are hashed, so all the keys are returned.
         '''
         # Our first pass will be to find all books that have an identical file size
         candidates_size_map = defaultdict(set)
         formats_count = 0
-        for book_id in book_ids:
+        for book_id in self.iter_with_progress(book_ids, _('Comparing the sizes of {0} books').format(len(book_ids))):
             formats_count += self._find_candidate_by_file_size(book_id, candidates_size_map)
 
         # Perform a quick pass through removing all groups with < 2 members
@@ -280,12 +452,34 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
         candidates_map = defaultdict(set)
         hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
         result_hash_map = {}
-        for size, size_group in list(candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                self._find_candidate_by_hash(book_id, fmt, mtime, size, candidates_map, hash_map, result_hash_map)
+        size_formats = [(size, book_id, fmt, mtime) for size, size_group in candidates_size_map.items()
+                        for book_id, fmt, mtime in size_group]
+        # Hashing a format can be slow, so report progress after every one
+        for size, book_id, fmt, mtime in self.iter_with_progress(size_formats,
+                                _('Comparing the contents of {0} formats').format(len(size_formats)), chunk_size=1):
+            self._find_candidate_by_hash(book_id, fmt, mtime, size, candidates_map, hash_map, result_hash_map)
         self.db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
         return candidates_map
 
+    def find_candidate_keys(self, book_ids, include_languages=False):
+        '''
+        Override to return the (hash, size) of each format of the books as
+        cached by the last binary compare, without reading any format files.
+        '''
+        book_ids = list(book_ids)
+        with self.stats.stage(STAGE_FETCH):
+            hash_map = self.db.new_api.get_custom_book_data('find_duplicates', book_ids, default={})
+            formats_map = get_field_for_books(self.db, 'formats', book_ids, default_value=())
+        for book_id in book_ids:
+            keys = []
+            book_hash_map = hash_map.get(book_id) or {}
+            for fmt in formats_map.get(book_id) or ():
+                book_data = book_hash_map.get(fmt, {})
+                sha, size = book_data.get('sha', None), book_data.get('size', None)
+                if sha and size:
+                    keys.append((sha, size))
+            yield book_id, keys
+
     def _find_candidate_by_file_size(self, book_id, candidates_map):
         formats = self.db.formats(book_id, index_is_id=True, verify_formats=False)
         count = 0
@@ -318,6 +512,8 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
                 return
         try:
             format_hash = self.db.format_hash(book_id, fmt)
+            self.stats.count(COUNTER_FORMATS_HASHED)
+            self.stats.count(COUNTER_HASH_BYTES, size)
             hash_key = (format_hash, size)
             candidates_map[hash_key].add(book_id)
             # Store our plugin book data for future repeat scanning
@@ -344,16 +540,52 @@ class TitleAuthorAlgorithm(AlgorithmBase):
         if include_languages:
             lang = self.db.languages(book_id, index_is_id=True)
         title_hash = self._title_eval(self.db.title(book_id, index_is_id=True), lang)
+        author_hashes = None
         if self._author_eval:
-            authors = authors_to_list(self.db, book_id)
-            if authors:
-                for author in authors:
-                    author_hash, rev_author_hash = self._author_eval(author)
-                    candidates_map[title_hash+author_hash].add(book_id)
-                    if rev_author_hash and rev_author_hash != author_hash:
-                        candidates_map[title_hash+rev_author_hash].add(book_id)
-                return
-        candidates_map[title_hash].add(book_id)
+            author_hashes = [self._author_eval(author) for author in authors_to_list(self.db, book_id)]
+        for key in title_author_keys(title_hash, author_hashes):
+            candidates_map[key].add(book_id)
+
+    def find_candidates(self, book_ids, include_languages=False, shared_only=False):
+        '''
+        Override to compute the candidates in several worker processes
+        when enabled and there are enough books to be worth the overhead.
+        '''
+        book_ids = list(book_ids)
+        if self.parallel_workers > 1 and len(book_ids) >= self.parallel_threshold:
+            self.report_progress(_('Reading {0} books').format(len(book_ids)))
+            result = find_title_author_candidates_in_parallel(
+                                self._get_book_rows(book_ids, include_languages), self._title_eval,
+                                self._author_eval, self.parallel_workers, self._progress, shared_only)
+            if result is not None:
+                candidates_map, key_count = result
+                self.stats.set_count(COUNTER_UNIQUE_KEYS, key_count)
+                return candidates_map
+        return AlgorithmBase.find_candidates(self, book_ids, include_languages, shared_only)
+
+    def find_candidate_keys(self, book_ids, include_languages=False):
+        '''
+        Override to fetch the title, authors and languages for all the books
+        with one call per field, rather than several calls per book.
+        '''
+        return title_author_candidate_keys(self._get_book_rows(book_ids, include_languages),
+                                           self._title_eval, self._author_eval, self.stats)
+
+    def _get_book_rows(self, book_ids, include_languages=False):
+        '''
+        Return a list of (book_id, title, authors, language) for each book
+        '''
+        book_ids = list(book_ids)
+        with self.stats.stage(STAGE_FETCH):
+            titles_map = get_field_for_books(self.db, 'title', book_ids, default_value='')
+            authors_map = {}
+            if self._author_eval:
+                authors_map = authors_for_books(self.db, book_ids)
+            languages_map = {}
+            if include_languages:
+                languages_map = languages_for_books(self.db, book_ids)
+        return [(book_id, titles_map.get(book_id) or '', authors_map.get(book_id), languages_map.get(book_id))
+                for book_id in book_ids]
 
 
 class AuthorOnlyAlgorithm(AlgorithmBase):
@@ -369,6 +601,29 @@ class AuthorOnlyAlgorithm(AlgorithmBase):
     def duplicate_search_mode(self):
         return DUPLICATE_SEARCH_FOR_AUTHOR
 
+    def find_candidates(self, book_ids, include_languages=False, shared_only=False):
+        '''
+        Override to read the authors of all the books with a single call and
+        invert them into the books of each author, so that each author is
+        evaluated once rather than once for every book they wrote.
+        There are far fewer authors than books, so all the keys are returned.
+        '''
+        candidates_map = defaultdict(set)
+        # Common authors appear on many books, so only evaluate each unique author once
+        with self.stats.stage(STAGE_FETCH):
+            author_books_map = books_for_authors(self.db, book_ids)
+        author_count = 0
+        author_items = self.iter_with_progress(list(author_books_map.items()),
+                                _('Analysing {0} authors for duplicates').format(len(author_books_map)))
+        for author, author_book_ids in author_items:
+            self.author_bookids_map[author].update(author_book_ids)
+            author_count += len(author_book_ids)
+            self.find_author_candidate(author, candidates_map)
+        if DEBUG:
+            prints('Evaluated %d unique authors for %d book authors (%.1f%%)'%(len(author_books_map),
+                            author_count, 100.0 * len(author_books_map) / max(author_count, 1)))
+        return candidates_map
+
     def find_candidate(self, book_id, candidates_map, include_languages=False):
         '''
         Override the base implementation because it differs in several ways:
@@ -405,6 +660,184 @@ class AuthorOnlyAlgorithm(AlgorithmBase):
         return sorted(list(book_ids))
 
 
+# --------------------------------------------------------------
+#           Cross Library Comparison Functions
+# --------------------------------------------------------------
+
+
+def find_duplicates_in_target(candidate_keys, target_candidates_map):
+    '''
+    Given an iterable of (book_id, candidate keys) for the books in one library
+    and the unshrunk candidates map of another library, probe the target map
+    once with the set of all keys rather than book by book.
+    Returns an OrderedDict (in the order of the candidate keys) of each book id
+    that has duplicates to the set of target book ids it duplicates.
+    '''
+    book_ids = []
+    source_candidates_map = defaultdict(list)
+    for book_id, keys in candidate_keys:
+        book_ids.append(book_id)
+        for key in keys:
+            source_candidates_map[key].append(book_id)
+
+    duplicates_map = defaultdict(set)
+    for key in set(source_candidates_map).intersection(target_candidates_map):
+        target_book_ids = target_candidates_map[key]
+        for book_id in source_candidates_map[key]:
+            duplicates_map[book_id] |= target_book_ids
+    return OrderedDict([(book_id, duplicates_map[book_id])
+                        for book_id in book_ids if book_id in duplicates_map])
+
+
+def find_author_duplicates_in_target(algorithm, db, book_ids, target_candidates_map):
+    '''
+    For an author only comparison, look at each author in the library of the
+    algorithm rather than each book, probing the unshrunk author candidates map
+    of another library.
+    Returns a tuple of a list of (author, [target authors]) for each author with
+    duplicates, and a list of the ids of the books by those authors.
+    '''
+    author_books_map = books_for_authors(db, book_ids)
+    authors = get_field_pairs(db, 'authors')
+    author_names = [a[1].replace('|',',') for a in authors]
+    author_matches = []
+    duplicate_book_ids = []
+    for author in algorithm.iter_with_progress(author_names,
+                            _('Analysing duplicates in current database')+'...'):
+        author_candidates_map = defaultdict(set)
+        algorithm.find_author_candidate(author, author_candidates_map)
+        for author_hash in author_candidates_map:
+            if author_hash in target_candidates_map:
+                # Find the books for this author
+                duplicate_book_ids.extend(author_books_map[author])
+                author_matches.append((author, sorted(list(target_candidates_map[author_hash]))))
+    return author_matches, duplicate_book_ids
+
+
+def find_binary_duplicates_in_target(algorithm, book_ids, target_algorithm, target_book_ids):
+    '''
+    For a binary comparison, find the formats of the books in the library of the
+    algorithm that are identical to formats of books in the target library.
+    We can't just run the algorithm against the target database because its
+    optimisations mean that we aren't given the "raw" candidates map for us
+    to include books from this database before shrinking/refining.
+    Returns a tuple of the local and target candidates maps of each (sha, size)
+    key to its book ids, where the local map only has keys found in the target,
+    and the local and target maps of book id to its format hash data.
+    '''
+    def shrink_map(source_map, other_map):
+        new_map = {}
+        for k,v in list(source_map.items()):
+            if k in other_map:
+                new_map[k] = v
+        return new_map
+
+    def find_candidates_by_hash(alg, candidates_size_map, stage):
+        # Compute the file hashes of the candidates, caching them in the database
+        db = alg.db
+        hash_map = db.get_all_custom_book_data('find_duplicates', default={})
+        result_hash_map = {}
+        candidates_map = defaultdict(set)
+        for size, size_group in list(candidates_size_map.items()):
+            alg.report_progress(stage)
+            for book_id, fmt, mtime in size_group:
+                alg._find_candidate_by_hash(book_id, fmt, mtime, size, candidates_map, hash_map, result_hash_map)
+        db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
+        return candidates_map, result_hash_map
+
+    # Find all books that have an identical file size in the target database
+    target_candidates_size_map = defaultdict(set)
+    for book_id in target_algorithm.iter_with_progress(target_book_ids,
+                            _('Comparing the sizes of books in target database')+'...'):
+        target_algorithm._find_candidate_by_file_size(book_id, target_candidates_size_map)
+    # Find all books that have an identical file size in the current database
+    local_candidates_size_map = defaultdict(set)
+    for book_id in algorithm.iter_with_progress(book_ids,
+                            _('Comparing the sizes of books in current database')+'...'):
+        algorithm._find_candidate_by_file_size(book_id, local_candidates_size_map)
+
+    # Now reduce our candidates size maps to only those which intersect
+    target_candidates_size_map = shrink_map(target_candidates_size_map, local_candidates_size_map)
+    local_candidates_size_map = shrink_map(local_candidates_size_map, target_candidates_size_map)
+
+    # Next compute file hashes for the target database candidates, and then
+    # the current database candidates (just to get the hashes)
+    target_candidates_map, target_result_hash_map = find_candidates_by_hash(target_algorithm,
+                target_candidates_size_map, _('Comparing the contents of formats in target database')+'...')
+    local_candidates_map, local_result_hash_map = find_candidates_by_hash(algorithm,
+                local_candidates_size_map, _('Comparing the contents of formats in current database')+'...')
+
+    # Now we have all the raw data we need. The local_candidates_map contains
+    # all the books that "might" have duplicates, but grouped together in case
+    # there are duplicates within the current library. Lets remove all the local
+    # candidates that definitely have no matches in the target library
+    local_candidates_map = shrink_map(local_candidates_map, target_candidates_map)
+    return local_candidates_map, target_candidates_map, local_result_hash_map, target_result_hash_map
+
+
+def get_format_for_hash(result_hash_map, book_id, hash_key):
+    '''
+    Return the format of this book that has the (sha, size) hash key
+    '''
+    for fmt, book_data in list(result_hash_map[book_id].items()):
+        if book_data['sha'] == hash_key[0] and book_data['size'] == hash_key[1]:
+            return fmt
+    return ''
+
+
+# --------------------------------------------------------------
+#           Binary Duplicate Format Functions
+# --------------------------------------------------------------
+
+
+def plan_binary_format_removals(db, books_for_group_map):
+    '''
+    Given the groups from a binary compare, work out which duplicate formats
+    can be removed. Within each group the formats on the oldest book record
+    are kept, and identical formats on the other books of the group are removed.
+    Returns a list of (book_id, fmt, size) tuples, using the sizes cached by the
+    binary compare so that no files need to be read.
+    '''
+    hash_map = db.get_all_custom_book_data('find_duplicates', default={})
+    book_ids = set()
+    for books_list in books_for_group_map.values():
+        book_ids.update(books_list)
+    timestamps_map = get_field_for_books(db, 'timestamp', book_ids)
+
+    plan = []
+    planned = set()
+    for books_list in books_for_group_map.values():
+        # Determine the oldest book format in this group
+        earliest_book_id = books_list[0]
+        for book_id in books_list[1:]:
+            if timestamps_map[book_id] < timestamps_map[earliest_book_id]:
+                earliest_book_id = book_id
+        other_book_ids = [book_id for book_id in books_list if book_id != earliest_book_id]
+
+        # Now iterate through the formats for this oldest book
+        for fmt, info in list(hash_map.get(earliest_book_id, {}).items()):
+            for other_book_id in other_book_ids:
+                other_info = hash_map.get(other_book_id, {}).get(fmt)
+                if other_info is None or (other_book_id, fmt) in planned:
+                    continue
+                if info['size'] == other_info['size'] and info['sha'] == other_info['sha']:
+                    planned.add((other_book_id, fmt))
+                    plan.append((other_book_id, fmt, other_info['size']))
+    return plan
+
+def remove_binary_format_duplicates(db, plan):
+    '''
+    Remove all of the formats in a plan from plan_binary_format_removals()
+    in a single database operation, with one notification for the affected books.
+    '''
+    formats_map = defaultdict(list)
+    for book_id, fmt, size in plan:
+        formats_map[book_id].append(fmt)
+    if formats_map:
+        db.new_api.remove_formats(formats_map)
+        db.notify('metadata', list(formats_map.keys()))
+
+
 # --------------------------------------------------------------
 #           Find Duplicates Book Algorithm Factory
 # --------------------------------------------------------------
@@ -0,0 +1,302 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+'''
+Run a duplicate search against a calibre library without the calibre user
+interface, for example to produce scheduled reports on a server. Run with:
+
+    calibre-debug -e cli.py -- [options] LIBRARY_PATH
+
+This module must never import Qt (or any plugin module which does) so that it
+starts quickly and works on hosts without a display.
+'''
+
+import argparse, csv, io, json, sys
+from datetime import datetime
+
+try:
+    from calibre.utils.iso8601 import local_tz
+except ImportError:
+    from calibre.utils.date import local_tz
+
+from calibre_plugins.find_duplicates.book_algorithms import (create_algorithm,
+                    find_duplicates_in_target, find_author_duplicates_in_target,
+                    find_binary_duplicates_in_target, DUPLICATE_SEARCH_FOR_AUTHOR,
+                    DEFAULT_PARALLEL_THRESHOLD)
+from calibre_plugins.find_duplicates.exemptions import ExemptionStore, ExemptionMap
+from calibre_plugins.find_duplicates.matching import (get_field_for_books, authors_for_books, books_for_authors,
+                    set_title_soundex_length, set_author_soundex_length, set_publisher_soundex_length,
+                    set_series_soundex_length, set_tags_soundex_length)
+from calibre_plugins.find_duplicates.variation_algorithms import VariationAlgorithm
+
+try:
+    load_translations()
+except NameError:
+    pass
+
+# These must match the keys in config.py, which cannot be imported without Qt
+PREFS_NAMESPACE = 'FindDuplicatesPlugin'
+KEY_BOOK_EXEMPTIONS = 'bookExemptions'
+KEY_AUTHOR_EXEMPTIONS = 'authorExemptions'
+
+MATCH_TYPES = ['identical', 'similar', 'soundex', 'fuzzy', 'ignore']
+VARIATION_ITEM_TYPES = ['authors', 'series', 'publisher', 'tags']
+VARIATION_SOUNDEX_SETTERS = {
+    'authors': set_author_soundex_length,
+    'series': set_series_soundex_length,
+    'publisher': set_publisher_soundex_length,
+    'tags': set_tags_soundex_length,
+}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='calibre-debug -e cli.py --',
+                description='Find duplicate books or metadata variations in a calibre library.')
+    parser.add_argument('library_path', help='The calibre library to search')
+    parser.add_argument('--search-type', choices=['titleauthor', 'identifier', 'binary'],
+                        default='titleauthor', help='The kind of duplicate search (default: %(default)s)')
+    parser.add_argument('--title-match', choices=MATCH_TYPES, default='identical',
+                        help='How to match titles for a titleauthor search (default: %(default)s)')
+    parser.add_argument('--author-match', choices=MATCH_TYPES, default='identical',
+                        help='How to match authors for a titleauthor search (default: %(default)s)')
+    parser.add_argument('--identifier-type', default='isbn',
+                        help='The identifier to match for an identifier search (default: %(default)s)')
+    parser.add_argument('--title-soundex-length', type=int, default=6)
+    parser.add_argument('--author-soundex-length', type=int, default=8)
+    parser.add_argument('--include-languages', action='store_true',
+                        help='Only match titles with the same languages')
+    parser.add_argument('--sort-groups-by-size', action='store_true',
+                        help='Order the groups by size rather than by title')
+    parser.add_argument('--cluster-groups', action='store_true',
+                        help='Merge overlapping groups into disjoint groups')
+    parser.add_argument('--ignore-exemptions', action='store_true',
+                        help='Include books and authors marked as not duplicates')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes to find title/author duplicates with (default: %(default)s)')
+    parser.add_argument('--parallel-threshold', type=int, default=DEFAULT_PARALLEL_THRESHOLD,
+                        help='Only use worker processes for at least this many books (default: %(default)s)')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Group the candidates using NumPy if it is available')
+    parser.add_argument('--compare-library', metavar='TARGET_LIBRARY_PATH',
+                        help='Find books that are duplicates of books in this other library instead')
+    parser.add_argument('--variations', choices=VARIATION_ITEM_TYPES,
+                        help='Find variations of this metadata instead of duplicate books')
+    parser.add_argument('--variation-match', choices=['similar', 'soundex', 'fuzzy'], default='similar',
+                        help='How to match variations (default: %(default)s)')
+    parser.add_argument('--variation-soundex-length', type=int)
+    parser.add_argument('--format', choices=['json', 'csv'], default='json',
+                        help='The format to write the results in (default: %(default)s)')
+    parser.add_argument('--output', metavar='PATH', help='The file to write to instead of stdout')
+    parser.add_argument('--quiet', action='store_true', help='Do not report progress on stderr')
+    return parser
+
+
+def open_library(library_path, read_only=False):
+    from calibre.library import db as DB
+    return DB(library_path, read_only=read_only)
+
+
+def create_progress(quiet):
+    '''
+    Returns a progress function which reports each new stage on stderr
+    '''
+    if quiet:
+        return None
+    last_stage = [None]
+    def progress(stage, done=0, total=0):
+        if stage != last_stage[0]:
+            last_stage[0] = stage
+            print(stage, file=sys.stderr)
+        return True
+    return progress
+
+
+def create_cli_algorithm(db, opts, progress, use_exemptions=True):
+    book_exemptions_map = author_exemptions_map = ExemptionMap()
+    if use_exemptions and not opts.ignore_exemptions:
+        book_exemptions_map = ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_BOOK_EXEMPTIONS).exemptions_map
+        author_exemptions_map = ExemptionStore(db.prefs, PREFS_NAMESPACE, KEY_AUTHOR_EXEMPTIONS).exemptions_map
+    algorithm, algorithm_text = create_algorithm(None, db, opts.search_type, opts.identifier_type,
+                        opts.title_match, opts.author_match, book_exemptions_map, author_exemptions_map)
+    algorithm.set_progress(progress)
+    algorithm.set_parallel(opts.workers, opts.parallel_threshold)
+    algorithm.set_use_numpy(opts.numpy)
+    return algorithm, algorithm_text
+
+
+def find_book_duplicates(db, opts, progress):
+    '''
+    Returns the description of the search, the map of each group id to its book ids
+    and the SearchStats of the search
+    '''
+    algorithm, algorithm_text = create_cli_algorithm(db, opts, progress)
+    books_for_group_map, _groups_for_book_map = algorithm.run_duplicate_check(
+                    not opts.sort_groups_by_size, opts.include_languages, opts.cluster_groups)
+    return algorithm_text, books_for_group_map, algorithm.stats
+
+
+def find_library_duplicates(db, target_db, opts, progress):
+    '''
+    Returns the description of the search and a list of (book ids, target book ids)
+    for each group of books in this library with duplicates in the target library.
+    As in the gui, book exemptions do not apply to a library comparison.
+    '''
+    algorithm, algorithm_text = create_cli_algorithm(db, opts, progress, use_exemptions=False)
+    target_algorithm, _text = create_cli_algorithm(target_db, opts, progress, use_exemptions=False)
+    book_ids = algorithm.get_book_ids_to_consider()
+    target_book_ids = target_algorithm.get_book_ids_to_consider()
+
+    if algorithm.duplicate_search_mode() == DUPLICATE_SEARCH_FOR_AUTHOR:
+        target_candidates_map = target_algorithm.find_candidates(target_book_ids, opts.include_languages)
+        author_books_map = books_for_authors(db, book_ids)
+        author_matches, _duplicate_book_ids = find_author_duplicates_in_target(algorithm, db,
+                                                        book_ids, target_candidates_map)
+        groups = []
+        for author, dup_authors in author_matches:
+            dup_book_ids = set()
+            for dup_author in dup_authors:
+                dup_book_ids |= target_algorithm.author_bookids_map[dup_author]
+            groups.append((sorted(author_books_map[author]), sorted(dup_book_ids)))
+
+    elif opts.search_type == 'binary':
+        local_candidates_map, target_candidates_map, _local_hashes, _target_hashes = \
+                find_binary_duplicates_in_target(algorithm, book_ids, target_algorithm, target_book_ids)
+        groups = [(sorted(local_book_ids), sorted(target_candidates_map[hash_key]))
+                  for hash_key, local_book_ids in local_candidates_map.items()]
+
+    else:
+        target_candidates_map = target_algorithm.find_candidates(target_book_ids, opts.include_languages)
+        candidate_keys = algorithm.find_candidate_keys(book_ids, opts.include_languages)
+        duplicates_map = find_duplicates_in_target(candidate_keys, target_candidates_map)
+        groups = [([book_id], sorted(dup_book_ids)) for book_id, dup_book_ids in duplicates_map.items()]
+    return algorithm_text, groups
+
+
+def find_variations(db, opts, progress):
+    '''
+    Returns the description of the search, the map of item id to its name and
+    book count, and the map of each item id to the ids of its variations.
+    '''
+    if opts.variation_soundex_length:
+        VARIATION_SOUNDEX_SETTERS[opts.variations](opts.variation_soundex_length)
+    algorithm = VariationAlgorithm(db)
+    algorithm.set_progress(progress)
+    item_map, count_map, variations_map = algorithm.run_variation_check(opts.variation_match, opts.variations)
+    items_map = dict((item_id, (item_map[item_id], count_map.get(item_id, 0))) for item_id in item_map)
+    return '{0} {1}'.format(opts.variation_match, opts.variations), items_map, variations_map
+
+
+def get_books_info(db, book_ids):
+    '''
+    Return a dictionary of book id to a (title, authors) tuple, fetched in bulk
+    '''
+    book_ids = list(book_ids)
+    titles_map = get_field_for_books(db, 'title', book_ids, default_value='')
+    authors_map = authors_for_books(db, book_ids)
+    return dict((book_id, (titles_map.get(book_id) or '', authors_map.get(book_id, [])))
+                for book_id in book_ids)
+
+
+def write_results(out, output_format, header, columns, rows):
+    '''
+    Write the rows either as csv or as json with the header dictionary,
+    in which case each row is a dictionary of these columns.
+    '''
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+    else:
+        data = dict(header)
+        data['results'] = [dict(zip(columns, row)) for row in rows]
+        json.dump(data, out, indent=4)
+        out.write('\n')
+
+
+def book_group_rows(db, books_for_group_map):
+    info_map = get_books_info(db, set().union(*books_for_group_map.values()))
+    for group_id, book_ids in books_for_group_map.items():
+        for book_id in book_ids:
+            title, authors = info_map[book_id]
+            yield group_id, book_id, title, ' & '.join(authors)
+
+
+def library_group_rows(db, target_db, groups):
+    info_map = get_books_info(db, set().union(*[book_ids for book_ids, _target in groups]))
+    target_info_map = get_books_info(target_db, set().union(*[target for _book_ids, target in groups]))
+    for group_id, (book_ids, target_book_ids) in enumerate(groups, start=1):
+        for library, ids, books_info_map in (('source', book_ids, info_map),
+                                             ('target', target_book_ids, target_info_map)):
+            for book_id in ids:
+                title, authors = books_info_map[book_id]
+                yield group_id, library, book_id, title, ' & '.join(authors)
+
+
+def variation_rows(items_map, variations_map):
+    for group_id, (item_id, variation_ids) in enumerate(variations_map.items(), start=1):
+        for variation_id in [item_id] + sorted(variation_ids):
+            name, count = items_map[variation_id]
+            yield group_id, variation_id, name, count
+
+
+def run_search(opts, progress):
+    '''
+    Run the search described by the options, returning the header of the results
+    and their column names and rows
+    '''
+    db = open_library(opts.library_path)
+    header = {
+        'library_uuid': db.library_id,
+        'library_path': db.library_path,
+        'timestamp': datetime.now().replace(tzinfo=local_tz).isoformat()
+    }
+    if opts.variations:
+        header['search'], items_map, variations_map = find_variations(db, opts, progress)
+        columns = ['group', 'item_id', 'name', 'books']
+        rows = list(variation_rows(items_map, variations_map))
+    elif opts.compare_library:
+        target_db = open_library(opts.compare_library, read_only=True)
+        header['search'], groups = find_library_duplicates(db, target_db, opts, progress)
+        header['target_library_path'] = target_db.library_path
+        columns = ['group', 'library', 'book_id', 'title', 'authors']
+        rows = list(library_group_rows(db, target_db, groups))
+    else:
+        header['search'], books_for_group_map, stats = find_book_duplicates(db, opts, progress)
+        header['stats'] = stats.as_dict()
+        columns = ['group', 'book_id', 'title', 'authors']
+        rows = list(book_group_rows(db, books_for_group_map))
+    return header, columns, rows
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == '--':
+        args = args[1:]
+    opts = create_parser().parse_args(args)
+    set_title_soundex_length(opts.title_soundex_length)
+    set_author_soundex_length(opts.author_soundex_length)
+    progress = create_progress(opts.quiet)
+
+    # The algorithms print their debug diagnostics to stdout, which must
+    # only contain the results
+    results_out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        header, columns, rows = run_search(opts, progress)
+    finally:
+        sys.stdout = results_out
+
+    if opts.output:
+        with io.open(opts.output, 'w', encoding='utf-8', newline='') as out:
+            write_results(out, opts.format, header, columns, rows)
+    else:
+        write_results(results_out, opts.format, header, columns, rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,20 +13,23 @@ from six import text_type as unicode
 try:
     from qt.core import (QDialog, QDialogButtonBox, QVBoxLayout, QHBoxLayout,
                         QListWidget, QProgressBar, QAbstractItemView, QTextEdit,
-                        QIcon, QApplication, Qt, QTextBrowser, QSize, QLabel)
+                        QIcon, QApplication, Qt, QTextBrowser, QSize, QLabel, QTimer)
 except ImportError:
     from PyQt5.Qt import (QDialog, QDialogButtonBox, QVBoxLayout, QHBoxLayout,
                         QListWidget, QProgressBar, QAbstractItemView, QTextEdit,
-                        QIcon, QApplication, Qt, QTextBrowser, QSize, QLabel)
+                        QIcon, QApplication, Qt, QTextBrowser, QSize, QLabel, QTimer)
 
 try:
     load_translations()
 except NameError:
     pass # load_translations()
 
+from calibre import prints
+from calibre.constants import DEBUG
 from calibre.gui2 import gprefs, info_dialog, Application
 from calibre.gui2.keyboard import ShortcutConfig
 from calibre_plugins.find_duplicates.common_icons import get_icon
+from calibre_plugins.find_duplicates.worker import BackgroundWorker, SearchCancelled
 
 
 # ----------------------------------------------
@@ -229,7 +232,7 @@ class PrefsViewerDialog(SizePersistedDialog):
 
 class ProgressBarDialog(QDialog):
     def __init__(self, parent=None, max_items=100, window_title='Progress Bar',
-                 label='Label goes here', on_top=False):
+                 label='Label goes here', on_top=False, show_cancel=False):
         if on_top:
             super(ProgressBarDialog, self).__init__(parent=parent, flags=Qt.WindowStaysOnTopHint)
         else:
@@ -248,6 +251,17 @@ class ProgressBarDialog(QDialog):
         self.progressBar.setValue(0)
         self.l.addWidget(self.progressBar)
 
+        self.is_cancelled = False
+        if show_cancel:
+            self.bb = QDialogButtonBox(QDialogButtonBox.Cancel)
+            self.bb.rejected.connect(self.reject)
+            self.l.addWidget(self.bb)
+
+    def reject(self):
+        # The caller is expected to check is_cancelled and close the dialog
+        self.is_cancelled = True
+        self.label.setText(_('Cancelling...'))
+
     def increment(self):
         self.progressBar.setValue(self.progressBar.value() + 1)
         self.refresh()
@@ -274,6 +288,48 @@ class ProgressBarDialog(QDialog):
         pass
 
 
+def run_with_progress(parent, window_title, fn):
+    '''
+    Run fn(progress) on a background thread while showing a ProgressBarDialog
+    with a cancel button, polling the worker for its progress from the gui thread.
+    Returns the result of fn, or raises SearchCancelled if the user cancelled it.
+    Any other error raised by fn is raised again here on the gui thread.
+    '''
+    worker = BackgroundWorker(fn)
+    d = ProgressBarDialog(parent, max_items=0, window_title=window_title,
+                          label=_('Starting...'), show_cancel=True)
+    d.setMinimumWidth(400)
+    timer = QTimer(d)
+
+    def poll():
+        if d.is_cancelled:
+            worker.cancel()
+        if not worker.is_alive():
+            timer.stop()
+            d.accept()
+            return
+        stage, done, total = worker.current_progress
+        if not d.is_cancelled and stage:
+            d.label.setText(stage)
+        d.progressBar.setMaximum(total)
+        d.progressBar.setValue(done)
+
+    timer.timeout.connect(poll)
+    timer.start(100)
+    worker.start()
+    d.exec_()
+    worker.join()
+    if worker.error is not None:
+        if DEBUG and worker.traceback:
+            # The error is raised again here, so log where it happened in the worker
+            prints('Error in background worker:')
+            prints(worker.traceback)
+        raise worker.error
+    if worker.is_cancelled:
+        raise SearchCancelled()
+    return worker.result
+
+
 class ViewLogDialog(QDialog):
 
     def __init__(self, title, html, parent=None):
@@ -4,15 +4,21 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
 import copy
+from multiprocessing import cpu_count
 
 try:
-    from qt.core import QWidget, QVBoxLayout, QPushButton
+    from qt.core import (QWidget, QVBoxLayout, QPushButton, QGroupBox, QGridLayout, QLabel, QSpinBox,
+                         QCheckBox)
 except ImportError:
-    from PyQt5.Qt import QWidget, QVBoxLayout, QPushButton
+    from PyQt5.Qt import (QWidget, QVBoxLayout, QPushButton, QGroupBox, QGridLayout, QLabel, QSpinBox,
+                          QCheckBox)
 
 from calibre.gui2 import dynamic, info_dialog
 from calibre.utils.config import JSONConfig
 from calibre_plugins.find_duplicates.common_dialogs import KeyboardConfigDialog, PrefsViewerDialog
+from calibre_plugins.find_duplicates.exemptions import ExemptionStore
+from calibre_plugins.find_duplicates.book_algorithms import DEFAULT_PARALLEL_THRESHOLD
+from calibre_plugins.find_duplicates.numpy_engine import is_numpy_available
 
 try:
     load_translations()
@@ -28,7 +34,7 @@ KEY_BOOK_EXEMPTIONS = 'bookExemptions'
 KEY_AUTHOR_EXEMPTIONS = 'authorExemptions'
 
 KEY_SCHEMA_VERSION = 'SchemaVersion'
-DEFAULT_SCHEMA_VERSION = 1.7
+DEFAULT_SCHEMA_VERSION = 1.8
 
 KEY_SEARCH_TYPE = 'searchType'
 KEY_IDENTIFIER_TYPE = 'identifierType'
@@ -45,14 +51,19 @@ KEY_TAGS_SOUNDEX = 'tagsSoundexLength'
 KEY_INCLUDE_LANGUAGES = 'includeLanguages'
 KEY_DISPLAY_LIBRARY_RESULTS = 'displayLibraryResults'
 KEY_AUTO_DELETE_BINARY_DUPS = 'autoDeleteBinaryDups'
+KEY_BINARY_DUPS_DRY_RUN = 'binaryDupsDryRun'
+KEY_CLUSTER_GROUPS = 'clusterGroups'
+KEY_PARALLEL_WORKERS = 'parallelWorkers'
+KEY_PARALLEL_THRESHOLD = 'parallelThreshold'
+KEY_USE_NUMPY = 'useNumpy'
+KEY_EXPORT_FORMAT = 'exportFormat'
+KEY_EXPORT_COLUMNS = 'exportColumns'
 
 KEY_SHOW_VARIATION_BOOKS = 'showVariationBooks'
 
 DEFAULT_LIBRARIES_VALUES = {}
 DEFAULT_LIBRARY_VALUES = {
                             KEY_LAST_LIBRARY_COMPARE: '',
-                            KEY_BOOK_EXEMPTIONS: [],
-                            KEY_AUTHOR_EXEMPTIONS: [],
                             KEY_SCHEMA_VERSION: DEFAULT_SCHEMA_VERSION
                          }
 
@@ -68,7 +79,15 @@ def migrate_library_config_if_required(db, library_config):
     library_config[KEY_SCHEMA_VERSION] = DEFAULT_SCHEMA_VERSION
 
     # Any migration code in future will exist in here.
-    #if schema_version < 1.x:
+    if schema_version < 1.8:
+        # Exemptions are no longer stored in the library settings but in their own
+        # store, so they can be updated without rewriting every exemption group.
+        # Exemptions from v1.0 or earlier were never migrated so just discard them.
+        library_config.pop('bookNotDuplicates', None)
+        library_config.pop('authorNotDuplicates', None)
+        for config_key in [KEY_BOOK_EXEMPTIONS, KEY_AUTHOR_EXEMPTIONS]:
+            exemptions_list = library_config.pop(config_key, [])
+            get_exemption_store(db, config_key).replace_all(exemptions_list)
 
     set_library_config(db, library_config)
 
@@ -99,36 +118,13 @@ def get_library_config(db):
 def set_library_config(db, library_config):
     db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS, library_config)
 
-def get_exemption_lists(db):
-    # When migrating from v1.0 or earlier to v1.1, exemptions have changed
-    # Too problematic to actually migrate the data, so just discard previous maps
-    library_config = get_library_config(db)
-    if 'bookNotDuplicates' in library_config:
-        del library_config['bookNotDuplicates']
-        set_exemption_list(db, KEY_BOOK_EXEMPTIONS, [])
-    if 'authorNotDuplicates' in library_config:
-        del library_config['authorNotDuplicates']
-        set_exemption_list(db, KEY_AUTHOR_EXEMPTIONS, [])
-
-    book_exemptions = library_config.get(KEY_BOOK_EXEMPTIONS, [])
-    is_changed = False
-    for idx in range(0, len(book_exemptions)):
-        old_list = book_exemptions[idx]
-        new_list = [book_id for book_id in old_list if db.data.has_id(book_id)]
-        if len(old_list) != len(new_list):
-            book_exemptions[idx] = new_list
-            is_changed = True
-    if is_changed:
-        book_exemptions = [l for l in book_exemptions if len(l) > 0]
-        set_exemption_list(db, KEY_BOOK_EXEMPTIONS, book_exemptions)
-
-    author_exemptions = library_config.get(KEY_AUTHOR_EXEMPTIONS, [])
-    return book_exemptions, author_exemptions
-
-def set_exemption_list(db, config_key, exemptions_list):
-    library_config = get_library_config(db)
-    library_config[config_key] = exemptions_list
-    set_library_config(db, library_config)
+def get_exemption_store(db, config_key):
+    return ExemptionStore(db.prefs, PREFS_NAMESPACE, config_key)
+
+def get_exemption_stores(db):
+    # Ensure any exemptions in the library settings have been migrated
+    get_library_config(db)
+    return get_exemption_store(db, KEY_BOOK_EXEMPTIONS), get_exemption_store(db, KEY_AUTHOR_EXEMPTIONS)
 
 class ConfigWidget(QWidget):
 
@@ -154,12 +150,49 @@ class ConfigWidget(QWidget):
                     'View data stored in the library database for this plugin'))
         view_prefs_button.clicked.connect(self.view_prefs)
         layout.addWidget(view_prefs_button)
+
+        performance_gb = QGroupBox(_('Performance'), self)
+        layout.addWidget(performance_gb)
+        performance_gl = QGridLayout()
+        performance_gb.setLayout(performance_gl)
+        workers_label = QLabel(_('&Worker processes:'), self)
+        self.workers_spin = QSpinBox(self)
+        self.workers_spin.setRange(1, max(cpu_count(), 1))
+        self.workers_spin.setToolTip(_('The number of processes to share finding title/author duplicates\n'
+                                       'between for large libraries. Use 1 to always search in a single process.'))
+        workers_label.setBuddy(self.workers_spin)
+        threshold_label = QLabel(_('Only for at &least:'), self)
+        self.threshold_spin = QSpinBox(self)
+        self.threshold_spin.setRange(1000, 10000000)
+        self.threshold_spin.setSingleStep(10000)
+        self.threshold_spin.setSuffix(' ' + _('books'))
+        self.threshold_spin.setToolTip(_('Starting the worker processes takes time, so searches of fewer\n'
+                                         'books than this will always use a single process.'))
+        threshold_label.setBuddy(self.threshold_spin)
+        performance_gl.addWidget(workers_label, 0, 0, 1, 1)
+        performance_gl.addWidget(self.workers_spin, 0, 1, 1, 1)
+        performance_gl.addWidget(threshold_label, 1, 0, 1, 1)
+        performance_gl.addWidget(self.threshold_spin, 1, 1, 1, 1)
+        self.workers_spin.setValue(plugin_prefs.get(KEY_PARALLEL_WORKERS, 1))
+        self.threshold_spin.setValue(plugin_prefs.get(KEY_PARALLEL_THRESHOLD, DEFAULT_PARALLEL_THRESHOLD))
+        self.use_numpy_checkbox = QCheckBox(_('Group candidates using &NumPy'), self)
+        if is_numpy_available():
+            self.use_numpy_checkbox.setToolTip(_('Group the duplicate candidates of very large libraries\n'
+                                                 'using NumPy, which is faster and uses less memory.'))
+        else:
+            self.use_numpy_checkbox.setEnabled(False)
+            self.use_numpy_checkbox.setToolTip(_('NumPy is not available in this calibre install.'))
+        performance_gl.addWidget(self.use_numpy_checkbox, 2, 0, 1, 2)
+        self.use_numpy_checkbox.setChecked(plugin_prefs.get(KEY_USE_NUMPY, False))
         layout.addStretch(1)
 
     def save_settings(self):
         # Delete the legacy keyboard setting options as no longer required
         if 'options' in plugin_prefs:
             del plugin_prefs['options']
+        plugin_prefs[KEY_PARALLEL_WORKERS] = self.workers_spin.value()
+        plugin_prefs[KEY_PARALLEL_THRESHOLD] = self.threshold_spin.value()
+        plugin_prefs[KEY_USE_NUMPY] = self.use_numpy_checkbox.isChecked()
 
     def reset_dialogs(self):
         for key in list(dynamic.keys()):
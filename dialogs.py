@@ -24,9 +24,9 @@ except ImportError:
 
 from calibre import patheq
 from calibre.ebooks.metadata import authors_to_string, fmt_sidx
-from calibre.gui2 import info_dialog, choose_dir, error_dialog, choose_save_file
+from calibre.gui2 import info_dialog, choose_dir, error_dialog, choose_save_file, dynamic
 from calibre.gui2.complete2 import EditWithComplete
-from calibre.gui2.dialogs.confirm_delete import confirm
+from calibre.gui2.dialogs.confirm_delete import confirm, confirm_config_name
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.utils.date import format_date
 from calibre.utils.titlecase import titlecase
@@ -34,12 +34,15 @@ from calibre.gui2.widgets import HistoryLineEdit
 
 import calibre_plugins.find_duplicates.config as cfg
 from calibre_plugins.find_duplicates.common_icons import get_icon
-from calibre_plugins.find_duplicates.common_dialogs import SizePersistedDialog
+from calibre_plugins.find_duplicates.common_dialogs import SizePersistedDialog, run_with_progress
 from calibre_plugins.find_duplicates.common_widgets import (ImageTitleLayout, ReadOnlyTableWidgetItem,
                                         CheckableTableWidgetItem)
+from calibre_plugins.find_duplicates.export import (EXPORT_FORMATS, EXPORT_FORMAT_JSON,
+                                        EXPORT_COLUMNS, COLUMN_MATCH_KEY)
 from calibre_plugins.find_duplicates.matching import (set_author_soundex_length,
                     set_publisher_soundex_length, set_series_soundex_length, set_tags_soundex_length)
 from calibre_plugins.find_duplicates.variation_algorithms import VariationAlgorithm
+from calibre_plugins.find_duplicates.worker import SearchCancelled
 
 try:
     load_translations()
@@ -276,6 +279,20 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
                 'Note that the book records themselves are not deleted, and will still appear in the\n'
                 'results for merging even if they now have no formats.'))
         display_group_box_layout.addWidget(self.auto_delete_binary_dups_checkbox, 4, 0, 1, 2)
+        self.binary_dups_dry_run_checkbox = QCheckBox(_('Only report the duplicate formats that would be removed'))
+        self.binary_dups_dry_run_checkbox.setToolTip(
+              _('When checked, automatically removing duplicate formats will instead display the\n'
+                'formats that would be removed and the disk space that would be reclaimed,\n'
+                'without removing anything.'))
+        display_group_box_layout.addWidget(self.binary_dups_dry_run_checkbox, 5, 0, 1, 2)
+        self.auto_delete_binary_dups_checkbox.toggled.connect(self.binary_dups_dry_run_checkbox.setEnabled)
+        self.cluster_groups_checkbox = QCheckBox(_('Merge overlapping groups into a single group'))
+        self.cluster_groups_checkbox.setToolTip(
+              _('When checked, any duplicate groups that share a book are merged together so that\n'
+                'each book appears in only one group. For instance a book matched by both the\n'
+                'forward and reversed author name will no longer appear in two groups.\n'
+                'Duplicate exemptions are still applied to the merged groups.'))
+        display_group_box_layout.addWidget(self.cluster_groups_checkbox, 6, 0, 1, 2)
 
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box.accepted.connect(self._ok_clicked)
@@ -312,6 +329,11 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
         self.include_languages_checkbox.setChecked(include_languages)
         auto_delete_binary_dups = cfg.plugin_prefs.get(cfg.KEY_AUTO_DELETE_BINARY_DUPS, False)
         self.auto_delete_binary_dups_checkbox.setChecked(auto_delete_binary_dups)
+        binary_dups_dry_run = cfg.plugin_prefs.get(cfg.KEY_BINARY_DUPS_DRY_RUN, False)
+        self.binary_dups_dry_run_checkbox.setChecked(binary_dups_dry_run)
+        self.binary_dups_dry_run_checkbox.setEnabled(auto_delete_binary_dups)
+        cluster_groups = cfg.plugin_prefs.get(cfg.KEY_CLUSTER_GROUPS, False)
+        self.cluster_groups_checkbox.setChecked(cluster_groups)
 
         # Cause our dialog size to be restored from prefs or created on first usage
         self.resize_dialog()
@@ -383,6 +405,8 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
         cfg.plugin_prefs[cfg.KEY_AUTHOR_SOUNDEX] = int(str(self.author_soundex_spin.value()))
         cfg.plugin_prefs[cfg.KEY_INCLUDE_LANGUAGES] = self.include_languages_checkbox.isChecked()
         cfg.plugin_prefs[cfg.KEY_AUTO_DELETE_BINARY_DUPS] = self.auto_delete_binary_dups_checkbox.isChecked()
+        cfg.plugin_prefs[cfg.KEY_BINARY_DUPS_DRY_RUN] = self.binary_dups_dry_run_checkbox.isChecked()
+        cfg.plugin_prefs[cfg.KEY_CLUSTER_GROUPS] = self.cluster_groups_checkbox.isChecked()
         self.accept()
 
     def _is_valid_to_continue(self):
@@ -774,10 +798,17 @@ class FindVariationsDialog(SizePersistedDialog):
         elif self.opt_fuzzy.isChecked():
             match_type = 'fuzzy'
 
+        def run_search(progress):
+            self.alg.set_progress(progress)
+            return self.alg.run_variation_check(match_type, item_type)
+        try:
+            results = run_with_progress(self, _('Finding variations'), run_search)
+        except SearchCancelled:
+            return
+        self.item_map, self.count_map, self.variations_map = results
+
         QApplication.setOverrideCursor(Qt.WaitCursor)
         try:
-            self.item_map, self.count_map, self.variations_map = \
-                self.alg.run_variation_check(match_type, item_type)
             combo_item_texts = []
             for item_id in self.item_map.keys():
                 if item_id in self.count_map:
@@ -1286,15 +1317,83 @@ class FindLibraryDuplicatesDialog(SizePersistedDialog):
         self.accept()
 
 
+class ExportDuplicatesDialog(SizePersistedDialog):
+    '''
+    Dialog to choose the format and columns to export the duplicate groups with
+    '''
+    def __init__(self, parent):
+        SizePersistedDialog.__init__(self, parent, 'find_duplicates_plugin:export_duplicates_dialog')
+        self.setWindowTitle(_('Export Duplicates'))
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+        title_layout = ImageTitleLayout(self, 'images/find_duplicates.png', _('Export Options'))
+        layout.addLayout(title_layout)
+
+        format_layout = QHBoxLayout()
+        layout.addLayout(format_layout)
+        format_label = QLabel(_('Format:'), self)
+        format_layout.addWidget(format_label)
+        self.format_combo = QComboBox(self)
+        for export_format, text in EXPORT_FORMATS.items():
+            self.format_combo.addItem(text, export_format)
+        self.format_combo.setToolTip(_('JSON Lines writes each group on a separate line and CSV writes\n'
+                                       'each book on a separate row, for use by other programs.\n'
+                                       'JSON writes a single document as in earlier versions.'))
+        format_layout.addWidget(self.format_combo, 1)
+        export_formats = list(EXPORT_FORMATS.keys())
+        export_format = cfg.plugin_prefs.get(cfg.KEY_EXPORT_FORMAT, EXPORT_FORMAT_JSON)
+        if export_format in export_formats:
+            self.format_combo.setCurrentIndex(export_formats.index(export_format))
+
+        columns_group_box = QGroupBox(_('Columns:'), self)
+        layout.addWidget(columns_group_box)
+        columns_layout = QVBoxLayout()
+        columns_group_box.setLayout(columns_layout)
+        columns = cfg.plugin_prefs.get(cfg.KEY_EXPORT_COLUMNS, [])
+        self.column_checkboxes = OrderedDict()
+        for column, text in EXPORT_COLUMNS.items():
+            checkbox = QCheckBox(text, self)
+            checkbox.setChecked(column in columns)
+            columns_layout.addWidget(checkbox)
+            self.column_checkboxes[column] = checkbox
+        self.column_checkboxes[COLUMN_MATCH_KEY].setToolTip(
+                _('The key the books of each group were matched on by the search'))
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self._ok_clicked)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def _ok_clicked(self):
+        self.export_format = str(self.format_combo.itemData(self.format_combo.currentIndex()))
+        self.columns = [column for column, checkbox in self.column_checkboxes.items() if checkbox.isChecked()]
+        cfg.plugin_prefs[cfg.KEY_EXPORT_FORMAT] = self.export_format
+        cfg.plugin_prefs[cfg.KEY_EXPORT_COLUMNS] = self.columns
+        self.accept()
+
+
 class SummaryMessageBox(MessageBox):
     def __init__(self, parent, title, msg, det_msg='', q_icon=None,
-                 show_copy_button=True, default_yes=True):
+                 show_copy_button=True, default_yes=True, confirm_name=None):
         MessageBox.__init__(self, MessageBox.INFO, title, msg, det_msg, q_icon,
                             show_copy_button, parent, default_yes)
         if det_msg:
             b = self.bb.addButton(_('Save log')+'...', self.bb.AcceptRole)
             b.setIcon(QIcon(I('save.png')))
             b.clicked.connect(self._save_log)
+        # Like calibre's confirm dialogs, optionally let the user stop this being shown
+        self.confirm_name = confirm_name
+        if confirm_name:
+            self.show_again_checkbox = QCheckBox(_('Show this information again'), self)
+            self.show_again_checkbox.setChecked(True)
+            self.layout().addWidget(self.show_again_checkbox)
+            self.finished.connect(self._save_show_again)
+
+    def _save_show_again(self):
+        dynamic[confirm_config_name(self.confirm_name)] = self.show_again_checkbox.isChecked()
 
     def _save_log(self):
         txt = str(self.det_msg.toPlainText())
@@ -1304,3 +1403,14 @@ class SummaryMessageBox(MessageBox):
         if filename:
             with codecs.open(filename, 'w', 'utf-8') as f:
                 f.write(txt)
+
+
+def show_summary(parent, title, msg, det_msg='', confirm_name=None):
+    '''
+    Show a summary message with optional details. If given a confirm name the
+    user can choose not to be shown it again, as for calibre's confirm dialogs.
+    '''
+    if confirm_name and not dynamic.get(confirm_config_name(confirm_name), True):
+        return
+    d = SummaryMessageBox(parent, title, msg, det_msg=det_msg, confirm_name=confirm_name)
+    d.exec_()
@@ -4,26 +4,41 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 __copyright__ = '2021, Caleb Rogers'
 
-from collections import defaultdict, deque, OrderedDict
+from collections import defaultdict, OrderedDict
+from functools import partial
+from threading import Lock
 
 try:
     from qt.core import QApplication, Qt
 except ImportError:
     from PyQt5.Qt import QApplication, Qt
 
-from calibre import prints
+from calibre import prints, human_readable
 from calibre.constants import DEBUG
 from calibre.gui2 import config, info_dialog, error_dialog
 from calibre.gui2.dialogs.confirm_delete import confirm
 from calibre.utils.logging import GUILog
 from calibre.utils.config import tweaks
 from calibre.devices.usbms.driver import debug_print
+try:
+    from calibre.db.listeners import EventType
+except ImportError:
+    EventType = None
 
 import calibre_plugins.find_duplicates.config as cfg
 from calibre_plugins.find_duplicates.book_algorithms import (create_algorithm,
-                    DUPLICATE_SEARCH_FOR_BOOK, DUPLICATE_SEARCH_FOR_AUTHOR)
-from calibre_plugins.find_duplicates.dialogs import SummaryMessageBox
-from calibre_plugins.find_duplicates.matching import (authors_to_list, get_field_pairs,
+                    find_duplicates_in_target, find_author_duplicates_in_target,
+                    find_binary_duplicates_in_target, get_format_for_hash, plan_binary_format_removals, remove_binary_format_duplicates,
+                    DUPLICATE_SEARCH_FOR_BOOK, DUPLICATE_SEARCH_FOR_AUTHOR, DEFAULT_PARALLEL_THRESHOLD)
+from calibre_plugins.find_duplicates.common_dialogs import ProgressBarDialog, run_with_progress
+from calibre_plugins.find_duplicates.dialogs import SummaryMessageBox, show_summary
+from calibre_plugins.find_duplicates.export import export_results
+from calibre_plugins.find_duplicates.merging import plan_group_merges, merge_groups
+from calibre_plugins.find_duplicates.worker import SearchCancelled, report_progress
+from calibre_plugins.find_duplicates.results import GroupNavigator, DuplicateResults
+from calibre_plugins.find_duplicates.stats import STAGE_IDS, STAGE_MARK, STAGE_DISPLAY
+from calibre_plugins.find_duplicates.matching import (authors_to_list,
+                            get_field_for_books, authors_for_books, books_for_authors,
                             set_title_soundex_length, set_author_soundex_length)
 
 
@@ -33,30 +48,11 @@ except NameError:
     pass
 
 
-class ExemptionMap(defaultdict):
-    '''
-    Exemptions are stored as a list of lists (each inner list represents an exemption group)
-    This wrapper class provides dictionary type access to that structure without the
-    original cartesian based approach of storing each id with every other id.
-    '''
-    def __init__(self, exemptions_list):
-        defaultdict.__init__(self, list)
-        # Convert list of lists into a dictionary of lists for each member
-        # So for a given member
-        for group_list in exemptions_list:
-            group_set = set(group_list)
-            for member in group_list:
-                self[member].append(group_set)
-        # Retain our original list or lists for persistence purposes
-        self.exemptions_list = exemptions_list
-
-    def merge_sets(self, key):
-        list_of_sets = self.get(key, [])
-        if len(list_of_sets) == 0:
-            return set()
-        if len(list_of_sets) == 1:
-            return list_of_sets[0] - set([key])
-        return set().union(*list_of_sets) - set([key])
+def set_performance_options(algorithm):
+    algorithm.set_parallel(cfg.plugin_prefs.get(cfg.KEY_PARALLEL_WORKERS, 1),
+                           cfg.plugin_prefs.get(cfg.KEY_PARALLEL_THRESHOLD, DEFAULT_PARALLEL_THRESHOLD))
+    algorithm.set_use_numpy(cfg.plugin_prefs.get(cfg.KEY_USE_NUMPY, False))
+
 
 class FinderBase(object):
 
@@ -135,12 +131,18 @@ class DuplicateFinder(FinderBase):
 
     def __init__(self, gui):
         super(DuplicateFinder, self).__init__(gui)
-        book_exemptions, author_exemptions = cfg.get_exemption_lists(self.db)
-        self._book_exemptions_map = ExemptionMap(book_exemptions)
-        self._author_exemptions_map = ExemptionMap(author_exemptions)
+        # Exemptions are only loaded and pruned of deleted books once first needed
+        self._book_exemptions, self._author_exemptions = cfg.get_exemption_stores(self.db)
+        self._is_book_exemptions_validated = False
         self._is_showing_duplicate_exemptions = False
-        self._books_for_group_map = None
-        self._groups_for_book_map = None
+        self._results = None
+        # Deleted books and author changes are tracked from database events when available
+        self._db_listener = None
+        self._changes_lock = Lock()
+        self._pending_deleted_ids = set()
+        self._pending_changed_ids = set()
+        # The SearchStats of the last duplicate search run, if any
+        self.last_search_stats = None
         self.clear_duplicates_mode()
 
     def clear_duplicates_mode(self, clear_search=True, reapply_restriction=True):
@@ -156,14 +158,19 @@ class DuplicateFinder(FinderBase):
         self._is_showing_duplicate_exemptions = False
         self._is_show_all_duplicates_mode = False
         self._is_duplicate_exemptions_changed = False
-        self._books_for_group_map = None
-        self._groups_for_book_map = None
+        self._results = None
         self._authors_for_group_map = None
         self._is_group_changed = False
-        self._group_ids_queue = None
+        self._group_navigator = None
+        self._algorithm_options = None
         self._algorithm_text = None
+        self._include_languages = False
         self._duplicate_search_mode = None
         self._current_group_id = None
+        self._marked_ids = None
+        self._is_marked_for_authors = False
+        self._dirty_marked_ids = set()
+        self._stop_tracking_changes()
         self.clear_gui_duplicates_mode(clear_search, reapply_restriction, restore_sort)
 
     def run_book_duplicates_check(self):
@@ -187,50 +194,95 @@ class DuplicateFinder(FinderBase):
         include_languages = cfg.plugin_prefs.get(cfg.KEY_INCLUDE_LANGUAGES, False)
         self._is_show_all_duplicates_mode = cfg.plugin_prefs.get(cfg.KEY_SHOW_ALL_GROUPS, True)
         auto_delete_binary_dups = cfg.plugin_prefs.get(cfg.KEY_AUTO_DELETE_BINARY_DUPS, False)
+        binary_dups_dry_run = cfg.plugin_prefs.get(cfg.KEY_BINARY_DUPS_DRY_RUN, False)
+        cluster_groups = cfg.plugin_prefs.get(cfg.KEY_CLUSTER_GROUPS, False)
 
         algorithm, self._algorithm_text = create_algorithm(self.gui, self.db,
                         search_type, identifier_type, title_match, author_match,
-                        self._book_exemptions_map, self._author_exemptions_map)
+                        self._get_book_exemptions_map(), self._author_exemptions.exemptions_map)
         self._duplicate_search_mode = algorithm.duplicate_search_mode()
-
-
-        bfg_map, gfb_map = algorithm.run_duplicate_check(sort_groups_by_title, include_languages)
+        set_performance_options(algorithm)
+        # The book ids must be read from the library view on the gui thread
+        with algorithm.stats.stage(STAGE_IDS):
+            book_ids = algorithm.get_book_ids_to_consider()
+
+        def run_search(progress):
+            algorithm.set_progress(progress)
+            books_for_group_map, _groups_for_book_map = algorithm.run_duplicate_check(
+                        sort_groups_by_title, include_languages, cluster_groups, book_ids)
+            return DuplicateResults(books_for_group_map)
+        try:
+            results = run_with_progress(self.gui, _('Finding duplicates'), run_search)
+        except SearchCancelled:
+            self._duplicate_search_mode = None
+            self.gui.status_bar.showMessage(_('Duplicate search cancelled'), 3000)
+            return
 
         if search_type == 'binary' and auto_delete_binary_dups:
-            self._delete_binary_duplicate_formats(bfg_map)
+            self._delete_binary_duplicate_formats(results, binary_dups_dry_run)
 
-        self._display_run_duplicate_results(bfg_map, gfb_map)
+        self.last_search_stats = algorithm.stats
+        # Kept to compute the match keys of the groups when they are exported
+        self._algorithm_options = (search_type, identifier_type, title_match, author_match)
+        self._include_languages = include_languages
+        self._display_run_duplicate_results(results, algorithm.stats)
 
-    def _display_run_duplicate_results(self, books_for_group_map, groups_for_book_map):
+    def _display_run_duplicate_results(self, results, stats):
         '''
         Invoked after run_book_duplicates_check has completed
         '''
-        self._books_for_group_map = books_for_group_map
-        self._groups_for_book_map = groups_for_book_map
-        self._group_ids_queue = deque(sorted(self._books_for_group_map.keys()))
+        self._results = results
+        self._group_navigator = GroupNavigator(self._results.group_ids())
+        if self._group_navigator:
+            self._start_tracking_changes()
 
-        if len(self._group_ids_queue) == 0:
+        if len(self._group_navigator) == 0:
             self.gui.status_bar.showMessage('')
-            confirm('<p>' + _(
+            show_summary(self.gui, _('No duplicates'), '<p>' + _(
                     'No duplicate groups were found when searching with: <b>{0}</b>').format(self._algorithm_text),
-                    'find_duplicates_no_results', self.gui, title=_('No duplicates'),
-                    show_cancel_button=False, pixmap='dialog_information.png',
-                    confirm_msg=_('Show this information again'))
+                    det_msg='\n'.join(stats.format_lines()), confirm_name='find_duplicates_no_results')
         else:
-            self.show_next_result()
-            confirm('<p>' + _(
-                    'Found {0} duplicate groups when searching with: <b>{1}</b>').format(len(self._group_ids_queue), self._algorithm_text),
-                    'find_duplicates_count_results', self.gui, title=_('Find Duplicates'),
-                    show_cancel_button=False, pixmap='dialog_information.png',
-                    confirm_msg=_('Show this information again'))
+            with stats.stage(STAGE_MARK):
+                self._update_marked_books()
+            with stats.stage(STAGE_DISPLAY):
+                self.show_next_result()
+            show_summary(self.gui, _('Find Duplicates'), '<p>' + _(
+                    'Found {0} duplicate groups when searching with: <b>{1}</b>').format(len(self._group_navigator), self._algorithm_text),
+                    det_msg='\n'.join(stats.format_lines()), confirm_name='find_duplicates_count_results')
+
+    def export_results(self, out, export_format, columns, header, progress=None):
+        '''
+        Write the remaining duplicate groups to the text stream in the export format,
+        with the columns for each book. May be run on a background thread, so
+        _cleanup_deleted_books() must be called first.
+        '''
+        header = OrderedDict(header)
+        header['search'] = self._algorithm_text
+        export_results(out, export_format, self.db, self._results, header, columns,
+                       self._create_export_algorithm(), self._include_languages, progress)
+
+    def _create_export_algorithm(self):
+        '''
+        Returns a new algorithm of the last search to compute the match keys with,
+        so that the export does not add to the statistics of the search or change
+        any state that the search left in its algorithm. It is created without the
+        gui as it may be run on a background thread, and the match keys do not
+        depend on the exemptions.
+        '''
+        if self._algorithm_options is None:
+            return None
+        search_type, identifier_type, title_match, author_match = self._algorithm_options
+        algorithm, _algorithm_text = create_algorithm(None, self.db, search_type, identifier_type,
+                                                      title_match, author_match, None, None)
+        return algorithm
 
     def has_results(self):
         '''
         Returns whether there is any duplicate groups outstanding from
         the last search run in the current session.
         '''
-        if self._books_for_group_map:
-            return len(self._books_for_group_map) > 0
+        if self._results:
+            return len(self._results) > 0
         return False
 
     def is_searching_for_authors(self):
@@ -252,14 +304,14 @@ class DuplicateFinder(FinderBase):
         Returns whether we have any duplicate exemptions configured for
         any books.
         '''
-        return len(self._book_exemptions_map) > 0
+        return self._book_exemptions.has_exemptions()
 
     def has_author_exemptions(self):
         '''
         Returns whether we have any duplicate exemptions configured for
         any authors.
         '''
-        return len(self._author_exemptions_map) > 0
+        return self._author_exemptions.has_exemptions()
 
     def is_book_in_exemption(self, book_id):
         '''
@@ -267,11 +319,12 @@ class DuplicateFinder(FinderBase):
         pairings. Note that it is possible that the pairing is no longer
         valid due to the paired book having been deleted.
         '''
-        if book_id in self._book_exemptions_map:
+        if book_id in self._get_book_exemptions_map():
             return True
+        author_exemptions_map = self._author_exemptions.exemptions_map
         coauthors = authors_to_list(self.db, book_id)
         for author in coauthors:
-            if author in self._author_exemptions_map:
+            if author in author_exemptions_map:
                 return True
         return False
 
@@ -283,14 +336,16 @@ class DuplicateFinder(FinderBase):
          their authors exemptions as a set of values
         '''
         book_exemptions = set()
-        if book_id in self._book_exemptions_map:
-            book_exemptions = self._book_exemptions_map.merge_sets(book_id)
+        book_exemptions_map = self._get_book_exemptions_map()
+        if book_id in book_exemptions_map:
+            book_exemptions = book_exemptions_map.merge_sets(book_id)
 
         author_exemptions_map = OrderedDict()
+        all_author_exemptions_map = self._author_exemptions.exemptions_map
         coauthors = authors_to_list(self.db, book_id)
         for author in coauthors:
-            if author in self._author_exemptions_map:
-                author_exemptions = self._author_exemptions_map.merge_sets(author)
+            if author in all_author_exemptions_map:
+                author_exemptions = all_author_exemptions_map.merge_sets(author)
                 author_exemptions_map[author] = author_exemptions
         return book_exemptions, author_exemptions_map
 
@@ -306,7 +361,7 @@ class DuplicateFinder(FinderBase):
         Returns None if no current group
         '''
         if self._current_group_id is not None:
-            return self._books_for_group_map[self._current_group_id]
+            return self._results.books_for_group(self._current_group_id)
         return None
 
     def show_next_result(self, forward=True):
@@ -323,7 +378,7 @@ class DuplicateFinder(FinderBase):
         self._is_showing_duplicate_exemptions = False
         self._cleanup_deleted_books()
 
-        if len(self._books_for_group_map) == 0:
+        if len(self._results) == 0:
             self.clear_duplicates_mode()
             confirm('<p>' + _('No more duplicate groups exist from your search.'),
                     'find_duplicates_no_more_results', self.gui, title=_('No duplicates'),
@@ -352,12 +407,12 @@ class DuplicateFinder(FinderBase):
         # First make sure we cater for any merged/deleted book ids
         self._cleanup_deleted_books()
         if all_groups:
-            group_ids = list(self._books_for_group_map.keys())
+            group_ids = self._results.group_ids()
         else:
             if self._current_group_id is None:
                 # Should not happen due to validation elsewhere
                 return
-            if self._current_group_id not in self._books_for_group_map:
+            if self._current_group_id not in self._results:
                 # The user must have resolved all the merges for this group
                 error_dialog(self.gui, _('No duplicates'),
                             _('The current duplicate group no longer exists. '
@@ -400,55 +455,71 @@ class DuplicateFinder(FinderBase):
               duplicate searches that the authors_for_group_map is populated
         '''
         # Update our duplicates map
-        self._mark_group_ids_as_exemptions(list(self._books_for_group_map.keys()))
+        self._mark_group_ids_as_exemptions(self._results.group_ids())
         # There must be no more duplicate groups so clear the search mode
         self.clear_duplicates_mode()
 
     def _mark_group_ids_as_exemptions(self, group_ids):
         if self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_BOOK:
-            exemptions_list = self._book_exemptions_map.exemptions_list
             for group_id in group_ids:
-                book_ids = self._books_for_group_map.get(group_id, [])
+                book_ids = self._results.books_for_group(group_id) if group_id in self._results else []
                 if book_ids:
-                    exemptions_list.append(book_ids)
-            cfg.set_exemption_list(self.db, cfg.KEY_BOOK_EXEMPTIONS, exemptions_list)
-            # Rather than trying to keep the map up to date, just create a new one
-            self._book_exemptions_map = ExemptionMap(exemptions_list)
+                    self._book_exemptions.add_group(book_ids)
+                    self._dirty_marked_ids.update(book_ids)
 
         elif self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_AUTHOR:
-            exemptions_list = self._author_exemptions_map.exemptions_list
             for group_id in group_ids:
                 authors = self._authors_for_group_map.get(group_id, [])
                 if authors:
-                    exemptions_list.append(list(authors))
-            cfg.set_exemption_list(self.db, cfg.KEY_AUTHOR_EXEMPTIONS, exemptions_list)
-            # Rather than trying to keep the map up to date, just create a new one
-            self._author_exemptions_map = ExemptionMap(exemptions_list)
+                    self._author_exemptions.add_group(authors)
 
     def merge_all_groups(self):
         '''
         For all groups in a given duplicates view, merge entries.
-        Iterates through each group, merging each group into a single entries,
-        using the logic within Calibre's Edit Metadata merge_books method.
-        As of now, that means the first item in the group functions as the
-        "destination" to which all other book formats  are
-        applied / merged. Furthermore, that means afterwards, books that
-        are not the first in the group are deleted. The result is one
-        book containing all available formats.
+        The first book in each group is kept, any formats it is missing are
+        copied from the other books in the group, and those other books are
+        then deleted, the same as Edit Metadata merge_books with formats only.
+        The merging is done directly against the database in chunks rather than
+        through the library view one group at a time, with the view refreshed
+        once at the end. The user can cancel between chunks.
         '''
-        # Get the IDs of all duplicate book groups
-        group_ids = self._books_for_group_map.keys()
-        for group_id in group_ids:
-            # Get the IDs of each book in this duplicate book group
-            book_ids = self._books_for_group_map.get(group_id, [])
-            if book_ids:
-                # Select all books in this group. Necessary due to
-                # how Edit Metadata.merge_books functions.
-                self.gui.library_view.select_rows(book_ids)
-                # Invoke Calibre's native merge_books action, the same
-                # one invoked if a user selects multiple books and
-                # presses "g".
-                self.gui.iactions['Edit Metadata'].merge_books(merge_only_formats=True)
+        self._cleanup_deleted_books()
+        plan = plan_group_merges(self.db, self._results)
+        if not plan:
+            self.show_next_result()
+            return
+        merge_count = sum(len(merged_ids) for _keeper_id, merged_ids in plan)
+        if not confirm('<p>' + _(
+                'Merge all {0} duplicate groups? The first book in each group will be kept '
+                'with the formats of the other books added to it, and the other {1} books '
+                'will be <b>deleted</b>.').format(len(plan), merge_count),
+                'find_duplicates_merge_all_groups', self.gui, title=_('Merge all groups')):
+            return
+
+        d = ProgressBarDialog(self.gui, max_items=len(plan), window_title=_('Merging duplicates'),
+                              label=_('Merging duplicate groups...'), show_cancel=True)
+        d.show()
+
+        def progress(merged_count, total_count):
+            d.set_label(_('Merged {0} of {1} duplicate groups').format(merged_count, total_count))
+            d.set_value(merged_count)
+            return not d.is_cancelled
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            deleted_ids = merge_groups(self.db, plan, progress=progress)
+        finally:
+            QApplication.restoreOverrideCursor()
+            d.hide()
+        if DEBUG:
+            prints('Merged %d duplicate books'%len(deleted_ids))
+
+        # Record the deletions ourselves rather than waiting on the database
+        # events, then refresh the library view just the once.
+        self._record_changes(deleted_ids=deleted_ids)
+        self.gui.library_view.model().refresh()
+        self.gui.tags_view.recount()
+        self.show_next_result()
 
     def show_all_exemptions(self, for_books=True):
         '''
@@ -462,7 +533,7 @@ class DuplicateFinder(FinderBase):
         # Make sure we prune any deleted books from our book exemptions map
         marked = self.BOOK_EXEMPTION_MARK
         mark_author_exemptions = False
-        if for_books and self._book_exemptions_map:
+        if for_books and self._get_book_exemptions_map():
             self._remove_book_exemptions()
         elif not for_books:
             marked = self.AUTHOR_EXEMPTION_MARK
@@ -481,66 +552,35 @@ class DuplicateFinder(FinderBase):
         If from_book_id is not specified, all permutations of mappings between
         this set of books are removed.
         '''
-        exl = self._book_exemptions_map.exemptions_list
         if from_book_id:
             # We are removing mappings from this book to the other books
-            exl = self._remove_master_child_exemptions(exl, from_book_id, book_ids)
+            self._mark_exemption_books_dirty([from_book_id])
+            self._book_exemptions.remove_master_child(from_book_id, book_ids)
         else:
-            exl = self._remove_items_from_exemptions(exl, book_ids)
-
-        cfg.set_exemption_list(self.db, cfg.KEY_BOOK_EXEMPTIONS, exl)
-        # Rather than trying to keep the map up to date, just create a new one
-        self._book_exemptions_map = ExemptionMap(exl)
+            self._mark_exemption_books_dirty(book_ids)
+            self._book_exemptions.remove_items(book_ids)
         self._is_duplicate_exemptions_changed = True
         self._update_marked_books()
         self.gui.search.do_search()
 
+    def _get_book_exemptions_map(self):
+        if not self._is_book_exemptions_validated:
+            # Prune any deleted books the first time the exemptions are needed
+            self._is_book_exemptions_validated = True
+            self._remove_book_exemptions()
+        return self._book_exemptions.exemptions_map
+
     def _remove_book_exemptions(self, book_ids=None):
         if book_ids is None:
-            book_ids = []
-            for book_id in list(self._book_exemptions_map.keys()):
-                if self.db.data.has_id(book_id):
-                    continue
-                # Ensure it is removed from the exemptions map if present
-                book_ids.append(book_id)
+            # Ensure any deleted books are removed from the exemptions map
+            exemptions_map = self._book_exemptions.exemptions_map
+            book_ids = set(exemptions_map.keys()).difference(self.db.all_ids())
         if book_ids:
-            exl = self._book_exemptions_map.exemptions_list
-            exl = self._remove_items_from_exemptions(exl, book_ids)
-            cfg.set_exemption_list(self.db, cfg.KEY_BOOK_EXEMPTIONS, exl)
-            # Rather than trying to keep the map up to date, just create a new one
-            self._book_exemptions_map = ExemptionMap(exl)
+            self._mark_exemption_books_dirty(book_ids)
+            self._book_exemptions.remove_items(book_ids)
 
     def _remove_author_exemptions(self, authors):
-        exl = self._author_exemptions_map.exemptions_list
-        exl = self._remove_items_from_exemptions(exl, authors)
-        cfg.set_exemption_list(self.db, cfg.KEY_AUTHOR_EXEMPTIONS, exl)
-        # Rather than trying to keep the map up to date, just create a new one
-        self._author_exemptions_map = ExemptionMap(exl)
-
-    def _remove_master_child_exemptions(self, exemptions_list, master, to_remove_items):
-        # We are removing mappings from a master to one or more other items
-        new_exemptions_list = []
-        to_remove = set(to_remove_items)
-        for s in exemptions_list:
-            s = set(s)
-            n = s - to_remove
-            if len(n) > 1:
-                new_exemptions_list.append(list(n))
-            n = (s - set([master]))
-            if len(n) > 1:
-                new_exemptions_list.append(list(n))
-        return new_exemptions_list
-
-    def _remove_items_from_exemptions(self, exemptions_list, to_remove_items):
-        # We are removing mappings between each of the items.
-        # Do this by just removing the ids from all the exemption groups they are in
-        new_exemptions_list = []
-        to_remove = set(to_remove_items)
-        for s in exemptions_list:
-            n = set(s) - to_remove
-            if len(n) > 1:
-                new_exemptions_list.append(list(n))
-        return new_exemptions_list
+        self._author_exemptions.remove_items(authors)
 
     def remove_from_author_exemptions(self, book_ids=None, authors=None, from_author=None):
         '''
@@ -552,20 +592,16 @@ class DuplicateFinder(FinderBase):
         this set of author are removed.
         If book_ids are specified, we need to lookup the authors for those books first
         '''
-        exl = self._author_exemptions_map.exemptions_list
         if from_author:
             # We are removing mappings from this author to the other authors
-            exl = self._remove_master_child_exemptions(exl, from_author, authors)
+            self._author_exemptions.remove_master_child(from_author, authors)
         else:
             # We are removing all of the mappings for these authors
             # If only book ids given we need to convert the book ids into a unique set of authors
             if book_ids:
                 authors = self._get_authors_for_books(book_ids)
-            exl = self._remove_items_from_exemptions(exl, authors)
+            self._author_exemptions.remove_items(authors)
 
-        cfg.set_exemption_list(self.db, cfg.KEY_AUTHOR_EXEMPTIONS, exl)
-        # Rather than trying to keep the map up to date, just create a new one
-        self._author_exemptions_map = ExemptionMap(exl)
         self._is_duplicate_exemptions_changed = True
         self._update_marked_books(mark_author_exemptions=True)
         self.gui.search.do_search()
@@ -584,35 +620,55 @@ class DuplicateFinder(FinderBase):
 
         The only limitation is making sure that we don't overlap the sets by
         using the same substrings like 'duplicates' in the value of marked_text.
+
+        The marks are kept between calls, so that after the first time only the
+        books whose groups or exemptions have changed need to be marked again.
         '''
-        marked_ids = dict()
-        # Build our dictionary of current marked duplicate groups
-        if self._books_for_group_map:
-            remaining_group_ids = list(sorted(self._books_for_group_map.keys()))
-            for group_id in remaining_group_ids:
-                marked_text = '%s%04d' % (self.DUPLICATE_GROUP_MARK, group_id)
-                for book_id in self._books_for_group_map[group_id]:
-                    if book_id not in marked_ids:
-                        marked_ids[book_id] = marked_text
-                    else:
-                        marked_ids[book_id] = '%s,%s' % (marked_ids[book_id], marked_text)
-
-        # Now add the marks to indicate each book that is in a duplicate group
-        if self._groups_for_book_map:
-            for book_id in list(self._groups_for_book_map.keys()):
-                if book_id not in marked_ids:
-                    marked_ids[book_id] = self.DUPLICATES_MARK
+        book_exemptions_map = self._get_book_exemptions_map()
+        if mark_author_exemptions or self._marked_ids is None or self._is_marked_for_authors:
+            self._marked_ids = self._create_marked_ids(mark_author_exemptions, book_exemptions_map)
+            self._is_marked_for_authors = mark_author_exemptions
+            self._dirty_marked_ids = set()
+        else:
+            is_changed = False
+            for book_id in self._dirty_marked_ids:
+                marked_text = self._get_marked_text(book_id, book_exemptions_map)
+                if marked_text == self._marked_ids.get(book_id, ''):
+                    continue
+                is_changed = True
+                if marked_text:
+                    self._marked_ids[book_id] = marked_text
                 else:
-                    # We need to store two bits of text in the one value
-                    marked_ids[book_id] = '%s,%s' % (marked_ids[book_id], self.DUPLICATES_MARK)
+                    del self._marked_ids[book_id]
+            self._dirty_marked_ids = set()
+            if not is_changed:
+                return
+        # Assign the results to our database. calibre can only replace all of the
+        # marks with text values, so it still refreshes every marked book whenever
+        # any of them change. Only building the marks here is incremental.
+        self.gui.current_db.set_marked_ids(dict(self._marked_ids))
+
+    def _create_marked_ids(self, mark_author_exemptions, book_exemptions_map):
+        book_ids = set()
+        if self._results:
+            book_ids.update(self._results.book_ids())
+        if mark_author_exemptions:
+            book_exemptions_map = None
+        else:
+            # Add the marks for book duplicate exemptions
+            book_ids.update(book_exemptions_map.keys())
+        marked_ids = dict()
+        for book_id in book_ids:
+            marked_ids[book_id] = self._get_marked_text(book_id, book_exemptions_map)
 
         # Add the marks for author duplicate exemptions. This is an expensive operation so
         # we only do it when we really have to (i.e. user is showing author exemptions)
         if mark_author_exemptions:
-            if self._author_exemptions_map:
+            author_exemptions_map = self._author_exemptions.exemptions_map
+            if author_exemptions_map:
                 # Rebuild the map of authors to books
                 books_for_author_map = self._create_books_for_author_map()
-                for author in list(self._author_exemptions_map.keys()):
+                for author in list(author_exemptions_map.keys()):
                     if author in books_for_author_map:
                         for book_id in books_for_author_map[author]:
                             if book_id not in marked_ids:
@@ -621,35 +677,40 @@ class DuplicateFinder(FinderBase):
                                 # We need to store two bits of text in the one value
                                 marked_ids[book_id] = '%s,%s' % (marked_ids[book_id],
                                                                  self.AUTHOR_EXEMPTION_MARK)
-        else:
-            # Add the marks for book duplicate exemptions
-            if self._book_exemptions_map:
-                for book_id in list(self._book_exemptions_map.keys()):
-                    if book_id not in marked_ids:
-                        marked_ids[book_id] = self.BOOK_EXEMPTION_MARK
-                    else:
-                        # We need to store two bits of text in the one value
-                        marked_ids[book_id] = '%s,%s' % (marked_ids[book_id], self.BOOK_EXEMPTION_MARK)
-        # Assign the results to our database
-        self.gui.current_db.set_marked_ids(marked_ids)
+        return marked_ids
+
+    def _get_marked_text(self, book_id, book_exemptions_map):
+        '''
+        Returns the marks for this book, being each duplicate group it is in, whether
+        it is in any duplicate group and whether it is in any book exemptions.
+        '''
+        marks = []
+        if self._results and self._results.has_book(book_id):
+            for group_id in self._results.groups_for_book(book_id):
+                marks.append('%s%04d' % (self.DUPLICATE_GROUP_MARK, group_id))
+            marks.append(self.DUPLICATES_MARK)
+        if book_exemptions_map and book_id in book_exemptions_map:
+            marks.append(self.BOOK_EXEMPTION_MARK)
+        return ','.join(marks)
+
+    def _mark_exemption_books_dirty(self, book_ids):
+        # Any book sharing an exemption group with these books may lose its exemption mark
+        book_exemptions_map = self._book_exemptions.exemptions_map
+        for book_id in book_ids:
+            self._dirty_marked_ids.add(book_id)
+            self._dirty_marked_ids.update(book_exemptions_map.merge_sets(book_id))
 
     def _get_authors_for_books(self, book_ids):
         authors = set()
-        for book_id in book_ids:
-            coauthors = authors_to_list(self.db, book_id)
-            for author in coauthors:
-                authors.add(author)
+        for coauthors in authors_for_books(self.db, book_ids).values():
+            authors.update(coauthors)
         return authors
 
     def _create_books_for_author_map(self):
-        books_for_author_map = defaultdict(set)
-        for book_id in self.db.all_ids():
-            coauthors = authors_to_list(self.db, book_id)
-            for author in coauthors:
-                books_for_author_map[author].add(book_id)
+        books_for_author_map = books_for_authors(self.db)
         # Use this opportunity to purge any author exemptions that we do not have books for
         deleted_authors = []
-        for author in list(self._author_exemptions_map.keys()):
+        for author in list(self._author_exemptions.exemptions_map.keys()):
             if author in books_for_author_map:
                 continue
             deleted_authors.append(author)
@@ -657,20 +718,74 @@ class DuplicateFinder(FinderBase):
             self._remove_author_exemptions(deleted_authors)
         return books_for_author_map
 
+    def _start_tracking_changes(self):
+        self._stop_tracking_changes()
+        new_api = getattr(self.db, 'new_api', None)
+        if EventType is None or not hasattr(new_api, 'add_listener'):
+            # Older calibre, so every cleanup will have to scan all the results
+            return
+        self._db_listener = self._on_database_event
+        new_api.add_listener(self._db_listener)
+
+    def _stop_tracking_changes(self):
+        if self._db_listener is not None:
+            new_api = getattr(self.db, 'new_api', None)
+            if hasattr(new_api, 'remove_listener'):
+                new_api.remove_listener(self._db_listener)
+            self._db_listener = None
+        with self._changes_lock:
+            self._pending_deleted_ids = set()
+            self._pending_changed_ids = set()
+
+    def _on_database_event(self, db, event_type, event_data):
+        # Called by calibre on its event dispatcher thread, so just record the
+        # changes for the next cleanup to apply on the gui thread.
+        if event_type == EventType.books_removed:
+            self._record_changes(deleted_ids=event_data[0])
+        elif event_type == EventType.metadata_changed and event_data[0] == 'authors':
+            self._record_changes(changed_ids=event_data[1])
+
+    def _record_changes(self, deleted_ids=(), changed_ids=()):
+        with self._changes_lock:
+            self._pending_deleted_ids.update(deleted_ids)
+            self._pending_changed_ids.update(changed_ids)
+
+    def _get_pending_changes(self):
+        with self._changes_lock:
+            deleted_ids, self._pending_deleted_ids = self._pending_deleted_ids, set()
+            changed_ids, self._pending_changed_ids = self._pending_changed_ids, set()
+        return deleted_ids, changed_ids
+
     def _cleanup_deleted_books(self):
+        deleted_ids, changed_ids = self._get_pending_changes()
+        if self._db_listener is not None and self._authors_for_group_map is not None:
+            # We only need to look at the books changed since the last cleanup.
+            # Events are delivered asynchronously, so the current group is always
+            # checked in case the user has only just merged it.
+            if self._current_group_id in self._results:
+                deleted_ids.update(self._results.books_for_group(self._current_group_id))
+            deleted_ids = [book_id for book_id in sorted(deleted_ids)
+                           if self._results.has_book(book_id) and not self.db.data.has_id(book_id)]
+            group_ids = set()
+            for book_id in deleted_ids:
+                group_ids.update(self._results.groups_for_book(book_id))
+            if self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_AUTHOR:
+                for book_id in changed_ids:
+                    group_ids.update(self._results.groups_for_book(book_id))
+            group_ids = [group_id for group_id in sorted(group_ids)
+                         if group_id in self._results]
+        else:
+            deleted_ids = [book_id for book_id in self._results.book_ids()
+                           if not self.db.data.has_id(book_id)]
+            self._authors_for_group_map = defaultdict(set)
+            group_ids = self._results.group_ids()
+
         # First pass is to remove delete/merged books and their associated groups
-        book_ids = list(self._groups_for_book_map.keys())
-        deleted_ids = []
-        for book_id in sorted(book_ids):
-            if not self.db.data.has_id(book_id):
-                # We have a book that has been merged/deleted
-                # Remove the book from all of its groups.
-                for group_id in self._groups_for_book_map[book_id]:
-                    group = self._books_for_group_map[group_id]
-                    group.remove(book_id)
-                del self._groups_for_book_map[book_id]
-                # Ensure it is removed from the exemptions map if present
-                deleted_ids.append(book_id)
+        for book_id in deleted_ids:
+            # We have a book that has been merged/deleted
+            # Remove the book from all of its groups.
+            self._results.remove_book(book_id)
+            self._dirty_marked_ids.add(book_id)
 
         # Second action is to ensure deleted books are removed from exemptions map
         if deleted_ids:
@@ -679,50 +794,38 @@ class DuplicateFinder(FinderBase):
         # Third pass is through the groups to remove all groups...
         #   with < 2 members if we are viewing a book based duplicate search, or
         #   with < 2 authors if we are viewing and author based duplicate search
-        self._authors_for_group_map = defaultdict(set)
-        for group_id in list(self._books_for_group_map.keys()):
+        if self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_AUTHOR:
+            # Fetch the authors for all the books in these groups in one call
+            group_book_ids = set()
+            for group_id in group_ids:
+                group_book_ids.update(self._results.books_for_group(group_id))
+            authors_map = authors_for_books(self.db, group_book_ids)
+        for group_id in group_ids:
             if self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_BOOK:
-                count = len(self._books_for_group_map[group_id])
+                count = self._results.group_size(group_id)
             elif self._duplicate_search_mode == DUPLICATE_SEARCH_FOR_AUTHOR:
                 authors = set()
-                for book_id in self._books_for_group_map[group_id]:
-                    coauthors = authors_to_list(self.db, book_id)
-                    for author in coauthors:
-                        if author not in authors:
-                            authors.add(author)
-                            self._authors_for_group_map[group_id].add(author)
+                for book_id in self._results.books_for_group(group_id):
+                    authors.update(authors_map.get(book_id, ()))
+                self._authors_for_group_map[group_id] = authors
                 count = len(authors)
             if count > 1:
                 continue
-            if count == 1:
-                # There is one book left in this group, so the group can be deleted
-                # However we need to cleanup entries for the book too.
-                last_book_id = self._books_for_group_map[group_id][0]
-                self._groups_for_book_map[last_book_id].remove(group_id)
-            del self._books_for_group_map[group_id]
-            self._group_ids_queue.remove(group_id)
+            # There is one book (or author) left in this group, so the group can be deleted.
+            # Removing the group also drops the remaining books that are in no other group.
+            self._dirty_marked_ids.update(self._results.books_for_group(group_id))
+            self._results.remove_group(group_id)
+            self._group_navigator.remove(group_id)
             if group_id in self._authors_for_group_map:
                 del self._authors_for_group_map[group_id]
 
-        # Our final pass is looking for books that can be removed from the maps because
-        # they have no groups any more
-        for book_id in list(self._groups_for_book_map.keys()):
-            if len(self._groups_for_book_map[book_id]) == 0:
-                del self._groups_for_book_map[book_id]
-
         # Set our flag to know whether to force a refresh of our search restriction
         # when we move to the next group, since the name of the restriction will be
         # the same when the marked groups get renumbered
-        self._is_group_changed = self._current_group_id not in self._groups_for_book_map
+        self._is_group_changed = self._current_group_id not in self._results
 
     def _get_next_group_to_display(self, forward):
-        if forward:
-            next_group_id = self._group_ids_queue.popleft()
-            self._group_ids_queue.append(next_group_id)
-        else:
-            next_group_id = self._group_ids_queue.pop()
-            self._group_ids_queue.appendleft(next_group_id)
-        return next_group_id
+        return self._group_navigator.move(forward)
 
     def _refresh_duplicate_display_mode(self):
         self.gui.library_view.multisort((('marked', True), ('authors', True), ('title', True)),
@@ -741,9 +844,8 @@ class DuplicateFinder(FinderBase):
             # When displaying groups one at a time, we need to move selection
             self.gui.library_view.set_current_row(0)
 
-        remaining_group_ids = list(sorted(self._books_for_group_map.keys()))
-        position = remaining_group_ids.index(group_id) + 1
-        msg = _('Showing #{0} of {0} remaining duplicate groups for {0}').format(position, len(remaining_group_ids), self._algorithm_text)
+        position = self._group_navigator.position(group_id)
+        msg = _('Showing #{0} of {0} remaining duplicate groups for {0}').format(position, len(self._group_navigator), self._algorithm_text)
         self.gui.status_bar.showMessage(msg)
 
     def _refresh_exemption_display_mode(self, marked):
@@ -753,14 +855,14 @@ class DuplicateFinder(FinderBase):
         self.apply_restriction_if_different(restriction)
 
     def _remove_duplicate_group(self, group_id):
-        book_ids = self._books_for_group_map[group_id]
-        for book_id in book_ids:
-            self._groups_for_book_map[book_id].remove(group_id)
-        del self._books_for_group_map[group_id]
-        self._group_ids_queue.remove(group_id)
+        self._dirty_marked_ids.update(self._results.books_for_group(group_id))
+        self._results.remove_group(group_id)
+        self._group_navigator.remove(group_id)
+        if self._authors_for_group_map and group_id in self._authors_for_group_map:
+            del self._authors_for_group_map[group_id]
 
     def _view_authors_in_tag_viewer(self):
-        draw_boxes = self._is_show_all_duplicates_mode and len(self._books_for_group_map) > 1
+        draw_boxes = self._is_show_all_duplicates_mode and len(self._results) > 1
         if not self.gui.tags_view.pane_is_visible:
             self.gui.tb_splitter.show_side_pane()
             if draw_boxes:
@@ -769,7 +871,7 @@ class DuplicateFinder(FinderBase):
             self.gui.tags_view.model().clear_boxed()
 
         if draw_boxes:
-            book_ids = self._books_for_group_map[self._current_group_id]
+            book_ids = self._results.books_for_group(self._current_group_id)
             for book_id in book_ids:
                 coauthors = authors_to_list(self.db, book_id)
                 for author in coauthors:
@@ -785,33 +887,31 @@ class DuplicateFinder(FinderBase):
                 idx = self.gui.tags_view.model().index_for_path(p)
                 self.gui.tags_view.setExpanded(idx, True)
 
-    def _delete_binary_duplicate_formats(self, books_for_group_map):
+    def _delete_binary_duplicate_formats(self, books_for_group_map, dry_run=False):
+        plan = plan_binary_format_removals(self.db, books_for_group_map)
+        total_size = sum(size for _book_id, _fmt, size in plan)
         if DEBUG:
-            prints('Automatically removing binary format duplicates')
-        hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
-        for books_list in list(books_for_group_map.values()):
-            # Determine the oldest book format in this group
-            earliest_book_id = books_list[0]
-            earliest_date = self.db.timestamp(earliest_book_id, index_is_id=True)
-            for idx in list(range(1, len(books_list))):
-                book_date = self.db.timestamp(books_list[idx], index_is_id=True)
-                if book_date < earliest_date:
-                    earliest_book_id = books_list[idx]
-                    earliest_date = book_date
-            other_book_ids = [book_id for book_id in books_list if book_id != earliest_book_id]
-
-            book_map = hash_map[earliest_book_id]
-            # Now iterate through the formats for this oldest book
-            for fmt, info in list(book_map.items()):
-                for other_book_id in other_book_ids:
-                    other_book_map = hash_map[other_book_id]
-                    if fmt not in other_book_map:
-                        continue
-                    other_info = other_book_map[fmt]
-                    if info['size'] == other_info['size'] and info['sha'] == other_info['sha']:
-                        if DEBUG:
-                            prints('Removing duplicate format: %s from book: %d'%(fmt, other_book_id))
-                        self.db.remove_format(other_book_id, fmt, index_is_id=True, notify=False)
+            if dry_run:
+                prints('Planning removal of %d binary format duplicates to reclaim %s'%(
+                        len(plan), human_readable(total_size)))
+            else:
+                prints('Automatically removing %d binary format duplicates to reclaim %s'%(
+                        len(plan), human_readable(total_size)))
+            for book_id, fmt, size in plan:
+                if dry_run:
+                    prints('Would remove duplicate format: %s from book: %d'%(fmt, book_id))
+                else:
+                    prints('Removing duplicate format: %s from book: %d'%(fmt, book_id))
+        if dry_run:
+            titles_map = get_field_for_books(self.db, 'title', set(book_id for book_id, _fmt, _size in plan))
+            details = ['%s: %s (%s)'%(titles_map[book_id], fmt, human_readable(size))
+                       for book_id, fmt, size in plan]
+            info_dialog(self.gui, _('Duplicate formats'),
+                    _('{0} duplicate formats would be removed, reclaiming {1}.').format(
+                        len(plan), human_readable(total_size)),
+                    det_msg='\n'.join(details), show=True, show_copy_button=True)
+            return
+        remove_binary_format_duplicates(self.db, plan)
 
 
 class CrossLibraryDuplicateFinder(FinderBase):
@@ -841,12 +941,20 @@ class CrossLibraryDuplicateFinder(FinderBase):
         # only by calling specific functions to control what gets executed
         # since the approach for comparing all books in one library with another
         # significantly differs. Also of course book exemptions will not apply.
-
-        QApplication.setOverrideCursor(Qt.WaitCursor)
+        # The comparison runs in the background, with the results displayed
+        # back on the gui thread.
+        debug_print('Find Duplicates -> Library -> Start ({})'.format(self.search_type))
+        algorithm, self.algorithm_text = create_algorithm(self.gui, self.db,
+                        self.search_type, self.identifier_type,
+                        self.title_match, self.author_match, None, None)
+        book_ids = algorithm.get_book_ids_to_consider()
         try:
-            message = self._do_comparison()
-        finally:
-            QApplication.restoreOverrideCursor()
+            duplicates_count, duplicate_book_ids, message = run_with_progress(self.gui,
+                        _('Finding library duplicates'), partial(self._do_comparison, algorithm, book_ids))
+        except SearchCancelled:
+            self.gui.status_bar.showMessage(_('Duplicate search cancelled'), 3000)
+            return
+        message = self._display_comparison_results(duplicates_count, duplicate_book_ids, message)
         self.gui.status_bar.showMessage('Duplicate search completed', 3000)
         txt = self.log.plain_text
         if txt:
@@ -863,72 +971,72 @@ class CrossLibraryDuplicateFinder(FinderBase):
         marked_ids = {k:v for k,v in db.data.marked_ids.items() if v != 'library_duplicate'}
         db.set_marked_ids(marked_ids)
 
-    def _get_book_display_info(self, db, book_id, include_author=True, include_formats=True,
-                               include_identifier=False):
-        if hasattr(db, 'new_api'):
-            # Requires calibre 5.9 or later
-            mi = db.new_api.get_proxy_metadata(book_id)
-            text = mi.title
-            if include_author:
-                authors = ' & '.join(mi.authors)
-                text = '%s / %s'%(text, authors)
-            if include_formats:
-                formats = mi.formats
-                if formats is None:
-                    formats = '[No formats]'
-                text = '%s %s'%(text, formats)
-            if include_identifier:
-                identifiers = mi.identifiers
-                identifier = identifiers.get(self.identifier_type, '')
-                text = '%s {%s:%s}'%(text, self.identifier_type, identifier)
-            return text
-        else:
-            text = db.title(book_id, index_is_id=True)
+    def _get_books_display_info(self, db, book_ids, include_author=True, include_formats=True,
+                                include_identifier=False):
+        '''
+        Return a dictionary of book id to the display text for each book in the log.
+        Each field is fetched for all of the books with a single call, rather than
+        retrieving the metadata for each book individually.
+        '''
+        book_ids = list(book_ids)
+        titles_map = get_field_for_books(db, 'title', book_ids, default_value='')
+        authors_map = formats_map = identifiers_map = {}
+        if include_author:
+            authors_map = authors_for_books(db, book_ids)
+        if include_formats:
+            formats_map = get_field_for_books(db, 'formats', book_ids, default_value=())
+        if include_identifier:
+            identifiers_map = get_field_for_books(db, 'identifiers', book_ids, default_value={})
+
+        display_map = {}
+        for book_id in book_ids:
+            text = titles_map.get(book_id) or ''
             if include_author:
-                authors = ' & '.join(authors_to_list(db, book_id))
+                authors = ' & '.join(authors_map.get(book_id, []))
                 text = '%s / %s'%(text, authors)
             if include_formats:
-                formats = db.formats(book_id, index_is_id=True)
-                if formats is None:
+                formats = formats_map.get(book_id)
+                if formats:
+                    formats = ','.join(formats)
+                else:
                     formats = 'No formats'
                 text = '%s [%s]'%(text, formats)
             if include_identifier:
-                identifiers = db.get_identifiers(book_id, index_is_id=True)
+                identifiers = identifiers_map.get(book_id) or {}
                 identifier = identifiers.get(self.identifier_type, '')
                 text = '%s {%s:%s}'%(text, self.identifier_type, identifier)
-            return text
+            display_map[book_id] = text
+        return display_map
 
-    def _do_comparison(self):
+    def _do_comparison(self, algorithm, book_ids, progress=None):
         '''
         When analysing the current database, we do not want to hash every book with
         every other book in this database. Instead we want to determine the hash
         and then compare it with the hashes we have from the other database.
         So we will not be reporting duplicates within this database, only duplicates
         from each individual book in this database with the target database.
+        This runs on a background thread so must not touch the gui.
         '''
-        debug_print('Find Duplicates -> Library -> Start ({})'.format(self.search_type))
-        algorithm, self.algorithm_text = create_algorithm(self.gui, self.db,
-                        self.search_type, self.identifier_type,
-                        self.title_match, self.author_match, None, None)
-        duplicates_count = 0
-        duplicate_book_ids = None
-
+        algorithm.set_progress(progress)
         if algorithm.duplicate_search_mode() == DUPLICATE_SEARCH_FOR_AUTHOR:
             # Author only comparisons need to be treated specially because we want to
             # iterate through authors, not book ids
-            duplicates_count, duplicate_book_ids, msg = self._do_author_only_comparison(algorithm)
+            result = self._do_author_only_comparison(algorithm, book_ids, progress)
 
         elif self.search_type == 'binary':
             # Binary comparison searches are a headache we can't solve by reusing the
             # existing algorithm because shrinking of the resultsets takes place.
             # Effectively must rewrite the algorithm code
-            duplicates_count, duplicate_book_ids, msg = self._do_binary_comparison(algorithm)
+            result = self._do_binary_comparison(algorithm, book_ids, progress)
 
         else:
             # This is an identifier or title/author search
-            duplicates_count, duplicate_book_ids, msg = self._do_title_author_identifier_comparison(algorithm)
+            result = self._do_title_author_identifier_comparison(algorithm, book_ids, progress)
 
         debug_print('Find Duplicates -> Library -> Search completed')
+        return result
+
+    def _display_comparison_results(self, duplicates_count, duplicate_book_ids, msg):
         if duplicates_count > 0:
             msg += "<br/><br/>" + _("Click 'Show details' to see the results.")
             if self.display_results and duplicate_book_ids is not None:
@@ -941,108 +1049,52 @@ class CrossLibraryDuplicateFinder(FinderBase):
                 debug_print('Find Duplicates -> Library -> Marked results displayed')
         return msg
 
-    def _do_author_only_comparison(self, algorithm):
-        self.gui.status_bar.showMessage(_('Analysing duplicates in target database')+'...', 0)
-        target_candidates_map, target_author_bookids_map = self._analyse_target_database()
-        self.gui.status_bar.showMessage(_('Analysing duplicates in current database')+'...', 0)
-        duplicates_count = 0
-        duplicate_book_ids = []
+    def _do_author_only_comparison(self, algorithm, book_ids, progress):
+        report_progress(progress, _('Analysing duplicates in target database')+'...')
+        target_candidates_map, target_author_bookids_map = self._analyse_target_database(progress)
 
         # We will just look at an author by author basis, rather than by book id
         # However in order to display the books affected afterwards, we need to keep track of them.
-        book_ids = algorithm.get_book_ids_to_consider()
-        author_books_map = defaultdict(set)
-        for book_id in book_ids:
-            book_authors = authors_to_list(self.db, book_id)
-            for author in book_authors:
-                author_books_map[author].add(book_id)
-
-        authors = get_field_pairs(self.db, 'authors')
-        author_names = [a[1].replace('|',',') for a in authors]
-        for author in author_names:
-            author_candidates_map = defaultdict(set)
-            algorithm.find_author_candidate(author, author_candidates_map)
-            for author_hash in author_candidates_map:
-                if author_hash in target_candidates_map:
-                    self.log('Author in this library: %s'%author)
-                    # Find the books for this author
-                    for book_id in author_books_map[author]:
-                        duplicate_book_ids.append(book_id)
-                    duplicates_count += 1
-                    for dup_author in sorted(list(target_candidates_map[author_hash])):
-                        self.log('   Target library author: %s'%dup_author)
-                        for book_id in target_author_bookids_map[dup_author]:
-                            self.log('      Has book: %s'%self._get_book_display_info(self.target_db, book_id))
-                    self.log('')
+        author_matches, duplicate_book_ids = find_author_duplicates_in_target(algorithm, self.db,
+                                                                book_ids, target_candidates_map)
+        duplicates_count = len(author_matches)
+
+        # Now we know all the target books we need to report, fetch their details in bulk
+        target_book_ids = set()
+        for author, dup_authors in author_matches:
+            for dup_author in dup_authors:
+                target_book_ids |= target_author_bookids_map[dup_author]
+        target_display_map = self._get_books_display_info(self.target_db, target_book_ids)
+
+        for author, dup_authors in author_matches:
+            self.log('Author in this library: %s'%author)
+            for dup_author in dup_authors:
+                self.log('   Target library author: %s'%dup_author)
+                for book_id in target_author_bookids_map[dup_author]:
+                    self.log('      Has book: %s'%target_display_map[book_id])
+            self.log('')
 
         msg = _('Found <b>{0} authors</b> with potential duplicates using <b>{1}</b> against the library at: {2}').format(
                     duplicates_count, self.algorithm_text, self.library_path)
         return duplicates_count, duplicate_book_ids, msg
 
-    def _do_binary_comparison(self, algorithm):
-        local_book_ids = algorithm.get_book_ids_to_consider()
-
-        def shrink_map(source_map, other_map):
-            new_map = {}
-            for k,v in list(source_map.items()):
-                if k in other_map:
-                    new_map[k] = v
-            return new_map
-
-        def get_format(results_hash_map, book_id):
-            book_format = ''
-            for fmt, book_data in list(results_hash_map[book_id].items()):
-                if book_data['sha'] == k[0] and book_data['size'] == k[1]:
-                    book_format = fmt
-                    break
-            return book_format
-
-        self.gui.status_bar.showMessage('Analysing binary duplicates...', 0)
+    def _do_binary_comparison(self, algorithm, local_book_ids, progress):
+        report_progress(progress, _('Analysing binary duplicates')+'...')
         from calibre_plugins.find_duplicates.book_algorithms import BinaryCompareAlgorithm
-        target_algorithm = BinaryCompareAlgorithm(self.gui, self.target_db, None)
-        # We can't just run the algorithm against the target database because its
-        # optimisations mean that we aren't given the "raw" candidates map for us
-        # to include books from this database before shrinking/refining.
-
-        # Find all books that have an identical file size in the target database
-        target_book_ids = target_algorithm.get_book_ids_to_consider()
-        target_candidates_size_map = defaultdict(set)
-        for book_id in target_book_ids:
-            target_algorithm._find_candidate_by_file_size(book_id, target_candidates_size_map)
-        # Find all books that have an identical file size in the current database
-        local_candidates_size_map = defaultdict(set)
-        for book_id in local_book_ids:
-            algorithm._find_candidate_by_file_size(book_id, local_candidates_size_map)
-
-        # Now reduce our candidates size maps to only those which intersect
-        target_candidates_size_map = shrink_map(target_candidates_size_map, local_candidates_size_map)
-        local_candidates_size_map = shrink_map(local_candidates_size_map, target_candidates_size_map)
-
-        # Next compute file hashes for the target database candidates
-        target_hash_map = self.target_db.get_all_custom_book_data('find_duplicates', default={})
-        target_result_hash_map = {}
-        target_candidates_map = defaultdict(set)
-        for size, size_group in list(target_candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                target_algorithm._find_candidate_by_hash(book_id, fmt, mtime, size, target_candidates_map, target_hash_map, target_result_hash_map)
-        self.target_db.add_multiple_custom_book_data('find_duplicates', target_result_hash_map)
-
-        # Now compute file hashes the current database candidates (just to get the hashes)
-        local_hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
-        local_result_hash_map = {}
-        local_candidates_map = defaultdict(set)
-        for size, size_group in list(local_candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                algorithm._find_candidate_by_hash(book_id, fmt, mtime, size, local_candidates_map, local_hash_map, local_result_hash_map)
-        self.db.add_multiple_custom_book_data('find_duplicates', local_result_hash_map)
-
-        # Now we have all the raw data we need. The local_candidates_map contains
-        # all the books that "might" have duplicates, but grouped together in case
-        # there are duplicates within the current library. Lets remove all the local
-        # candidates that definitely have no matches in the target library
-        local_candidates_map = shrink_map(local_candidates_map, target_candidates_map)
+        # Run on a background thread, so the target algorithm is created without the gui
+        target_algorithm = BinaryCompareAlgorithm(None, self.target_db, None)
+        target_algorithm.set_progress(progress)
+        target_book_ids = self._get_target_db_book_ids('binary')
+        local_candidates_map, target_candidates_map, local_result_hash_map, target_result_hash_map = \
+                find_binary_duplicates_in_target(algorithm, local_book_ids, target_algorithm, target_book_ids)
 
         # Finally what is left are groups of current library books that have duplicates
+        # Fetch the details of all the books we will report on in bulk from each library
+        local_display_map = self._get_books_display_info(self.db,
+                    set().union(*local_candidates_map.values()), include_formats=False)
+        target_display_map = self._get_books_display_info(self.target_db,
+                    set().union(*[target_candidates_map[k] for k in local_candidates_map]),
+                    include_formats=False)
         duplicates_count = 0
         duplicate_book_ids = []
         for k, book_ids in list(local_candidates_map.items()):
@@ -1053,13 +1105,13 @@ class CrossLibraryDuplicateFinder(FinderBase):
                 duplicate_book_ids.append(book_id)
                 duplicates_count += 1
                 # Figure out what format was considered a duplicate
-                book_format = get_format(local_result_hash_map, book_id)
-                text = '%s [%s]'%(self._get_book_display_info(self.db, book_id, include_formats=False), book_format)
+                book_format = get_format_for_hash(local_result_hash_map, book_id, k)
+                text = '%s [%s]'%(local_display_map[book_id], book_format)
                 self.log('Book format in this library: %s'%text)
                 dups = []
                 for dup_book_id in target_book_ids:
-                    book_format = get_format(target_result_hash_map, dup_book_id)
-                    dups.append('%s [%s]'%(self._get_book_display_info(self.target_db, dup_book_id, include_formats=False), book_format))
+                    book_format = get_format_for_hash(target_result_hash_map, dup_book_id, k)
+                    dups.append('%s [%s]'%(target_display_map[dup_book_id], book_format))
                 for dup_text in sorted(dups):
                     self.log('   Target duplicate format: %s'%dup_text)
                 self.log('')
@@ -1067,44 +1119,36 @@ class CrossLibraryDuplicateFinder(FinderBase):
         msg = _('Found <b>{0} books</b> with binary duplicates against the library at: {1}').format(duplicates_count, self.library_path)
         return duplicates_count, duplicate_book_ids, msg
 
-    def _do_title_author_identifier_comparison(self, algorithm):
-        self.gui.status_bar.showMessage(_('Analysing duplicates in target database')+'...', 0)
-        target_candidates_map, author_bookids_map_unused = self._analyse_target_database()
-
-        # Use the standard approach to get current library book ids for consideration
-        book_ids = algorithm.get_book_ids_to_consider()
+    def _do_title_author_identifier_comparison(self, algorithm, book_ids, progress):
+        report_progress(progress, _('Analysing duplicates in target database')+'...')
+        target_candidates_map, author_bookids_map_unused = self._analyse_target_database(progress)
         include_identifier = self.search_type == 'identifier'
-        duplicate_book_ids = []
-
-        marked_ids = {}
-        self.gui.status_bar.showMessage(_('Analysing duplicates in current database')+'...', 0)
-        # Iterate through these books getting our hashes
-        for book_id in book_ids:
-            # We will create a temporary candidates map for each book, since we are
-            # not interested in hashing the current library's books together. And we
-            # can't give it the map from the target database, because we won't know
-            # which database each group's ids belong to!
-            book_candidates_map = defaultdict(set)
-            algorithm.find_candidate(book_id, book_candidates_map, self.include_languages)
-            # We now have any hash(s) for the current book in our candidates map.
-            # See if we have them in our target library map too to indicate a duplicate
-            duplicate_books = set()
-            for book_hash in book_candidates_map:
-                if book_hash in target_candidates_map:
-                    duplicate_books |= target_candidates_map[book_hash]
-            if len(duplicate_books) > 0:
-                duplicate_book_ids.append(book_id)
-                self.log('Book in this library: %s'%self._get_book_display_info(self.db, book_id, include_identifier=include_identifier))
-                dups = [self._get_book_display_info(self.target_db, dup_book_id)
-                        for dup_book_id in duplicate_books]
-                for dup_text in sorted(dups):
-                    self.log('   Target library: %s'%dup_text)
-                self.log('')
 
+        # Compute the hash(s) for all of the current library books in one pass, then
+        # probe the target library map with them. We are not interested in hashing
+        # the current library's books together, so each book keeps its own keys.
+        candidate_keys = algorithm.iter_with_progress(
+                            algorithm.find_candidate_keys(book_ids, self.include_languages),
+                            _('Analysing duplicates in current database')+'...', len(book_ids))
+        duplicates_map = find_duplicates_in_target(candidate_keys, target_candidates_map)
+
+        # Fetch the details of all the books we will report on in bulk from each library
+        local_display_map = self._get_books_display_info(self.db, duplicates_map.keys(),
+                                                         include_identifier=include_identifier)
+        target_display_map = self._get_books_display_info(self.target_db,
+                                                          set().union(*duplicates_map.values()))
+        for book_id, duplicate_books in duplicates_map.items():
+            self.log('Book in this library: %s'%local_display_map[book_id])
+            dups = [target_display_map[dup_book_id] for dup_book_id in duplicate_books]
+            for dup_text in sorted(dups):
+                self.log('   Target library: %s'%dup_text)
+            self.log('')
+
+        duplicate_book_ids = list(duplicates_map.keys())
         msg = _('Found <b>{0} books</b> with potential duplicates using <b>{1}</b> against the library at: {2}').format(len(duplicate_book_ids), self.algorithm_text, self.library_path)
         return len(duplicate_book_ids), duplicate_book_ids, msg
 
-    def _analyse_target_database(self):
+    def _analyse_target_database(self, progress=None):
         '''
         Get the candidates using algorithm against the target database.
         Similar to a regular duplicate check except that:
@@ -1113,9 +1157,13 @@ class CrossLibraryDuplicateFinder(FinderBase):
         (c) we do *not* want to shrink the candidates map as we must use it to
             "add" candidates from *this* database too.
         '''
-        algorithm, self.algorithm_text = create_algorithm(self.gui, self.target_db,
+        # Run on a background thread, so the algorithm is created without the gui.
+        # Its description is the same as that of the search of this library.
+        algorithm, _algorithm_text = create_algorithm(None, self.target_db,
                         self.search_type, self.identifier_type,
                         self.title_match, self.author_match, None, None)
+        algorithm.set_progress(progress)
+        set_performance_options(algorithm)
 
         book_ids = self._get_target_db_book_ids(self.search_type)
         target_candidates_map = algorithm.find_candidates(book_ids, self.include_languages)
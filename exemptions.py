@@ -0,0 +1,262 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+from collections import defaultdict, OrderedDict
+
+# This module must not import Qt or the calibre gui so that it can be used
+# by the duplicate algorithms outside of the calibre user interface.
+
+
+class ExemptionMap(object):
+    '''
+    Exemptions are stored as a list of lists (each inner list represents an exemption group)
+    This wrapper class provides dictionary type access to that structure without the
+    original cartesian based approach of storing each id with every other id.
+
+    The map is maintained incrementally. Each member keeps the ids of the groups it
+    belongs to, and the merged set of everything a member is exempt from is cached
+    until a change touches one of that member's groups.
+    '''
+    def __init__(self, exemptions_list=None):
+        self._groups = OrderedDict()
+        self._groups_for_member = defaultdict(set)
+        self._merged_sets = {}
+        self._next_group_id = 0
+        for group_list in exemptions_list or []:
+            self.add_group(group_list)
+
+    def __contains__(self, member):
+        return member in self._groups_for_member
+
+    def __len__(self):
+        return len(self._groups_for_member)
+
+    def __iter__(self):
+        return iter(self._groups_for_member)
+
+    def keys(self):
+        return list(self._groups_for_member.keys())
+
+    @property
+    def group_count(self):
+        return len(self._groups)
+
+    @property
+    def exemptions_list(self):
+        '''
+        The exemption groups as a list of lists for persistence purposes
+        '''
+        return [list(group) for group in self._groups.values()]
+
+    def merge_sets(self, member):
+        '''
+        Returns a frozenset of all the other members this member is exempt
+        from being a duplicate of. The result is cached until changed.
+        '''
+        merged = self._merged_sets.get(member)
+        if merged is None:
+            group_ids = self._groups_for_member.get(member)
+            if not group_ids:
+                return frozenset()
+            groups = [self._groups[group_id] for group_id in group_ids]
+            merged = frozenset().union(*groups) - frozenset([member])
+            self._merged_sets[member] = merged
+        return merged
+
+    def is_in_one_group(self, members):
+        '''
+        Returns whether all of these members are already together in a single
+        exemption group, looking only at the groups of the first member.
+        '''
+        members = list(members)
+        if not members:
+            return False
+        for group_id in self._groups_for_member.get(members[0], ()):
+            if self._groups[group_id].issuperset(members):
+                return True
+        return False
+
+    def add_group(self, members):
+        '''
+        Add a new exemption group, flagging all of these members as not
+        duplicates of each other. Groups of less than two members are ignored.
+        '''
+        group = frozenset(members)
+        if len(group) < 2:
+            return
+        group_id = self._next_group_id
+        self._next_group_id += 1
+        self._groups[group_id] = group
+        for member in group:
+            self._groups_for_member[member].add(group_id)
+            self._merged_sets.pop(member, None)
+
+    def remove_items(self, items):
+        '''
+        Remove all of the exemption mappings between each of these items and
+        any others, by removing them from every exemption group they are in.
+        '''
+        to_remove = frozenset(items)
+        for group_id in self._group_ids_for_members(to_remove):
+            group = self._groups[group_id]
+            self._replace_group(group_id, group - to_remove)
+
+    def remove_master_child(self, master, items):
+        '''
+        Remove only the exemption mappings from the master to each of these items.
+        Every group containing the master and any of the items is split into
+        the group without the items, and the group without the master.
+        '''
+        to_remove = frozenset(items)
+        for group_id in list(self._groups_for_member.get(master, ())):
+            group = self._groups[group_id]
+            if group.isdisjoint(to_remove):
+                continue
+            self._replace_group(group_id, group - to_remove)
+            self.add_group(group - frozenset([master]))
+
+    def _group_ids_for_members(self, members):
+        group_ids = set()
+        for member in members:
+            group_ids.update(self._groups_for_member.get(member, ()))
+        # Preserve the original ordering of the groups
+        return sorted(group_ids)
+
+    def _replace_group(self, group_id, new_group):
+        old_group = self._groups[group_id]
+        for member in old_group:
+            self._merged_sets.pop(member, None)
+        if len(new_group) > 1:
+            self._groups[group_id] = new_group
+        else:
+            del self._groups[group_id]
+            new_group = frozenset()
+        for member in old_group - new_group:
+            group_ids = self._groups_for_member[member]
+            group_ids.discard(group_id)
+            if not group_ids:
+                del self._groups_for_member[member]
+
+
+class ExemptionStore(object):
+    '''
+    Persists an ExemptionMap in the library database preferences.
+    Rather than rewriting every exemption group on each change, the store keeps
+    a snapshot of the groups plus a log of the changes made since it was taken.
+    Each change writes a single log entry and the log length, so marking or removing
+    a group costs in proportion to the size of that group. Once the log grows too
+    large relative to the snapshot it is compacted into a new snapshot.
+
+    Log entries are written into numbered slots which are reused after compaction.
+    The snapshot and the log length both carry a generation number, so that a
+    compaction interrupted part way through never replays a stale log.
+
+    The exemptions are not loaded until they are first needed.
+    '''
+    MIN_COMPACT_LOG_SIZE = 100
+
+    def __init__(self, prefs, namespace, name):
+        self.prefs = prefs
+        self.namespace = namespace
+        self.name = name
+        self._generation = 0
+        self._log_size = 0
+        self._exemptions_map = None
+
+    @property
+    def exemptions_map(self):
+        if self._exemptions_map is None:
+            self._exemptions_map = self._load()
+        return self._exemptions_map
+
+    def has_exemptions(self):
+        '''
+        Returns whether there are any exemptions, without loading them if possible
+        '''
+        if self._exemptions_map is None:
+            snapshot = self.prefs.get_namespaced(self.namespace, self._key('snapshot'), None)
+            log_state = self.prefs.get_namespaced(self.namespace, self._key('log'), None)
+            has_log = log_state and snapshot and log_state['size'] and \
+                        log_state['generation'] == snapshot['generation']
+            if not has_log:
+                return bool(snapshot and snapshot['groups'])
+        return len(self.exemptions_map) > 0
+
+    def _key(self, *parts):
+        # calibre does not allow colons in the keys of namespaced preferences
+        return '_'.join((self.name,) + parts)
+
+    def _load(self):
+        snapshot = self.prefs.get_namespaced(self.namespace, self._key('snapshot'), None)
+        if not snapshot:
+            return ExemptionMap()
+        exemptions_map = ExemptionMap(snapshot['groups'])
+        self._generation = snapshot['generation']
+        log_state = self.prefs.get_namespaced(self.namespace, self._key('log'), None)
+        if log_state and log_state['generation'] == self._generation:
+            self._log_size = log_state['size']
+            for idx in range(self._log_size):
+                entry = self.prefs.get_namespaced(self.namespace, self._key('log', str(idx)), None)
+                if entry:
+                    self._apply(exemptions_map, entry)
+        return exemptions_map
+
+    def _apply(self, exemptions_map, entry):
+        op = entry[0]
+        if op == 'add':
+            exemptions_map.add_group(entry[1])
+        elif op == 'remove':
+            exemptions_map.remove_items(entry[1])
+        elif op == 'remove_master':
+            exemptions_map.remove_master_child(entry[1], entry[2])
+
+    def _append(self, entry):
+        self._apply(self.exemptions_map, entry)
+        if self._log_size >= max(self.MIN_COMPACT_LOG_SIZE, self.exemptions_map.group_count // 4):
+            self.compact()
+            return
+        self.prefs.set_namespaced(self.namespace, self._key('log', str(self._log_size)), entry)
+        self._log_size += 1
+        self.prefs.set_namespaced(self.namespace, self._key('log'),
+                                  {'generation': self._generation, 'size': self._log_size})
+
+    def add_group(self, members):
+        members = list(OrderedDict.fromkeys(members))
+        if len(members) < 2:
+            return
+        # Marking a group again whose members are already in an exemption group
+        # together would only grow the log without changing the exemptions
+        if self.exemptions_map.is_in_one_group(members):
+            return
+        self._append(['add', members])
+
+    def remove_items(self, items):
+        items = [item for item in items if item in self.exemptions_map]
+        if items:
+            self._append(['remove', items])
+
+    def remove_master_child(self, master, items):
+        items = list(items)
+        if items and master in self.exemptions_map:
+            self._append(['remove_master', master, items])
+
+    def replace_all(self, exemptions_list):
+        '''
+        Replace all of the exemptions with this list of lists
+        '''
+        self._exemptions_map = ExemptionMap(exemptions_list)
+        self.compact()
+
+    def compact(self):
+        '''
+        Write the current exemption groups as a new snapshot and empty the log
+        '''
+        self._generation += 1
+        self.prefs.set_namespaced(self.namespace, self._key('snapshot'),
+                                  {'generation': self._generation,
+                                   'groups': self.exemptions_map.exemptions_list})
+        self._log_size = 0
+        self.prefs.set_namespaced(self.namespace, self._key('log'),
+                                  {'generation': self._generation, 'size': 0})
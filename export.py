@@ -0,0 +1,229 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import csv, json
+from collections import OrderedDict
+from itertools import islice
+
+from calibre_plugins.find_duplicates.matching import get_field_for_books, authors_for_books
+from calibre_plugins.find_duplicates.worker import report_progress
+
+try:
+    load_translations()
+except NameError:
+    pass
+
+# This module must not import Qt or the calibre gui so that it can be used
+# outside of the calibre user interface.
+
+EXPORT_FORMAT_JSONL = 'jsonl'
+EXPORT_FORMAT_CSV = 'csv'
+EXPORT_FORMAT_JSON = 'json'
+
+EXPORT_FORMATS = OrderedDict([
+    (EXPORT_FORMAT_JSONL, _('JSON Lines')),
+    (EXPORT_FORMAT_CSV, _('CSV')),
+    (EXPORT_FORMAT_JSON, _('JSON')),
+])
+
+# The optional columns which can be exported for each book
+COLUMN_TITLE = 'title'
+COLUMN_AUTHORS = 'authors'
+COLUMN_FORMATS = 'formats'
+COLUMN_SIZES = 'sizes'
+COLUMN_IDENTIFIERS = 'identifiers'
+COLUMN_MATCH_KEY = 'match_key'
+
+EXPORT_COLUMNS = OrderedDict([
+    (COLUMN_TITLE, _('Title')),
+    (COLUMN_AUTHORS, _('Authors')),
+    (COLUMN_FORMATS, _('Formats')),
+    (COLUMN_SIZES, _('Format sizes')),
+    (COLUMN_IDENTIFIERS, _('Identifiers')),
+    (COLUMN_MATCH_KEY, _('Match key')),
+])
+
+# How many groups to fetch the columns of at a time, which bounds the memory
+# used by an export however many groups there are
+EXPORT_CHUNK_SIZE = 1000
+
+
+def fetch_book_columns(db, book_ids, columns):
+    '''
+    Return a dictionary of book id to an ordered dictionary of its values for
+    the columns, fetching each column for all of the books with one call.
+    The match key is a column of each group rather than of its books.
+    '''
+    book_ids = list(book_ids)
+    values_map = dict((book_id, OrderedDict()) for book_id in book_ids)
+    if COLUMN_TITLE in columns:
+        titles_map = get_field_for_books(db, 'title', book_ids, default_value='')
+        for book_id, values in values_map.items():
+            values[COLUMN_TITLE] = titles_map.get(book_id) or ''
+    if COLUMN_AUTHORS in columns:
+        authors_map = authors_for_books(db, book_ids)
+        for book_id, values in values_map.items():
+            values[COLUMN_AUTHORS] = authors_map.get(book_id, [])
+    if COLUMN_FORMATS in columns or COLUMN_SIZES in columns:
+        formats_map = get_field_for_books(db, 'formats', book_ids, default_value=())
+        db_ref = db.new_api if hasattr(db, 'new_api') else db
+        for book_id, values in values_map.items():
+            formats = list(formats_map.get(book_id) or ())
+            if COLUMN_FORMATS in columns:
+                values[COLUMN_FORMATS] = formats
+            if COLUMN_SIZES in columns:
+                # The sizes are read from the database rather than the files
+                values[COLUMN_SIZES] = OrderedDict((fmt, db_ref.format_db_size(book_id, fmt))
+                                                   for fmt in formats)
+    if COLUMN_IDENTIFIERS in columns:
+        identifiers_map = get_field_for_books(db, 'identifiers', book_ids, default_value={})
+        for book_id, values in values_map.items():
+            values[COLUMN_IDENTIFIERS] = dict(identifiers_map.get(book_id) or {})
+    return values_map
+
+
+def format_match_key(key):
+    '''
+    Match keys are usually text, but a binary compare matches on (hash, size)
+    '''
+    if key is None:
+        return ''
+    if isinstance(key, tuple):
+        return ':'.join('%s' % part for part in key)
+    return key
+
+
+def iter_group_records(db, results, columns=(), algorithm=None, include_languages=False,
+                       progress=None, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Yields an ordered dictionary for each group of the results, with its group id,
+    optionally its match key and a list of its books with their column values.
+    The columns and match keys are fetched for chunk_size groups at a time.
+    The match keys are computed by an algorithm of the search which found the groups.
+    '''
+    total = len(results)
+    stage = _('Exporting {0} duplicate groups').format(total)
+    groups = iter(results.items())
+    done = 0
+    while True:
+        report_progress(progress, stage, done, total)
+        chunk = list(islice(groups, chunk_size))
+        if not chunk:
+            break
+        book_ids = set()
+        for _group_id, book_ids_in_group in chunk:
+            book_ids.update(book_ids_in_group)
+        values_map = fetch_book_columns(db, book_ids, columns)
+        match_keys = {}
+        if COLUMN_MATCH_KEY in columns and algorithm is not None:
+            match_keys = algorithm.find_match_keys(chunk, include_languages)
+        for group_id, book_ids_in_group in chunk:
+            record = OrderedDict([('group', group_id)])
+            if COLUMN_MATCH_KEY in columns:
+                record[COLUMN_MATCH_KEY] = format_match_key(match_keys.get(group_id))
+            books = []
+            for book_id in book_ids_in_group:
+                book = OrderedDict([('book_id', book_id)])
+                book.update(values_map[book_id])
+                books.append(book)
+            record['books'] = books
+            yield record
+        done += len(chunk)
+
+
+def _csv_value(column, value):
+    if column == COLUMN_AUTHORS:
+        return ' & '.join(value)
+    if column == COLUMN_FORMATS:
+        return ','.join(value)
+    if column in (COLUMN_SIZES, COLUMN_IDENTIFIERS):
+        return ','.join('%s:%s' % (key, value[key]) for key in value)
+    return value
+
+
+def write_csv(out, records, columns):
+    '''
+    Write a row for each book of each group, repeating the match key of
+    the group on each of its rows
+    '''
+    book_columns = [column for column in EXPORT_COLUMNS if column in columns and column != COLUMN_MATCH_KEY]
+    match_key_columns = [COLUMN_MATCH_KEY] if COLUMN_MATCH_KEY in columns else []
+    writer = csv.writer(out)
+    writer.writerow(['group', 'book_id'] + book_columns + match_key_columns)
+    for record in records:
+        match_key_values = [record[COLUMN_MATCH_KEY]] if match_key_columns else []
+        for book in record['books']:
+            writer.writerow([record['group'], book['book_id']] +
+                            [_csv_value(column, book[column]) for column in book_columns] +
+                            match_key_values)
+
+
+def write_jsonl(out, header, records):
+    '''
+    Write the header as the first line, then each group on a line of its own
+    '''
+    out.write(json.dumps(header) + '\n')
+    for record in records:
+        out.write(json.dumps(record) + '\n')
+
+
+def _write_json_member(out, key, value, last=False):
+    # Indent the value as json.dump would within the top level object
+    text = json.dumps(value, indent=4).replace('\n', '\n    ')
+    out.write('    %s: %s%s\n' % (json.dumps(key), text, '' if last else ','))
+
+
+def _write_json_items(out, key, items, as_list=False, last=False):
+    # Write a member of the top level object one item at a time
+    out.write('    %s: %s' % (json.dumps(key), '[' if as_list else '{'))
+    separator = '\n'
+    for item in items:
+        if as_list:
+            text = json.dumps(item, indent=4)
+        else:
+            text = '%s: %s' % (json.dumps('%s' % item[0]), json.dumps(item[1], indent=4))
+        out.write(separator + '        ' + text.replace('\n', '\n        '))
+        separator = ',\n'
+    out.write('%s    %s%s\n' % ('\n' if separator != '\n' else '', ']' if as_list else '}',
+                                 '' if last else ','))
+
+
+def write_json(out, header, results, records=None):
+    '''
+    Write a single indented JSON object of the header, the book ids of each
+    group and the groups of each book in more than one group, which is the
+    export format of earlier versions. If given, the group records with their
+    columns are added as a list of groups. Each part is written as it is
+    produced rather than building the whole object in memory.
+    '''
+    out.write('{\n')
+    for key, value in header.items():
+        _write_json_member(out, key, value)
+    _write_json_items(out, 'books_for_group', results.items())
+    entangled_items = ((book_id, group_ids) for book_id, group_ids in results.book_items()
+                       if len(group_ids) > 1)
+    _write_json_items(out, 'entangled_groups_for_book', entangled_items, last=records is None)
+    if records is not None:
+        _write_json_items(out, 'groups', records, as_list=True, last=True)
+    out.write('}\n')
+
+
+def export_results(out, export_format, db, results, header, columns=(), algorithm=None,
+                   include_languages=False, progress=None):
+    '''
+    Write the duplicate groups of the results to the text stream in the export
+    format, with the header describing the library and search, and the values of
+    the columns for each book fetched in bulk a chunk of groups at a time.
+    Only one chunk of groups is held in memory at a time.
+    '''
+    records = iter_group_records(db, results, columns, algorithm, include_languages, progress)
+    if export_format == EXPORT_FORMAT_CSV:
+        write_csv(out, records, columns)
+    elif export_format == EXPORT_FORMAT_JSONL:
+        header = OrderedDict(header)
+        header['columns'] = [column for column in EXPORT_COLUMNS if column in columns]
+        write_jsonl(out, header, records)
+    else:
+        write_json(out, header, results, records if columns else None)
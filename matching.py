@@ -4,10 +4,16 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
 import re
+from bisect import bisect_right
+from collections import defaultdict
+
 from calibre import prints
 from calibre.utils.config import tweaks
 from calibre.utils.localization import get_udc
 
+from calibre_plugins.find_duplicates.stats import (COUNTER_UNIQUE_TITLES, COUNTER_BOOK_AUTHORS,
+                                                   COUNTER_UNIQUE_AUTHORS)
+
 title_soundex_length = 6
 author_soundex_length = 8
 publisher_soundex_length = 6
@@ -78,6 +84,48 @@ def authors_to_list(db, book_id):
         return [a.strip().replace('|',',') for a in authors.split(',')]
     return []
 
+def get_field_for_books(db, field_name, book_ids, default_value=None):
+    '''
+    Return a dictionary of book id to field value, fetching the field for
+    all of the books in a single call rather than one book at a time.
+    '''
+    db_ref = db.new_api if hasattr(db, 'new_api') else db
+    return db_ref.all_field_for(field_name, book_ids, default_value=default_value)
+
+def authors_for_books(db, book_ids):
+    '''
+    Bulk equivalent of authors_to_list(), returning a dictionary of book id
+    to the list of authors for that book.
+    '''
+    authors_map = get_field_for_books(db, 'authors', book_ids, default_value=())
+    return dict((book_id, [a.strip().replace('|',',') for a in authors])
+                for book_id, authors in authors_map.items())
+
+def books_for_authors(db, book_ids=None):
+    '''
+    Returns a dictionary of author name to the set of ids of the books by
+    that author, inverting the authors of all the books read with a single
+    call rather than looking up the books of each author in turn.
+    If book_ids are specified then only those books are included.
+    '''
+    if book_ids is None:
+        db_ref = db.new_api if hasattr(db, 'new_api') else db
+        book_ids = db_ref.all_book_ids()
+    author_books_map = defaultdict(set)
+    for book_id, authors in authors_for_books(db, book_ids).items():
+        for author in authors:
+            author_books_map[author].add(book_id)
+    return author_books_map
+
+def languages_for_books(db, book_ids):
+    '''
+    Bulk equivalent of db.languages(), returning a dictionary of book id
+    to a comma separated string of language codes (or None).
+    '''
+    languages_map = get_field_for_books(db, 'languages', book_ids, default_value=())
+    return dict((book_id, ','.join(langs) or None)
+                for book_id, langs in languages_map.items())
+
 def fuzzy_it(text, patterns=None):
     fuzzy_title_patterns = [(re.compile(pat, re.IGNORECASE), repl) for pat, repl in
                 [
@@ -413,6 +461,168 @@ def fuzzy_tags_match(tag):
     return tag_tokens[0]
 
 
+# --------------------------------------------------------------
+#           Candidate Group Functions
+# --------------------------------------------------------------
+
+def remove_subset_groups(candidate_groups):
+    '''
+    Given an iterable of sets, return a list of the sets ordered by size with
+    any set removed that is a subset of a later set in that order.
+    Rather than comparing each set with every larger set, an index of member
+    to set positions is built so that only the sets sharing the rarest member
+    of a set need to be checked.
+    '''
+    res = [set(d) for d in candidate_groups]
+    res.sort(key=lambda x: len(x))
+    positions_for_member = defaultdict(list)
+    for i, a in enumerate(res):
+        for member in a:
+            positions_for_member[member].append(i)
+
+    candidates_list = []
+    last_position = len(res) - 1
+    for i, a in enumerate(res):
+        if not a:
+            # An empty set is a subset of every set after it
+            if i == last_position:
+                candidates_list.append(a)
+            continue
+        rarest_member = min(a, key=lambda member: len(positions_for_member[member]))
+        positions = positions_for_member[rarest_member]
+        for idx in range(bisect_right(positions, i), len(positions)):
+            if a.issubset(res[positions[idx]]):
+                break
+        else:
+            candidates_list.append(a)
+    return candidates_list
+
+def cluster_candidate_groups(candidate_groups):
+    '''
+    Given an iterable of sets, merge all the sets sharing any member into a single
+    set using a union-find structure, so that each member appears in only one set.
+    Returns a list of the disjoint sets, ordered by the position of the first set
+    that contributed to each of them.
+    '''
+    parent = {}
+    def find(member):
+        while parent[member] != member:
+            # Path halving keeps the trees shallow without recursion
+            parent[member] = parent[parent[member]]
+            member = parent[member]
+        return member
+
+    first_members = []
+    for group in candidate_groups:
+        root = None
+        for member in group:
+            if member not in parent:
+                parent[member] = member
+            member_root = find(member)
+            if root is None:
+                root = member_root
+                first_members.append(member)
+            elif member_root != root:
+                parent[member_root] = root
+
+    clusters = defaultdict(set)
+    for member in parent:
+        clusters[find(member)].add(member)
+    candidates_list = []
+    seen_roots = set()
+    for member in first_members:
+        root = find(member)
+        if root not in seen_roots:
+            seen_roots.add(root)
+            candidates_list.append(clusters[root])
+    return candidates_list
+
+
+def group_candidates(key_book_pairs, shared_only=False):
+    '''
+    Given an iterable of (key, book_id) pairs, return a tuple of the map of each
+    key to the set of its book ids, and the number of unique keys.
+    If shared_only, the map only has the keys of two or more books. Since on a
+    large library almost every key belongs to a single book, only the first book
+    of each key is held until a second book has the same key, so that no set is
+    created for a key which would be shrunk from the map straight afterwards.
+    '''
+    candidates_map = defaultdict(set)
+    if not shared_only:
+        for key, book_id in key_book_pairs:
+            candidates_map[key].add(book_id)
+        return candidates_map, len(candidates_map)
+
+    first_book_map = {}
+    shared_map = {}
+    for key, book_id in key_book_pairs:
+        first_book_id = first_book_map.setdefault(key, book_id)
+        if first_book_id != book_id:
+            group = shared_map.get(key)
+            if group is None:
+                group = shared_map[key] = set()
+                group.add(first_book_id)
+            group.add(book_id)
+    # Keep the keys in the order they were first seen, as in the full map
+    for key in first_book_map:
+        group = shared_map.get(key)
+        if group is not None:
+            candidates_map[key] = group
+    return candidates_map, len(first_book_map)
+
+
+def title_author_keys(title_hash, author_hashes):
+    '''
+    Returns the candidate keys of a book, combining the hash of its title with
+    each (author hash, reversed author hash) of its authors
+    '''
+    if not author_hashes:
+        return [title_hash]
+    keys = []
+    for author_hash, rev_author_hash in author_hashes:
+        keys.append(title_hash+author_hash)
+        if rev_author_hash and rev_author_hash != author_hash:
+            keys.append(title_hash+rev_author_hash)
+    return keys
+
+
+def title_author_candidate_keys(book_rows, title_eval, author_eval=None, stats=None):
+    '''
+    Generator returning a tuple of (book_id, candidate keys) for each of the
+    (book_id, title, authors, language) rows, combining the title hash with
+    the hashes of each author.
+    Each unique title and author is only evaluated once, since common
+    authors in particular will appear on a great many books. If given, the
+    counts of unique titles and authors are added to the search stats.
+    '''
+    title_hashes = {}
+    author_hashes = {}
+    author_count = 0
+    try:
+        for book_id, title, authors, lang in book_rows:
+            title_key = (title or '', lang)
+            title_hash = title_hashes.get(title_key)
+            if title_hash is None:
+                title_hash = title_hashes[title_key] = title_eval(*title_key)
+            if not authors or not author_eval:
+                yield book_id, [title_hash]
+                continue
+            book_author_hashes = []
+            for author in authors:
+                hashes = author_hashes.get(author)
+                if hashes is None:
+                    hashes = author_hashes[author] = author_eval(author)
+                book_author_hashes.append(hashes)
+            author_count += len(book_author_hashes)
+            yield book_id, title_author_keys(title_hash, book_author_hashes)
+    finally:
+        if stats is not None:
+            stats.count(COUNTER_UNIQUE_TITLES, len(title_hashes))
+            if author_eval:
+                stats.count(COUNTER_BOOK_AUTHORS, author_count)
+                stats.count(COUNTER_UNIQUE_AUTHORS, len(author_hashes))
+
+
 # --------------------------------------------------------------
 #           Find Duplicates Algorithm Factories
 # --------------------------------------------------------------
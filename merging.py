@@ -0,0 +1,72 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+# This module must not import Qt or the calibre gui so that it can be used
+# outside of the calibre user interface.
+
+# The number of groups merged before their duplicate books are deleted
+MERGE_CHUNK_SIZE = 50
+
+
+def plan_group_merges(db, books_for_group_map):
+    '''
+    Decide which books to merge for every duplicate group, without changing anything.
+    The first book of each group is kept and the other books in that group are
+    merged into it, the same as merging the group with Edit Metadata.
+    A book may appear in more than one group, so once it has been merged away it
+    is ignored by any later groups, which may leave them with nothing to merge.
+    Returns a list of (keeper_id, [merged_ids]) tuples in the order to apply them.
+    '''
+    merged_ids = set()
+    plan = []
+    for book_ids in books_for_group_map.values():
+        remaining_ids = [book_id for book_id in book_ids
+                         if book_id not in merged_ids and db.data.has_id(book_id)]
+        if len(remaining_ids) < 2:
+            continue
+        keeper_id = remaining_ids[0]
+        plan.append((keeper_id, remaining_ids[1:]))
+        merged_ids.update(remaining_ids[1:])
+    return plan
+
+
+def merge_formats(db, keeper_id, merged_ids):
+    '''
+    Copy any formats the keeper does not already have from each of the merged books
+    '''
+    new_api = db.new_api
+    keeper_formats = set(new_api.formats(keeper_id))
+    for book_id in merged_ids:
+        for fmt in new_api.formats(book_id):
+            if fmt in keeper_formats:
+                continue
+            path = new_api.format_abspath(book_id, fmt)
+            if path:
+                new_api.add_format(keeper_id, fmt, path, replace=False, run_hooks=False)
+                keeper_formats.add(fmt)
+
+
+def merge_groups(db, plan, chunk_size=MERGE_CHUNK_SIZE, progress=None):
+    '''
+    Apply a plan from plan_group_merges() directly to the database.
+    The groups are merged in chunks, with the merged books of each chunk deleted
+    in a single call once all of their formats have been copied. So stopping
+    part way through always leaves every group either fully merged or untouched.
+    If given, progress(merged_count, total_count) is called after each chunk
+    and can return False to stop merging any further groups.
+    Returns the ids of the books that were deleted.
+    '''
+    deleted_ids = []
+    for start in range(0, len(plan), chunk_size):
+        chunk = plan[start:start + chunk_size]
+        chunk_ids = []
+        for keeper_id, merged_ids in chunk:
+            merge_formats(db, keeper_id, merged_ids)
+            chunk_ids.extend(merged_ids)
+        db.new_api.remove_books(chunk_ids)
+        deleted_ids.extend(chunk_ids)
+        if progress is not None and progress(start + len(chunk), len(plan)) is False:
+            break
+    return deleted_ids
@@ -0,0 +1,124 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import gc
+from array import array
+from collections import defaultdict, OrderedDict
+
+# This module must not import Qt or the calibre gui so that it can be used
+# by the duplicate algorithms outside of the calibre user interface.
+
+# NumPy is optional, and is not available within most calibre installs.
+# Importing it is slow, so it is only imported when first needed rather
+# than whenever calibre loads the plugin.
+_numpy = None
+_is_numpy_imported = False
+
+
+def _get_numpy():
+    global _numpy, _is_numpy_imported
+    if not _is_numpy_imported:
+        _is_numpy_imported = True
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            pass
+    return _numpy
+
+
+def is_numpy_available():
+    return _get_numpy() is not None
+
+
+def group_shared_candidates(key_book_pairs):
+    '''
+    Given an iterable of (key, book_id) pairs, return a tuple of the map of
+    each key shared by two or more books to the set of its book ids, and the
+    number of unique keys, as matching.group_candidates does with shared_only.
+
+    Each key is hashed to a 64 bit integer so that the pairs can be sorted and
+    split into runs of equal hashes by NumPy. Only the runs of two or more pairs
+    are looked at in Python, where the keys are compared exactly in case two
+    different keys have the same hash.
+    '''
+    numpy = _get_numpy()
+    keys = []
+    hashes = array('q')
+    book_ids = array('q')
+    add_key, add_hash, add_book_id = keys.append, hashes.append, book_ids.append
+    for key, book_id in key_book_pairs:
+        add_key(key)
+        add_hash(hash(key))
+        add_book_id(book_id)
+    candidates_map = defaultdict(set)
+    if not keys:
+        return candidates_map, 0
+
+    hashes = numpy.frombuffer(hashes, dtype=numpy.int64)
+    # A stable sort keeps the pairs of each key in the order they were given
+    order = numpy.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[order]
+    del hashes
+    run_starts = numpy.flatnonzero(numpy.concatenate(([True], sorted_hashes[1:] != sorted_hashes[:-1])))
+    run_lengths = numpy.diff(numpy.append(run_starts, len(sorted_hashes)))
+    del sorted_hashes, run_starts
+    key_count = len(run_lengths)
+
+    # Only the pairs in runs of two or more are needed from here on
+    is_shared_run = run_lengths > 1
+    shared_indices = order[numpy.repeat(is_shared_run, run_lengths)]
+    del order
+    shared_lengths = run_lengths[is_shared_run]
+    shared_starts = numpy.cumsum(shared_lengths) - shared_lengths
+    del run_lengths, is_shared_run
+    shared_book_ids = numpy.frombuffer(book_ids, dtype=numpy.int64)[shared_indices]
+    shared_keys = [keys[idx] for idx in shared_indices.tolist()]
+    del keys, book_ids
+    # Visit the runs in the order their first pair was given, which is the
+    # order of the keys in a map built from the pairs one at a time
+    first_indices = shared_indices[shared_starts]
+    run_order = numpy.argsort(first_indices, kind='stable')
+    runs = zip(shared_starts[run_order].tolist(), shared_lengths[run_order].tolist(),
+               first_indices[run_order].tolist())
+
+    # Keys only share a hash by chance, but if they do their groups are
+    # added at the end and all the keys are then put back in order.
+    first_index_map = {}
+    is_collision = False
+    # The groups hold no cycles, but creating a set for each would otherwise
+    # trigger many needless garbage collections. Only this loop is run with
+    # the collector disabled, as that affects every thread of the process.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for start, length, first_index in runs:
+            end = start + length
+            run_keys = shared_keys[start:end]
+            key = run_keys[0]
+            if run_keys.count(key) == length:
+                group = set(shared_book_ids[start:end].tolist())
+                if len(group) > 1:
+                    candidates_map[key] = group
+                    first_index_map[key] = first_index
+                continue
+            # Different keys with the same hash, so group them by the exact key
+            run_map = OrderedDict()
+            for pos in range(start, end):
+                run_map.setdefault(shared_keys[pos], (int(shared_indices[pos]), set()))[1].add(
+                                                                                int(shared_book_ids[pos]))
+            key_count += len(run_map) - 1
+            for key, (idx, group) in run_map.items():
+                if len(group) > 1:
+                    candidates_map[key] = group
+                    first_index_map[key] = idx
+            is_collision = True
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if is_collision:
+        ordered_keys = sorted(candidates_map, key=first_index_map.get)
+        candidates_map = defaultdict(set, ((key, candidates_map[key]) for key in ordered_keys))
+    return candidates_map, key_count
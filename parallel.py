@@ -0,0 +1,109 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import time
+from collections import defaultdict
+from threading import Thread, Event
+
+from calibre import prints
+from calibre.constants import DEBUG
+
+import calibre_plugins.find_duplicates.matching as matching
+from calibre_plugins.find_duplicates.worker import report_progress, SearchCancelled
+
+try:
+    load_translations()
+except NameError:
+    pass
+
+# This module must not import Qt or the calibre gui, since it is also
+# imported by the worker processes to compute the candidate keys.
+
+# How long to allow a worker process to compute its share of the candidates
+PARALLEL_JOB_TIMEOUT = 3600
+
+
+def find_title_author_candidates_in_process(title_fn_name, author_fn_name, soundex_lengths, book_rows):
+    '''
+    The entry point run in each worker process. Given the names of the title and
+    author matching functions and a chunk of (book_id, title, authors, language)
+    rows, returns the partial candidates map of each key to a list of book ids.
+    '''
+    matching.set_soundex_lengths(*soundex_lengths)
+    title_eval = getattr(matching, title_fn_name)
+    author_eval = getattr(matching, author_fn_name) if author_fn_name else None
+    candidates_map = defaultdict(list)
+    for book_id, keys in matching.title_author_candidate_keys(book_rows, title_eval, author_eval):
+        for key in keys:
+            candidates_map[key].append(book_id)
+    return dict(candidates_map)
+
+
+def find_title_author_candidates_in_parallel(book_rows, title_eval, author_eval, worker_count,
+                                             progress=None, shared_only=False):
+    '''
+    Compute the title/author candidates map by splitting the book rows into a
+    chunk per worker, each computed in a separate calibre worker process.
+    Only the rows are sent to the workers, and their partial candidate maps are
+    merged back together here in the same key order as a single process would.
+    If shared_only, the merged map only has the keys of two or more books.
+    Returns a tuple of the candidates map and the number of unique keys,
+    or None if worker processes are not available or any of them fails.
+    The first failure aborts the other workers.
+    '''
+    try:
+        from calibre.utils.ipc.simple_worker import fork_job
+    except ImportError:
+        return None
+    start = time.time()
+    chunk_size = (len(book_rows) + worker_count - 1) // worker_count
+    chunks = [book_rows[idx:idx + chunk_size] for idx in range(0, len(book_rows), chunk_size)]
+    args_prefix = (title_eval.__name__, author_eval.__name__ if author_eval else None,
+                   (matching.title_soundex_length, matching.author_soundex_length))
+    results = [None] * len(chunks)
+    errors = []
+    abort = Event()
+
+    def run_chunk(idx, chunk):
+        try:
+            job = fork_job('calibre_plugins.find_duplicates.parallel',
+                           'find_title_author_candidates_in_process', args=args_prefix + (chunk,),
+                           timeout=PARALLEL_JOB_TIMEOUT, abort=abort, no_output=True)
+            results[idx] = job['result']
+        except Exception as e:
+            errors.append(e)
+            # No point waiting for the other chunks, as all the candidates are then
+            # computed in this process instead
+            abort.set()
+
+    threads = [Thread(target=run_chunk, args=(idx, chunk), name='FindDuplicatesParallel')
+               for idx, chunk in enumerate(chunks)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    stage = _('Analysing {0} books for duplicates in {1} processes').format(len(book_rows), len(chunks))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            done = sum(1 for result in results if result is not None)
+            report_progress(progress, stage, done, len(chunks))
+            time.sleep(0.25)
+    except SearchCancelled:
+        abort.set()
+        for thread in threads:
+            thread.join()
+        raise
+    if errors:
+        if DEBUG:
+            prints('Failed to compute the candidates in worker processes:', errors[0])
+        return None
+
+    candidates_map, key_count = matching.group_candidates(((key, book_id)
+                                for partial_candidates_map in results
+                                for key, book_ids in partial_candidates_map.items()
+                                for book_id in book_ids), shared_only)
+    if DEBUG:
+        prints('Computed candidates for %d books in %d processes in:'%(len(book_rows), len(chunks)),
+               time.time() - start)
+    return candidates_map, key_count
@@ -0,0 +1,285 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+# This module must not import Qt or the calibre gui so that it can be used
+# outside of the calibre user interface.
+
+from array import array
+from bisect import bisect_left
+
+
+class GroupNavigator(object):
+    '''
+    Keeps the remaining duplicate group ids in ascending order, along with a
+    cursor for cycling through them forwards or backwards.
+    Group ids are positive integers. Presence of each id is held in a Fenwick
+    (binary indexed) tree, so that removing a group, finding the position of a
+    group and finding the next or previous remaining group are all O(log n).
+    '''
+    def __init__(self, group_ids):
+        group_ids = sorted(group_ids)
+        self._size = group_ids[-1] if group_ids else 0
+        self._present = bytearray(self._size + 1)
+        for group_id in group_ids:
+            self._present[group_id] = 1
+        # Build the tree in linear time by pushing each partial sum to its parent
+        self._tree = [0] * (self._size + 1)
+        for idx in range(1, self._size + 1):
+            self._tree[idx] += self._present[idx]
+            parent = idx + (idx & -idx)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[idx]
+        self._count = len(group_ids)
+        self._cursor = group_ids[0] if group_ids else None
+        self._top_bit = 1
+        while self._top_bit * 2 <= self._size:
+            self._top_bit *= 2
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, group_id):
+        return 0 < group_id <= self._size and self._present[group_id] == 1
+
+    def position(self, group_id):
+        '''
+        Returns the 1 based position of this group amongst the remaining groups
+        '''
+        rank = 0
+        idx = group_id
+        while idx > 0:
+            rank += self._tree[idx]
+            idx -= idx & -idx
+        return rank
+
+    def group_at(self, position):
+        '''
+        Returns the group id at this 1 based position amongst the remaining groups
+        '''
+        idx = 0
+        bit = self._top_bit
+        while bit:
+            next_idx = idx + bit
+            if next_idx <= self._size and self._tree[next_idx] < position:
+                idx = next_idx
+                position -= self._tree[next_idx]
+            bit //= 2
+        return idx + 1
+
+    def next_group(self, group_id):
+        '''
+        Returns the remaining group after this one, wrapping around to the first
+        '''
+        position = self.position(group_id)
+        if position >= self._count:
+            return self.group_at(1)
+        return self.group_at(position + 1)
+
+    def previous_group(self, group_id):
+        '''
+        Returns the remaining group before this one, wrapping around to the last
+        '''
+        position = self.position(group_id)
+        if group_id in self:
+            position -= 1
+        if position < 1:
+            return self.group_at(self._count)
+        return self.group_at(position)
+
+    def move(self, forward=True):
+        '''
+        Returns the next group to display and moves the cursor. Moving forward
+        returns the group at the cursor and then advances past it, moving
+        backwards steps the cursor back and returns the group it lands on.
+        '''
+        if self._count == 0:
+            return None
+        if forward:
+            group_id = self._cursor
+            self._cursor = self.next_group(group_id)
+        else:
+            group_id = self._cursor = self.previous_group(self._cursor)
+        return group_id
+
+    def remove(self, group_id):
+        if group_id not in self:
+            raise ValueError('Group %s is not present' % group_id)
+        if self._cursor == group_id:
+            self._cursor = self.next_group(group_id) if self._count > 1 else None
+        self._present[group_id] = 0
+        self._count -= 1
+        idx = group_id
+        while idx <= self._size:
+            self._tree[idx] -= 1
+            idx += idx & -idx
+
+
+class DuplicateResults(object):
+    '''
+    The duplicate groups of a search, held as the book ids of each group and
+    the group ids of each book. Rather than a dict of lists and a dict of sets,
+    each direction is a pair of arrays of offsets and members, so that even
+    very large results are only a few flat arrays of integers.
+    Group ids are positive integers and books are looked up by a binary search
+    of their sorted ids. Removing a book from a group zeroes its entry in the
+    members rather than rebuilding the arrays, and a book is dropped once it
+    is no longer in any group.
+    '''
+    __slots__ = ('_group_offsets', '_group_members', '_group_sizes', '_group_present', '_group_count',
+                 '_book_ids', '_book_offsets', '_book_members', '_book_sizes', '_book_present')
+
+    def __init__(self, books_for_group_map):
+        group_ids = sorted(books_for_group_map)
+        size = group_ids[-1] if group_ids else 0
+        self._group_present = bytearray(size + 1)
+        self._group_sizes = array('i', [0]) * (size + 1)
+        self._group_offsets = array('i', [0]) * (size + 2)
+        self._group_members = array('i')
+        for group_id in range(1, size + 1):
+            book_ids = books_for_group_map.get(group_id)
+            if book_ids is not None:
+                self._group_present[group_id] = 1
+                self._group_sizes[group_id] = len(book_ids)
+                self._group_members.extend(book_ids)
+            self._group_offsets[group_id + 1] = len(self._group_members)
+        self._group_count = len(group_ids)
+
+        # Lay out the groups of each book by counting the books first, so that
+        # the group ids of each book are in ascending order
+        self._book_ids = array('i', sorted(set(self._group_members)))
+        book_count = len(self._book_ids)
+        book_index = dict((book_id, idx) for idx, book_id in enumerate(self._book_ids))
+        self._book_sizes = array('i', [0]) * book_count
+        for book_id in self._group_members:
+            self._book_sizes[book_index[book_id]] += 1
+        self._book_offsets = array('i', [0]) * (book_count + 1)
+        for idx in range(book_count):
+            self._book_offsets[idx + 1] = self._book_offsets[idx] + self._book_sizes[idx]
+        self._book_members = array('i', [0]) * len(self._group_members)
+        next_positions = self._book_offsets[:-1]
+        for group_id in range(1, size + 1):
+            for pos in range(self._group_offsets[group_id], self._group_offsets[group_id + 1]):
+                idx = book_index[self._group_members[pos]]
+                self._book_members[next_positions[idx]] = group_id
+                next_positions[idx] += 1
+        self._book_present = bytearray([1]) * book_count
+
+    def __len__(self):
+        return self._group_count
+
+    def __contains__(self, group_id):
+        # There is no current group id before the first group is shown
+        if group_id is None:
+            return False
+        return 0 < group_id < len(self._group_present) and self._group_present[group_id] == 1
+
+    def _book_index(self, book_id):
+        idx = bisect_left(self._book_ids, book_id)
+        if idx < len(self._book_ids) and self._book_ids[idx] == book_id and self._book_present[idx]:
+            return idx
+        return None
+
+    def has_book(self, book_id):
+        return self._book_index(book_id) is not None
+
+    def group_ids(self):
+        '''
+        Returns the ids of the remaining groups in ascending order
+        '''
+        return [group_id for group_id in range(1, len(self._group_present)) if self._group_present[group_id]]
+
+    def book_ids(self):
+        '''
+        Returns the ids of the books in any remaining group in ascending order
+        '''
+        return [book_id for idx, book_id in enumerate(self._book_ids) if self._book_present[idx]]
+
+    def books_for_group(self, group_id):
+        '''
+        Returns the book ids remaining in this group in their original order
+        '''
+        if group_id not in self:
+            raise KeyError(group_id)
+        members = self._group_members[self._group_offsets[group_id]:self._group_offsets[group_id + 1]]
+        return [book_id for book_id in members if book_id]
+
+    def groups_for_book(self, book_id):
+        '''
+        Returns the ids of the remaining groups this book is in, in ascending order
+        '''
+        idx = self._book_index(book_id)
+        if idx is None:
+            return []
+        members = self._book_members[self._book_offsets[idx]:self._book_offsets[idx + 1]]
+        return [group_id for group_id in members if group_id]
+
+    def items(self):
+        '''
+        Yields each remaining group id and its book ids, so that the results
+        can be used in place of a books for group map
+        '''
+        for group_id in self.group_ids():
+            yield group_id, self.books_for_group(group_id)
+
+    def values(self):
+        for _group_id, book_ids in self.items():
+            yield book_ids
+
+    def book_items(self):
+        '''
+        Yields each remaining book id and the ids of its groups
+        '''
+        for book_id in self.book_ids():
+            yield book_id, self.groups_for_book(book_id)
+
+    def remove_book(self, book_id):
+        '''
+        Removes this book from all of its groups. The groups remain even
+        if they now have less than two books.
+        '''
+        idx = self._book_index(book_id)
+        if idx is None:
+            raise KeyError(book_id)
+        for pos in range(self._book_offsets[idx], self._book_offsets[idx + 1]):
+            group_id = self._book_members[pos]
+            if not group_id:
+                continue
+            for member_pos in range(self._group_offsets[group_id], self._group_offsets[group_id + 1]):
+                if self._group_members[member_pos] == book_id:
+                    self._group_members[member_pos] = 0
+                    self._group_sizes[group_id] -= 1
+                    break
+        self._drop_book(idx)
+
+    def remove_group(self, group_id):
+        '''
+        Removes this group, dropping any of its books now in no other group
+        '''
+        if group_id not in self:
+            raise KeyError(group_id)
+        for pos in range(self._group_offsets[group_id], self._group_offsets[group_id + 1]):
+            book_id = self._group_members[pos]
+            if not book_id:
+                continue
+            idx = self._book_index(book_id)
+            for member_pos in range(self._book_offsets[idx], self._book_offsets[idx + 1]):
+                if self._book_members[member_pos] == group_id:
+                    self._book_members[member_pos] = 0
+                    self._book_sizes[idx] -= 1
+                    break
+            if self._book_sizes[idx] == 0:
+                self._drop_book(idx)
+        self._group_present[group_id] = 0
+        self._group_sizes[group_id] = 0
+        self._group_count -= 1
+
+    def _drop_book(self, idx):
+        self._book_present[idx] = 0
+        self._book_sizes[idx] = 0
+
+    def group_size(self, group_id):
+        if group_id not in self:
+            raise KeyError(group_id)
+        return self._group_sizes[group_id]
@@ -0,0 +1,133 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    load_translations()
+except NameError:
+    pass
+
+# This module must not import Qt or the calibre gui so that it can be used
+# by the duplicate algorithms outside of the calibre user interface.
+
+# The stages of a duplicate search, in the order they run
+STAGE_IDS = 'ids'
+STAGE_FETCH = 'fetch'
+STAGE_KEYS = 'keys'
+STAGE_SHRINK = 'shrink'
+STAGE_SORT = 'sort'
+STAGE_CLEANUP = 'cleanup'
+STAGE_PARTITION = 'partition'
+STAGE_MARK = 'mark'
+STAGE_DISPLAY = 'display'
+
+STAGE_NAMES = OrderedDict([
+    (STAGE_IDS, _('Collecting book ids')),
+    (STAGE_FETCH, _('Reading book fields')),
+    (STAGE_KEYS, _('Computing candidate keys')),
+    (STAGE_SHRINK, _('Removing single book candidates')),
+    (STAGE_SORT, _('Sorting candidate groups')),
+    (STAGE_CLEANUP, _('Removing subset groups')),
+    (STAGE_PARTITION, _('Partitioning groups by exemptions')),
+    (STAGE_MARK, _('Marking books')),
+    (STAGE_DISPLAY, _('Displaying results')),
+])
+
+# What a duplicate search counts as it runs
+COUNTER_BOOKS = 'books'
+COUNTER_UNIQUE_TITLES = 'unique_titles'
+COUNTER_BOOK_AUTHORS = 'book_authors'
+COUNTER_UNIQUE_AUTHORS = 'unique_authors'
+COUNTER_UNIQUE_KEYS = 'unique_keys'
+COUNTER_GROUPS_AFTER_SHRINK = 'groups_after_shrink'
+COUNTER_GROUPS_AFTER_CLEANUP = 'groups_after_cleanup'
+COUNTER_DUPLICATE_GROUPS = 'duplicate_groups'
+COUNTER_FORMATS_HASHED = 'formats_hashed'
+COUNTER_HASH_BYTES = 'hash_bytes_read'
+
+COUNTER_NAMES = OrderedDict([
+    (COUNTER_BOOKS, _('Books')),
+    (COUNTER_UNIQUE_TITLES, _('Unique titles evaluated')),
+    (COUNTER_BOOK_AUTHORS, _('Authors of the books')),
+    (COUNTER_UNIQUE_AUTHORS, _('Unique authors evaluated')),
+    (COUNTER_UNIQUE_KEYS, _('Unique candidate keys (candidate groups before shrink)')),
+    (COUNTER_GROUPS_AFTER_SHRINK, _('Candidate groups after shrink')),
+    (COUNTER_GROUPS_AFTER_CLEANUP, _('Candidate groups after removing subsets')),
+    (COUNTER_DUPLICATE_GROUPS, _('Duplicate groups')),
+    (COUNTER_FORMATS_HASHED, _('Formats hashed')),
+    (COUNTER_HASH_BYTES, _('Bytes read to hash formats')),
+])
+
+
+class SearchStats(object):
+    '''
+    Records how long each stage of a duplicate search took, and counts of
+    what it processed, to see where the time of a slow search goes.
+    The time of a stage excludes that of any stage nested within it, so the
+    stage times add up to the total. Stages run many times are summed.
+    '''
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._running = []
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager timing the code within it as this stage
+        '''
+        # Each running stage is a list of its name, start and nested time
+        running = [name, time.time(), 0.0]
+        self._running.append(running)
+        try:
+            yield
+        finally:
+            self._running.pop()
+            elapsed = time.time() - running[1]
+            self.add_time(name, elapsed - running[2])
+            if self._running:
+                self._running[-1][2] += elapsed
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_count(self, name, value):
+        self.counters[name] = value
+
+    def total_time(self):
+        return sum(self.stages.values())
+
+    def as_dict(self):
+        '''
+        Return the stage times in seconds and the counters, to be
+        inspected or serialised by code using the algorithms
+        '''
+        return {
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'total': self.total_time()
+        }
+
+    def format_lines(self):
+        '''
+        Return the stage times and counters as lines of text
+        '''
+        lines = [_('Search stages:')]
+        for name in list(STAGE_NAMES.keys()) + [name for name in self.stages if name not in STAGE_NAMES]:
+            if name in self.stages:
+                lines.append('    {0}: {1:.3f}s'.format(STAGE_NAMES.get(name, name), self.stages[name]))
+        lines.append('    {0}: {1:.3f}s'.format(_('Total'), self.total_time()))
+        if self.counters:
+            lines.append(_('Search counts:'))
+            for name in list(COUNTER_NAMES.keys()) + [name for name in self.counters if name not in COUNTER_NAMES]:
+                if name in self.counters:
+                    lines.append('    {0}: {1}'.format(COUNTER_NAMES.get(name, name), self.counters[name]))
+        return lines
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+'''
+Tests of the exemption store. Run from the plugin folder with:
+
+    python -m unittest discover -s tests
+'''
+
+import json, os, unittest
+
+
+def load_plugin_module(name):
+    '''
+    Load a module of the plugin which imports nothing from calibre by its path
+    '''
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name + '.py')
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source('find_duplicates_' + name, path)
+    spec = spec_from_file_location('find_duplicates_' + name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+exemptions = load_plugin_module('exemptions')
+
+
+class NamespacedPrefs(object):
+    '''
+    Stores values like calibre's DBPrefs, including rejecting keys with colons
+    '''
+    def __init__(self):
+        self.values = {}
+
+    def get_namespaced(self, namespace, key, default=None):
+        value = self.values.get('namespaced:%s:%s' % (namespace, key))
+        return default if value is None else json.loads(value)
+
+    def set_namespaced(self, namespace, key, value):
+        if ':' in key:
+            raise KeyError('Colons are not allowed in keys')
+        if ':' in namespace:
+            raise KeyError('Colons are not allowed in the namespace')
+        self.values['namespaced:%s:%s' % (namespace, key)] = json.dumps(value)
+
+
+class TestExemptionStore(unittest.TestCase):
+
+    def create_store(self, prefs):
+        return exemptions.ExemptionStore(prefs, 'FindDuplicatesPlugin', 'bookExemptions')
+
+    def assertSameExemptions(self, exemptions_map, expected_map):
+        self.assertEqual(sorted(exemptions_map.keys()), sorted(expected_map.keys()))
+        for member in expected_map.keys():
+            self.assertEqual(exemptions_map.merge_sets(member), expected_map.merge_sets(member))
+
+    def test_replace_all(self):
+        prefs = NamespacedPrefs()
+        self.create_store(prefs).replace_all([[1, 2], [3, 4, 5]])
+        self.assertSameExemptions(self.create_store(prefs).exemptions_map,
+                                  exemptions.ExemptionMap([[1, 2], [3, 4, 5]]))
+
+    def test_changes_are_logged_and_reloaded(self):
+        prefs = NamespacedPrefs()
+        store = self.create_store(prefs)
+        store.replace_all([[1, 2]])
+        store.add_group([3, 4, 5])
+        store.remove_items([4])
+        store.remove_master_child(1, [2])
+        expected_map = exemptions.ExemptionMap([[1, 2]])
+        expected_map.add_group([3, 4, 5])
+        expected_map.remove_items([4])
+        expected_map.remove_master_child(1, [2])
+        self.assertTrue(any('_log_' in key for key in prefs.values))
+        self.assertSameExemptions(self.create_store(prefs).exemptions_map, expected_map)
+
+    def test_changes_which_do_nothing_are_not_logged(self):
+        prefs = NamespacedPrefs()
+        store = self.create_store(prefs)
+        store.replace_all([[1, 2, 3]])
+        values = dict(prefs.values)
+        store.add_group([3, 1])
+        store.remove_master_child(4, [1])
+        self.assertEqual(prefs.values, values)
+        store.add_group([3, 4])
+        self.assertNotEqual(prefs.values, values)
+        self.assertEqual(store.exemptions_map.merge_sets(4), frozenset([3]))
+
+    def test_compaction(self):
+        prefs = NamespacedPrefs()
+        store = self.create_store(prefs)
+        store.MIN_COMPACT_LOG_SIZE = 2
+        for book_id in range(1, 20, 2):
+            store.add_group([book_id, book_id + 1])
+        reloaded_store = self.create_store(prefs)
+        self.assertSameExemptions(reloaded_store.exemptions_map, store.exemptions_map)
+        self.assertTrue(reloaded_store.has_exemptions())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,14 @@ from collections import OrderedDict, defaultdict
 from calibre import prints
 from calibre.constants import DEBUG
 
-from calibre_plugins.find_duplicates.matching import get_variation_algorithm_fn, get_field_pairs
+from calibre_plugins.find_duplicates.matching import (get_variation_algorithm_fn, get_field_pairs,
+                                                      remove_subset_groups)
+from calibre_plugins.find_duplicates.worker import report_progress, iter_with_progress
+
+try:
+    load_translations()
+except NameError:
+    pass
 
 # --------------------------------------------------------------
 #              Variation Algorithm Class
@@ -21,6 +28,14 @@ class VariationAlgorithm(object):
     '''
     def __init__(self, db):
         self.db = db
+        self._progress = None
+
+    def set_progress(self, progress):
+        '''
+        Set a function of (stage, done, total) for the algorithm to report its
+        progress to as it runs. The function returns False to cancel the search.
+        '''
+        self._progress = progress
 
     def run_variation_check(self, match_type, item_type):
         '''
@@ -40,6 +55,7 @@ class VariationAlgorithm(object):
         matches_for_item_map = self._flatten_candidates_for_item(candidates_map, data_map)
 
         # Now lookup how many books there are for each candidate
+        report_progress(self._progress, _('Counting books for {0} {1}').format(len(matches_for_item_map), item_type))
         count_map = self._get_counts_for_candidates(matches_for_item_map, item_type)
 
         if DEBUG:
@@ -70,7 +86,9 @@ class VariationAlgorithm(object):
         Return a dictionary of candidates.
         '''
         candidates_map = defaultdict(set)
-        for item_id, item_text in list(data_map.items()):
+        items = iter_with_progress(self._progress, list(data_map.items()),
+                                   _('Analysing {0} items for variations').format(len(data_map)))
+        for item_id, item_text in items:
             result = self.fn(item_text)
             # Have to cope with functions returning 1 or 2 results since
             # author functions do the reverse hash too
@@ -117,16 +135,7 @@ class VariationAlgorithm(object):
         Given a dictionary of sets, convert into a list of sets removing any sets
         that are subsets of other sets.
         '''
-        res = [set(d) for d in list(candidates_map.values())]
-        res.sort(key=lambda x: len(x))
-        candidates_list = []
-        for i,a in enumerate(res):
-            for b in res[i+1:]:
-                if a.issubset(b):
-                    break
-            else:
-                candidates_list.append(a)
-        return candidates_list
+        return remove_subset_groups(candidates_map.values())
 
     def _get_counts_for_candidates(self, matches_for_item_map, item_type):
         all_counts = self.db.get_usage_count_by_id(item_type)
@@ -0,0 +1,81 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import traceback
+from threading import Thread
+
+# This module must not import Qt or the calibre gui so that it can be used
+# by the duplicate algorithms outside of the calibre user interface.
+
+# How many items to process between each report of progress through a stage
+PROGRESS_CHUNK_SIZE = 500
+
+
+class SearchCancelled(Exception):
+    '''
+    Raised from within a search when the user has asked for it to be cancelled
+    '''
+    pass
+
+
+def report_progress(progress, stage, done=0, total=0):
+    '''
+    Report progress through a search to the optional progress function, which
+    is called with (stage, done, total) and returns False to cancel the search.
+    A total of zero means the size of the stage is not known.
+    '''
+    if progress is not None and progress(stage, done, total) is False:
+        raise SearchCancelled()
+
+
+def iter_with_progress(progress, items, stage, total=None, chunk_size=PROGRESS_CHUNK_SIZE):
+    '''
+    Iterate over the items, reporting progress at the start of each chunk of them
+    '''
+    if progress is None:
+        for item in items:
+            yield item
+        return
+    if total is None:
+        total = len(items)
+    for count, item in enumerate(items):
+        if count % chunk_size == 0:
+            report_progress(progress, stage, count, total)
+        yield item
+    report_progress(progress, stage, total, total)
+
+
+class BackgroundWorker(Thread):
+    '''
+    Runs fn(progress) on a separate thread so that the gui remains responsive.
+    The latest progress is held for the gui thread to poll, since the worker
+    must never touch the gui itself. Once the thread has finished, either the
+    result, the error raised or is_cancelled will be set.
+    '''
+    def __init__(self, fn):
+        Thread.__init__(self, name='FindDuplicatesWorker')
+        self.daemon = True
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.is_cancelled = False
+        self.current_progress = ('', 0, 0)
+
+    def run(self):
+        try:
+            self.result = self.fn(self.progress)
+        except SearchCancelled:
+            self.is_cancelled = True
+        except Exception as e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+
+    def progress(self, stage, done=0, total=0):
+        self.current_progress = (stage, done, total)
+        return not self.is_cancelled
+
+    def cancel(self):
+        self.is_cancelled = True